@@ -0,0 +1,269 @@
+"""End-to-end benchmark of the tunnel, run entirely on this machine.
+
+Starts a `fakemail.FakeMailServer`, an HTTP origin server, the remote and
+the local proxy, sends requests through the proxy from concurrent
+clients, and reports throughput, latency, mail traffic and memory use,
+and where the time went (see `metrics`):
+
+    >> python3 -m email_to_tcp.benchmark --requests 200 --concurrency 8
+
+Save a run with `--save results.json` and compare later runs with it with
+`--baseline results.json`. The tunnel's settings (BATCH_WINDOW, PREFETCH,
+...) are read from the environment as usual; the local cache is off
+unless `--cache` is given, so that every request crosses the tunnel.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+from email_to_tcp import fakemail, local, metrics, remote, utils
+
+
+logger = logging.getLogger(
+    'benchmark' if __name__ == '__main__' else __name__)
+
+LOCAL_ADDRESS = 'local@tunnel.test'
+REMOTE_ADDRESS = 'remote@tunnel.test'
+
+# Results compared with a baseline, and whether lower values are better
+METRICS = {'failed': True, 'seconds': True, 'requests_per_second': False,
+           'latency_p50_ms': True, 'latency_p99_ms': True,
+           'mail_bytes_per_request': True, 'emails_per_request': True,
+           'max_rss_mb': True}
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Answers GET /<anything>?<size> with a text page of <size> bytes"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urlsplit(self.path).query
+        size = int(query) if query.isdigit() else 2 ** 14
+        lines = b''.join(b'%s line %d\n' % (self.path.encode(), n)
+                         for n in range(size // 16 + 1))
+        body = lines[:size]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_in_background(server):
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name=type(server).__name__).start()
+    return server
+
+
+class QuietProxyServer(local.ThreadedTCPProxyServer):
+
+    def handle_error(self, request, client_address):
+        # Requests whose emails were lost fail when the tunnel closes
+        logger.debug("Request from %s failed", client_address,
+                     exc_info=True)
+
+
+class Tunnel:
+    """The remote and a local proxy, exchanging mail through `mail`"""
+
+    def __init__(self, mail, cache=False):
+        self.remote_settings = self.settings(mail, REMOTE_ADDRESS)
+        self.local_settings = self.settings(mail, LOCAL_ADDRESS)
+        self.local_settings.TO_EMAIL = REMOTE_ADDRESS
+        if not cache:
+            self.local_settings.CACHE_MEMORY_BYTES = 0
+            self.local_settings.CACHE_DIR = ''
+
+        threading.Thread(target=self.run_remote, daemon=True,
+                         name='remote').start()
+        # A handler class of our own, as `connect` sets class attributes
+        self.handler = type('BenchmarkHandler', (local.TCPProxyHandler,),
+                            {})
+        self.handler.connect(self.local_settings)
+        self.proxy = serve_in_background(QuietProxyServer(
+            ('127.0.0.1', 0), self.handler,
+            self.local_settings.MAX_IN_FLIGHT))
+
+    @staticmethod
+    def settings(mail, address):
+        s = mail.configure(utils.Settings(), address)
+        s.ACCOUNTS_FILE = ''
+        # Fail fast once the mail server is gone
+        s.RECONNECT_ATTEMPTS = 1
+        return s
+
+    def run_remote(self):
+        try:
+            remote.run(self.remote_settings)
+        except Exception as err:
+            logger.debug("Remote stopped: %s", err)
+
+    @property
+    def address(self):
+        return self.proxy.server_address
+
+    def close(self):
+        for account in self.handler.accounts.accounts:
+            account.watcher.stop()
+        self.proxy.shutdown()
+        self.proxy.server_close()
+
+
+def fetch(proxy_address, url, timeout):
+    """GET `url` through the proxy; returns (seconds, response bytes)
+
+    :raises OSError: if the proxy doesn't answer within `timeout`
+    :raises ValueError: if the response isn't a 200
+    """
+    started = time.monotonic()
+    request = 'GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (url,
+                                                       urlsplit(url).netloc)
+    response = []
+    with socket.create_connection(proxy_address, timeout) as sock:
+        sock.sendall(request.encode('ascii'))
+        while True:
+            chunk = sock.recv(2 ** 16)
+            if not chunk:
+                break
+            response.append(chunk)
+    response = b''.join(response)
+    if response.split(b' ', 2)[1:2] != [b'200']:
+        raise ValueError('Bad response: %r' % response[:80])
+    return time.monotonic() - started, len(response)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    # Kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10),
+                 1)
+
+
+def run(requests=100, concurrency=8, size=2 ** 14, delay=0, loss=0,
+        timeout=30, cache=False, seed=None):
+    """Send `requests` requests of `size`-byte pages through a tunnel
+    over a fake mail server, `concurrency` at a time
+
+    :param delay: Seconds the mail server takes to deliver an email
+    :param loss: Fraction of emails the mail server drops
+    :return: dict of results
+    """
+    with fakemail.FakeMailServer(delay=delay, loss=loss, seed=seed) as mail:
+        origin = serve_in_background(
+            ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler))
+        tunnel = Tunnel(mail, cache)
+        origin_url = 'http://127.0.0.1:%d' % origin.server_address[1]
+
+        def one(n):
+            try:
+                return fetch(tunnel.address,
+                             '%s/%d?%d' % (origin_url, n, size), timeout)
+            except (OSError, ValueError) as err:
+                logger.debug("Request %d failed: %s", n, err)
+                return None
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(concurrency) as clients:
+            results = list(clients.map(one, range(requests)))
+        seconds = time.monotonic() - started
+
+        tunnel.close()
+        origin.shutdown()
+        origin.server_close()
+
+    latencies = [latency for latency, _ in filter(None, results)]
+    completed = len(latencies) or 1
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'size': size,
+        'failed': requests - len(latencies),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(latencies) / seconds, 2),
+        'latency_p50_ms': round(1000 * percentile(latencies or [0], 0.5),
+                                1),
+        'latency_p99_ms': round(1000 * percentile(latencies or [0], 0.99),
+                                1),
+        'mail_bytes_per_request': mail.delivered_bytes // completed,
+        'emails_per_request': round(mail.delivered / completed, 2),
+        'max_rss_mb': max_rss_mb(),
+    }
+
+
+def report(results, baseline=None):
+    """Lines describing `results`, with the change from `baseline`"""
+    lines = []
+    for name, value in results.items():
+        line = '%-24s %s' % (name, value)
+        before = (baseline or {}).get(name)
+        if name in METRICS and value is not None and before:
+            change = 100.0 * (value - before) / before
+            better = (change < 0) == METRICS[name]
+            line += '  (%+.1f%% vs %s%s)' % (
+                change, before, '' if not change else
+                ', better' if better else ', worse')
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the tunnel end to end over a fake mail server')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--size', type=int, default=2 ** 14,
+                        help='bytes per response body')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds the mail server takes to deliver')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='fraction of emails the mail server drops')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds before a request counts as failed')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the local response cache on')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved earlier')
+    args = parser.parse_args(argv)
+
+    results = run(args.requests, args.concurrency, args.size, args.delay,
+                  args.loss, args.timeout, args.cache, args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print('\n'.join(report(results, baseline)))
+    print('\nStages (local and remote):')
+    print('\n'.join(metrics.summary()[0]))
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,604 @@
+"""HTTP response caches on both ends of the tunnel.
+
+Every request served from the local `ResponseCache` saves a whole email
+round trip. The cache follows the HTTP caching rules that matter for a
+single-user (private) cache: Cache-Control (no-store, no-cache,
+max-age), Expires, heuristic freshness from Last-Modified, Vary, and
+revalidation of stale responses with If-None-Match/If-Modified-Since.
+Recently used responses are kept in an in-memory LRU; every cached
+response is also written to a directory on disk, which is trimmed back
+to its size limit by evicting the least recently used files.
+
+When the local cache revalidates a response, it also sends the hash of
+the body it holds in an X-Tunnel-Have header. The remote's
+`UpstreamCache` answers with a tiny 304 Not Modified whenever the
+current body has that hash, even if the origin server doesn't support
+conditional requests, so an unchanged page costs a few hundred bytes of
+email instead of the whole payload. If the body has changed but the
+remote still holds the version the local cache has, it sends a delta
+against that version instead (see `delta`), marked with an
+X-Tunnel-Delta header naming the hash of its base.
+"""
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import hashlib
+from http.client import parse_headers
+from io import BytesIO
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from email_to_tcp import delta, prefetch, utils
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses that may be cached without explicit freshness information
+CACHEABLE_STATUSES = {200, 203, 300, 301, 404, 410}
+
+# Upper bound on the heuristic freshness derived from Last-Modified
+MAX_HEURISTIC_LIFETIME = 24 * 60 * 60
+
+# Hash of the body the local cache holds, sent when revalidating
+HAVE_HEADER = 'X-Tunnel-Have'
+
+# Hash of the body a delta relayed in place of the response body applies to
+DELTA_HEADER = 'X-Tunnel-Delta'
+
+# Headers of a full response that are repeated in a 304 Not Modified
+NOT_MODIFIED_HEADERS = ('date', 'etag', 'last-modified', 'cache-control',
+                        'expires', 'vary', 'content-location')
+
+
+def parse_cache_control(headers):
+    """Dictionary of the Cache-Control directives in `headers`"""
+    directives = {}
+    for value in headers.get_all('Cache-Control') or []:
+        for directive in value.split(','):
+            name, _, argument = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def _parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness_lifetime(headers, now):
+    """Seconds for which a response with `headers` is fresh"""
+    directives = parse_cache_control(headers)
+    if 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            return max(0, int(directives['max-age']))
+        except ValueError:
+            return 0
+
+    date = _parse_date(headers.get('Date')) or now
+    if headers.get('Expires') is not None:
+        expires = _parse_date(headers.get('Expires'))
+        return max(0, expires - date) if expires else 0
+
+    last_modified = _parse_date(headers.get('Last-Modified'))
+    if last_modified:
+        return min(MAX_HEURISTIC_LIFETIME,
+                   max(0, (date - last_modified) / 10))
+    return 0
+
+
+def parse_response_head(head):
+    """(status, headers) of the status line and headers in `head`"""
+    status_line, _, header_block = head.partition(b'\r\n')
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        status = 0
+    return status, parse_headers(BytesIO(header_block))
+
+
+def split_head(chunks):
+    """Read the status line and headers off a stream of response chunks
+
+    :return: (head, body) where body iterates over the remaining chunks
+    """
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        end = head.find(b'\r\n\r\n')
+        if end != -1:
+            rest = head[end + 4:]
+            return head[:end + 4], _prepend(rest, chunks)
+    return head, iter(())
+
+
+def _prepend(first, chunks):
+    if first:
+        yield first
+    yield from chunks
+
+
+def body_digest(body):
+    """Value of the X-Tunnel-Have header for a response body"""
+    return hashlib.sha256(body).hexdigest()
+
+
+def not_modified_head(head):
+    """Head of a 304 Not Modified standing in for the response `head`"""
+    _, header_block = head.split(b'\r\n', 1)
+    lines = [b'HTTP/1.1 304 Not Modified']
+    for line in header_block.split(b'\r\n'):
+        name = line.partition(b':')[0].strip().lower().decode('latin-1')
+        if name in NOT_MODIFIED_HEADERS:
+            lines.append(line)
+    lines.append(b'Connection: close')
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def vary_header_names(headers):
+    """Request header names listed by the Vary headers of a response"""
+    return [name.strip() for value in headers.get_all('Vary') or []
+            for name in value.split(',') if name.strip()]
+
+
+def add_header(head, name, value):
+    """Add a header to a raw request without a body, or a response head"""
+    if not head.endswith(b'\r\n\r\n'):
+        return head
+    line = ('%s: %s\r\n' % (name, value)).encode('iso-8859-1')
+    return head[:-2] + line + b'\r\n'
+
+
+def remove_header(head, name):
+    """Remove every `name` header from a response head"""
+    prefix = name.lower().encode('iso-8859-1') + b':'
+    return b'\r\n'.join(line for line in head.split(b'\r\n')
+                         if not line.lower().startswith(prefix))
+
+
+class CacheEntry:
+    """A cached response, with the request header values it varies on"""
+
+    def __init__(self, key, vary, head, body, stored_at, lifetime):
+        self.key = key
+        self.vary = vary
+        self.head = head
+        self.body = body
+        self.stored_at = stored_at
+        self.lifetime = lifetime
+        self.status, self.headers = parse_response_head(head)
+        self._digest = None
+
+    @property
+    def size(self):
+        return len(self.head) + len(self.body)
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = body_digest(self.body)
+        return self._digest
+
+    def age(self, now=None):
+        return max(0, (now or time.time()) - self.stored_at)
+
+    def is_fresh(self, now=None):
+        return self.age(now) < self.lifetime
+
+    def matches(self, request):
+        """Whether the varying request headers match those cached"""
+        return all(request.headers.get(name) == value
+                   for name, value in self.vary.items())
+
+    def chunks(self):
+        """The response, as served to the client (with an Age header)"""
+        status_line, _, header_block = self.head.partition(b'\r\n')
+        lines = [line for line in header_block.split(b'\r\n')
+                 if line and not line.lower().startswith(b'age:')]
+        age = ('Age: %d' % self.age()).encode('ascii')
+        yield b'\r\n'.join([status_line, age] + lines) + b'\r\n\r\n'
+        if self.body:
+            yield self.body
+
+    def revalidated(self, headers, now=None):
+        """Entry refreshed by the headers of a 304 Not Modified"""
+        now = now or time.time()
+        lifetime = freshness_lifetime(headers, now)
+        return CacheEntry(self.key, self.vary, self.head, self.body,
+                          now, lifetime)
+
+    def dump(self):
+        meta = {'key': self.key, 'vary': self.vary,
+                'stored_at': self.stored_at, 'lifetime': self.lifetime,
+                'head_length': len(self.head)}
+        return json.dumps(meta).encode('utf-8') + b'\n' + self.head + \
+            self.body
+
+    @classmethod
+    def load(cls, data):
+        meta_line, _, rest = data.partition(b'\n')
+        meta = json.loads(meta_line.decode('utf-8'))
+        head, body = rest[:meta['head_length']], rest[meta['head_length']:]
+        return cls(meta['key'], meta['vary'], head, body,
+                   meta['stored_at'], meta['lifetime'])
+
+
+class DiskStore:
+    """Cache entries stored one per file, trimmed to `max_bytes` by
+    evicting the least recently used files"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._paths())
+
+    def _paths(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.entry')]
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest() + '.entry'
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                entry = CacheEntry.load(entry_file.read())
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError, KeyError) as err:
+            logger.debug("Disk cache miss for %s: %s", key, err)
+            return None
+        return entry
+
+    def put(self, entry):
+        path = self._path(entry.key)
+        self.delete(entry.key)
+        data = entry.dump()
+        with open(path + '.tmp', 'wb') as entry_file:
+            entry_file.write(data)
+        os.replace(path + '.tmp', path)
+        self.size += len(data)
+        self._evict()
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.size -= size
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for path in sorted(self._paths(), key=os.path.getmtime):
+            if self.size <= self.max_bytes:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class MemoryStore:
+    """In-memory LRU of cache entries, bounded by their total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, entry):
+        with self._lock:
+            old = self._entries.pop(entry.key, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[entry.key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+
+class ResponseCache:
+    """Cache of tunneled HTTP responses, consulted before sending email
+
+    Use `respond()` to serve a raw request: it returns cached responses
+    that are still fresh, revalidates stale ones through the tunnel and
+    stores new cacheable responses as they stream past.
+    """
+
+    def __init__(self, s):
+        self.max_entry_bytes = s.CACHE_MAX_ENTRY_BYTES
+        self.memory = MemoryStore(s.CACHE_MEMORY_BYTES)
+        self.disk = None
+        if s.CACHE_DIR and s.CACHE_DISK_BYTES:
+            self.disk = DiskStore(s.CACHE_DIR, s.CACHE_DISK_BYTES)
+        self._disk_lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.put(entry)
+        return entry
+
+    def put(self, entry):
+        self.memory.put(entry)
+        if self.disk is not None:
+            with self._disk_lock:
+                self.disk.put(entry)
+
+    def respond(self, raw_request, fetch):
+        """Chunks of the response to `raw_request`
+
+        :param fetch: Function sending a raw request through the tunnel
+        and returning the chunks of its response
+        """
+        lookup = self.lookup(raw_request)
+        if lookup.chunks is not None:
+            return lookup.chunks
+        return lookup.finish(fetch(lookup.request))
+
+    def lookup(self, raw_request):
+        """Look up `raw_request`; see `Lookup`"""
+        try:
+            request = utils.Forwarder(raw_request)
+        except ValueError:
+            return Lookup(self, raw_request)
+
+        request_directives = parse_cache_control(request.headers)
+        if (request.method.upper() != 'GET' or
+                'no-store' in request_directives or
+                request.headers.get('Authorization')):
+            return Lookup(self, raw_request)
+
+        key = request.path
+        entry = self.get(key)
+        if entry is not None and not entry.matches(request):
+            entry = None
+        reload = ('no-cache' in request_directives or
+                  request.headers.get('Pragma') == 'no-cache')
+        if entry is not None and entry.is_fresh() and not reload:
+            logger.debug("Cache hit for %s", key)
+            return Lookup(self, raw_request, chunks=entry.chunks())
+
+        if entry is not None:
+            raw_request = add_header(
+                raw_request, HAVE_HEADER, entry.digest)
+            etag = entry.headers.get('ETag')
+            last_modified = entry.headers.get('Last-Modified')
+            if etag:
+                raw_request = add_header(
+                    raw_request, 'If-None-Match', etag)
+            if last_modified:
+                raw_request = add_header(
+                    raw_request, 'If-Modified-Since', last_modified)
+        return Lookup(self, raw_request, request, entry)
+
+    def push(self, url, page_request, chunks):
+        """Store a response the remote sent along with a page, as if it
+        had been requested by the browser"""
+        try:
+            page = utils.Forwarder(page_request)
+            request = utils.Forwarder(
+                prefetch.subresource_request(url, page.headers))
+            head, body = split_head(chunks)
+            status, headers = parse_response_head(head)
+            for _ in self._store(url, request, head, status, headers, body):
+                pass
+        except Exception as err:
+            logger.debug("Unable to store pushed %s: %s", url, err)
+            return
+        logger.debug("Stored pushed %s", url)
+
+    def _store(self, key, request, head, status, headers, body):
+        """Pass the response through, caching it if allowed"""
+        now = time.time()
+        directives = parse_cache_control(headers)
+        vary_names = vary_header_names(headers)
+        lifetime = freshness_lifetime(headers, now)
+        cacheable = (
+            status in CACHEABLE_STATUSES and
+            'no-store' not in directives and
+            '*' not in vary_names and
+            (lifetime > 0 or headers.get('ETag') or
+             headers.get('Last-Modified')))
+
+        yield head
+        if not cacheable:
+            yield from body
+            return
+
+        stored, size = [], len(head)
+        for chunk in body:
+            if stored is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    stored = None
+                else:
+                    stored.append(chunk)
+            yield chunk
+
+        if stored is not None:
+            vary = {name: request.headers.get(name) for name in vary_names}
+            self.put(CacheEntry(key, vary, head, b''.join(stored),
+                                now, lifetime))
+
+
+def read_at_most(chunks, limit):
+    """Read up to `limit` bytes (plus one chunk) from an iterator
+
+    :return: (data, complete) where `complete` tells whether the
+    iterator was exhausted
+    """
+    buffered, size = [], 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            return b''.join(buffered), False
+    return b''.join(buffered), True
+
+
+class Lookup:
+    """Outcome of looking a request up in a `ResponseCache`
+
+    Either `chunks` holds the cached response, or `request` has to be
+    sent through the tunnel and the chunks of its response passed to
+    `finish()`.
+    """
+
+    def __init__(self, cache, raw_request, request=None, entry=None,
+                 chunks=None):
+        self.cache = cache
+        self.request = raw_request
+        self.chunks = chunks
+        self._parsed = request
+        self._entry = entry
+
+    def finish(self, chunks):
+        """Chunks of the response to serve, caching it if allowed"""
+        request, entry = self._parsed, self._entry
+        if request is None:
+            return chunks
+        key = request.path
+        head, body = split_head(chunks)
+        status, headers = parse_response_head(head)
+        base = headers.get(DELTA_HEADER)
+        if base is not None:
+            if entry is None or base != entry.digest:
+                logger.error("Delta for %s against an unknown base", key)
+                return iter([utils.error_response(502, 'Bad Gateway')])
+            try:
+                body = iter([delta.apply(entry.body, b''.join(body))])
+            except ValueError as err:
+                logger.error("Bad delta for %s: %s", key, err)
+                return iter([utils.error_response(502, 'Bad Gateway')])
+            head = remove_header(head, DELTA_HEADER)
+            logger.debug("Rebuilt %s from a delta", key)
+        if status == 304 and entry is not None:
+            logger.debug("Revalidated cached %s", key)
+            entry = entry.revalidated(headers)
+            self.cache.put(entry)
+            return entry.chunks()
+        return self.cache._store(key, request, head, status, headers, body)
+
+
+# Prefix of the keys under which relayed bodies are kept by hash
+BASE_PREFIX = 'sha256:'
+
+
+class UpstreamCache:
+    """Remote-side cache of origin responses, keyed by URL and the
+    request headers the response varies on
+
+    Cached validators make origin requests conditional, and cached
+    bodies let the remote answer a revalidation from the local cache
+    (see HAVE_HEADER) with a 304 whenever the body hasn't changed. The
+    bodies relayed recently are also kept by hash, as bases for deltas.
+    With a `transcode.Transcoder`, responses are cached and compared as
+    they are relayed, after transcoding.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes, transcoder=None):
+        self.memory = MemoryStore(max_bytes)
+        self.max_entry_bytes = max_entry_bytes
+        self.transcoder = transcoder
+
+    def get(self, forwarder):
+        """Cached entry for a parsed request, if its Vary headers match"""
+        entry = self.memory.get(forwarder.path)
+        if entry is not None and entry.matches(forwarder):
+            return entry
+        return None
+
+    def forward(self, forwarder, session=None, chunk_size=2 ** 16):
+        """Forward a parsed request (`utils.Forwarder`) to its origin
+
+        :return: iterator over the relayed response (head and body)
+        """
+        have = forwarder.headers.get(HAVE_HEADER)
+        del forwarder.headers[HAVE_HEADER]
+        cacheable_request = forwarder.method.upper() == 'GET'
+        entry = self.get(forwarder) if cacheable_request else None
+
+        own_validators = False
+        if entry is not None and not (
+                forwarder.headers.get('If-None-Match') or
+                forwarder.headers.get('If-Modified-Since')):
+            for validator, conditional in (
+                    ('ETag', 'If-None-Match'),
+                    ('Last-Modified', 'If-Modified-Since')):
+                if entry.headers.get(validator):
+                    forwarder.headers[conditional] = \
+                        entry.headers.get(validator)
+                    own_validators = True
+
+        response = forwarder.forward(session, stream=True)
+        head = utils.response_head(response)
+        if response.status_code == 304:
+            response.close()
+            if not own_validators:
+                # The local cache's own validators matched
+                return iter([head])
+            logger.debug("Origin confirmed cached %s", forwarder.path)
+            head, body = entry.head, entry.body
+            self.memory.put(entry)
+        else:
+            chunks = response.iter_content(chunk_size)
+            if self.transcoder is not None:
+                head, chunks = self.transcoder.transcode(head, chunks)
+            _, headers = parse_response_head(head)
+            vary_names = vary_header_names(headers)
+            if not (cacheable_request and response.status_code == 200 and
+                    'no-store' not in parse_cache_control(headers) and
+                    '*' not in vary_names):
+                # Neither cached nor compared: relayed as it arrives
+                return itertools.chain([head], chunks)
+            body, complete = read_at_most(chunks, self.max_entry_bytes)
+            if not complete:
+                return itertools.chain([head, body], chunks)
+            vary = {name: forwarder.headers.get(name)
+                    for name in vary_names}
+            self.memory.put(CacheEntry(forwarder.path, vary, head,
+                                       body, time.time(), 0))
+
+        digest = body_digest(body)
+        if have and have == digest:
+            logger.debug("Local copy of %s is current", forwarder.path)
+            return iter([not_modified_head(head)])
+        # The local cache will hold this version from now on
+        self.memory.put(CacheEntry(BASE_PREFIX + digest, {}, b'', body,
+                                   time.time(), 0))
+        base = self.memory.get(BASE_PREFIX + have) if have else None
+        if base is not None:
+            patch = delta.encode(base.body, body)
+            if len(patch) < len(body):
+                logger.debug("Sending %s as a %d byte delta",
+                             forwarder.path, len(patch))
+                return iter([add_header(head, DELTA_HEADER, have), patch])
+        return iter([head, body])
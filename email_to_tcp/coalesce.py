@@ -0,0 +1,354 @@
+"""Sharing one email round trip between identical requests in flight.
+
+Browsers often ask for a URL again while the first request for it is
+still waiting on its reply email: from another tab, or a preload
+followed by the real request. `Coalescer.fetch` sends only the first of
+such requests through the tunnel; the others attach to it and are served
+the same response, from its first byte, as it arrives.
+
+Requests are identical if their method, URL and the request headers that
+may change the response (`KEY_HEADERS`) are. Only requests a shared
+cache could answer are coalesced: GET and HEAD requests without a body,
+Authorization or Cache-Control: no-store.
+
+`AsyncCoalescer` does the same for the asyncio engine, whose requests
+wait on the event loop rather than on threads.
+"""
+import asyncio
+import logging
+import threading
+
+from email_to_tcp import cache, utils
+
+
+logger = logging.getLogger(__name__)
+
+# Request headers that select between responses for the same URL
+KEY_HEADERS = ('Accept', 'Accept-Encoding', 'Accept-Language', 'Cookie',
+               'Range', 'If-None-Match', 'If-Modified-Since',
+               cache.HAVE_HEADER)
+
+
+def coalescing_key(raw_request):
+    """Key identifying requests that can share a response, or None if
+    `raw_request` has to be sent on its own"""
+    head, separator, body = raw_request.partition(b'\r\n\r\n')
+    if not separator or body:
+        return None
+    try:
+        request = utils.Forwarder(raw_request)
+    except ValueError:
+        return None
+    if (request.method.upper() not in ('GET', 'HEAD') or
+            request.headers.get('Authorization') or
+            'no-store' in cache.parse_cache_control(request.headers)):
+        return None
+    return (request.method.upper(), request.path) + tuple(
+        tuple(request.headers.get_all(name) or ()) for name in KEY_HEADERS)
+
+
+class SharedResponse:
+    """Response chunks read once from their source and served to every
+    reader
+
+    Each chunk is read from the source by whichever reader needs it
+    first, and kept for the others. Readers can join as long as the
+    response is open (see `close`); once it is closed, the chunks every
+    reader has passed are dropped.
+    """
+
+    def __init__(self, on_close=None):
+        self.on_close = on_close
+        self.size = 0
+        self._source = None
+        self._chunks = []
+        self._first = 0  # Index of _chunks[0] in the response
+        self._positions = {}  # reader: index of its next chunk
+        self._pulling = False
+        self._done = False
+        self._error = None
+        self._open = True
+        self._condition = threading.Condition()
+
+    def start(self, chunks):
+        """Start serving the response `chunks`"""
+        with self._condition:
+            self._source = iter(chunks)
+            self._condition.notify_all()
+
+    def fail(self, err):
+        """Fail every reader waiting for the response to start"""
+        with self._condition:
+            self._error = err
+            self._condition.notify_all()
+        self.close()
+
+    def close(self):
+        """Stop taking new readers"""
+        with self._condition:
+            if not self._open:
+                return
+            self._open = False
+            self._trim()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def reader(self):
+        """Iterator over the whole response, or None if the response is
+        closed to new readers"""
+        with self._condition:
+            if not self._open:
+                return None
+            token = object()
+            self._positions[token] = 0
+        return self._read(token)
+
+    def _read(self, token):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._ready(token))
+                    position = self._positions[token]
+                    end = self._first + len(self._chunks)
+                    if position < end:
+                        chunk = self._chunks[position - self._first]
+                        self._positions[token] = position + 1
+                        self._trim()
+                    elif self._error is not None:
+                        raise self._error
+                    elif self._done:
+                        return
+                    else:
+                        self._pulling = True
+                        chunk = None
+                if chunk is None:
+                    self._pull()
+                else:
+                    yield chunk
+        finally:
+            with self._condition:
+                del self._positions[token]
+                self._trim()
+
+    def _ready(self, token):
+        # Called with the condition held
+        return (self._positions[token] < self._first + len(self._chunks) or
+                self._error is not None or self._done or
+                (self._source is not None and not self._pulling))
+
+    def _pull(self):
+        """Read the next chunk from the source, for every reader"""
+        chunk = error = None
+        try:
+            chunk = next(self._source)
+        except StopIteration:
+            pass
+        except Exception as err:
+            error = err
+        with self._condition:
+            self._pulling = False
+            if chunk is not None:
+                self._chunks.append(chunk)
+                self.size += len(chunk)
+            elif error is not None:
+                self._error = error
+            else:
+                self._done = True
+            self._condition.notify_all()
+        if chunk is None:
+            self.close()
+
+    def _trim(self):
+        # Called with the condition held
+        if self._open:
+            return
+        keep_from = min(self._positions.values(),
+                        default=self._first + len(self._chunks))
+        del self._chunks[:keep_from - self._first]
+        self._first = max(self._first, keep_from)
+
+
+class Coalescer:
+    """Sends identical requests in flight through the tunnel only once
+
+    Every request for which `coalescing_key` finds an identical one
+    still being answered is served that request's response. Responses
+    stop taking new readers once they are complete, or once
+    `max_bytes` of them would have to be kept for readers joining late.
+    """
+
+    def __init__(self, max_bytes=2 ** 23):
+        self.max_bytes = max_bytes
+        self._in_flight = {}  # key: SharedResponse
+        self._lock = threading.Lock()
+
+    def fetch(self, raw_request, send):
+        """Chunks of the response to `raw_request`
+
+        :param send: Function sending a raw request through the tunnel
+        and returning the chunks of its response
+        """
+        key = coalescing_key(raw_request)
+        if key is None:
+            return send(raw_request)
+        with self._lock:
+            shared = self._in_flight.get(key)
+            reader = shared.reader() if shared is not None else None
+            if reader is not None:
+                logger.debug("Sharing the response to %s %s", *key[:2])
+                return reader
+            shared = SharedResponse(
+                on_close=lambda closed: self._forget(key, closed))
+            self._in_flight[key] = shared
+            reader = shared.reader()
+
+        try:
+            shared.start(self._limit(send(raw_request), shared))
+        except Exception as err:
+            shared.fail(err)
+            raise
+        return reader
+
+    def _limit(self, chunks, shared):
+        """Pass `chunks` through, closing `shared` to new readers once it
+        holds more than `max_bytes`"""
+        for chunk in chunks:
+            if shared.size + len(chunk) > self.max_bytes:
+                shared.close()
+            yield chunk
+
+    def _forget(self, key, shared):
+        with self._lock:
+            if self._in_flight.get(key) is shared:
+                del self._in_flight[key]
+
+
+class _AsyncSharedResponse:
+    """`SharedResponse` for readers on an asyncio event loop
+
+    The response is read by a task of its own as it arrives, and every
+    reader is served from the chunks read so far.
+    """
+
+    def __init__(self, max_bytes, on_close):
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.open = True
+        self.size = 0
+        self._chunks = []
+        self._first = 0  # Index of _chunks[0] in the response
+        self._positions = {}  # reader: index of its next chunk
+        self._done = False
+        self._error = None
+        self._changed = asyncio.Event()
+
+    def start(self, chunks):
+        """Start reading the async iterable `chunks`"""
+        asyncio.ensure_future(self._read_source(chunks))
+
+    async def _read_source(self, chunks):
+        try:
+            async for chunk in chunks:
+                self._chunks.append(chunk)
+                self.size += len(chunk)
+                if self.size > self.max_bytes:
+                    self.close()
+                self._notify()
+        except Exception as err:
+            self._error = err
+        else:
+            self._done = True
+        self.close()
+        self._notify()
+
+    def fail(self, err):
+        """Fail every reader waiting for the response to start"""
+        self._error = err
+        self.close()
+        self._notify()
+
+    def close(self):
+        """Stop taking new readers"""
+        if not self.open:
+            return
+        self.open = False
+        self._trim()
+        self.on_close(self)
+
+    def reader(self):
+        """Async iterator over the whole response"""
+        token = object()
+        self._positions[token] = 0
+        return self._read(token)
+
+    async def _read(self, token):
+        try:
+            while True:
+                position = self._positions[token]
+                if position < self._first + len(self._chunks):
+                    chunk = self._chunks[position - self._first]
+                    self._positions[token] = position + 1
+                    self._trim()
+                    yield chunk
+                elif self._error is not None:
+                    raise self._error
+                elif self._done:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            del self._positions[token]
+            self._trim()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _trim(self):
+        if self.open:
+            return
+        keep_from = min(self._positions.values(),
+                        default=self._first + len(self._chunks))
+        del self._chunks[:keep_from - self._first]
+        self._first = max(self._first, keep_from)
+
+
+class AsyncCoalescer:
+    """`Coalescer` for requests served on an asyncio event loop (see
+    `local.AsyncTCPProxyServer`), under the same limits
+
+    Its methods must be called from the loop's thread.
+    """
+
+    def __init__(self, max_bytes=2 ** 23):
+        self.max_bytes = max_bytes
+        self._in_flight = {}  # key: _AsyncSharedResponse
+
+    async def fetch(self, raw_request, send):
+        """Async iterator over the response to `raw_request`
+
+        :param send: Coroutine function sending a raw request through
+        the tunnel and returning an async iterable over its response
+        """
+        key = coalescing_key(raw_request)
+        if key is None:
+            return await send(raw_request)
+        shared = self._in_flight.get(key)
+        if shared is not None and shared.open:
+            logger.debug("Sharing the response to %s %s", *key[:2])
+            return shared.reader()
+        shared = _AsyncSharedResponse(
+            self.max_bytes, lambda closed: self._forget(key, closed))
+        self._in_flight[key] = shared
+        reader = shared.reader()
+        try:
+            chunks = await send(raw_request)
+        except Exception as err:
+            shared.fail(err)
+            raise
+        shared.start(chunks)
+        return reader
+
+    def _forget(self, key, shared):
+        if self._in_flight.get(key) is shared:
+            del self._in_flight[key]
@@ -0,0 +1,133 @@
+"""Compression of tunneled payloads.
+
+Each side advertises the encodings it can decode in the
+`X-Tunnel-Accept-Encoding` header of every email it sends, and
+compresses attachments only with an encoding the other side has
+advertised. Compressed attachments are marked with an
+`X-Tunnel-Encoding` header, so peers that predate compression keep
+working: they never advertise an encoding and are sent raw payloads.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ACCEPT_HEADER = 'X-Tunnel-Accept-Encoding'
+ENCODING_HEADER = 'X-Tunnel-Encoding'
+
+# Encodings in order of preference, with (compress, decompress) functions
+CODECS = {}
+# ... and factories for incremental (compress, flush) and decompress
+# functions, for payloads that are streamed rather than held in memory.
+STREAM_CODECS = {}
+
+if zstandard is not None:
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=19).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+    def _zstd_compressor():
+        compressor = zstandard.ZstdCompressor(level=19).compressobj()
+        return compressor.compress, compressor.flush
+
+    STREAM_CODECS['zstd'] = (
+        _zstd_compressor,
+        lambda: zstandard.ZstdDecompressor().decompressobj().decompress)
+
+if brotli is not None:
+    CODECS['br'] = (brotli.compress, brotli.decompress)
+
+    def _brotli_compressor():
+        compressor = brotli.Compressor()
+        return compressor.process, compressor.finish
+
+    STREAM_CODECS['br'] = (_brotli_compressor,
+                           lambda: brotli.Decompressor().process)
+
+CODECS['zlib'] = (lambda data: zlib.compress(data, 9), zlib.decompress)
+
+
+def _zlib_compressor():
+    compressor = zlib.compressobj(9)
+    return compressor.compress, compressor.flush
+
+
+STREAM_CODECS['zlib'] = (_zlib_compressor,
+                         lambda: zlib.decompressobj().decompress)
+
+
+def accept_encoding():
+    """Value of the header advertising the encodings we can decode"""
+    return ', '.join(CODECS)
+
+
+def negotiate(accepted):
+    """Our preferred encoding among those the peer `accepted`
+
+    :param accepted: Value of the peer's accept header, or None
+    :return: Encoding name, or None if there is no common encoding
+    """
+    if not accepted:
+        return None
+    offered = {name.strip().lower() for name in str(accepted).split(',')}
+    for name in CODECS:
+        if name in offered:
+            return name
+    return None
+
+
+def compress(data, encoding):
+    """Compress `data`; returns (data, encoding actually used)
+
+    Data that doesn't shrink (already compressed images, tiny requests)
+    is returned unchanged with an encoding of None.
+    """
+    if not encoding:
+        return data, None
+    compressed = CODECS[encoding][0](data)
+    if len(compressed) >= len(data):
+        return data, None
+    return compressed, encoding
+
+
+def decompress(data, encoding):
+    """Inverse of `compress`"""
+    if not encoding:
+        return data
+    try:
+        return CODECS[encoding.strip().lower()][1](data)
+    except KeyError:
+        raise ValueError('Unsupported tunnel encoding: %s' % encoding)
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of byte chunks incrementally"""
+    compress, flush = STREAM_CODECS[encoding][0]()
+    for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield flush()
+
+
+def decompress_stream(chunks, encoding):
+    """Inverse of `compress_stream`"""
+    if not encoding:
+        yield from chunks
+        return
+    try:
+        decompress = STREAM_CODECS[encoding.strip().lower()][1]()
+    except KeyError:
+        raise ValueError('Unsupported tunnel encoding: %s' % encoding)
+    for chunk in chunks:
+        decompressed = decompress(chunk)
+        if decompressed:
+            yield decompressed
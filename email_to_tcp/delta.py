@@ -0,0 +1,91 @@
+"""Binary deltas between two versions of a response body.
+
+A delta is a series of instructions that rebuild the new version from
+the old one (the base): copy a range of the base, or insert literal
+bytes. Bodies are compared as runs of tokens ending at a newline, '>',
+';' or '}', so matches are anchored on the content itself and an edit
+only disturbs the tokens around it. Any run of `ANCHOR_TOKENS` tokens
+found in the base starts a copy, which is then extended token by token.
+"""
+import itertools
+import re
+import struct
+
+
+# Consecutive tokens that must match before a copy is emitted
+ANCHOR_TOKENS = 4
+
+_TOKEN_END = re.compile(rb'(?<=[\n>;}])')
+_COPY = b'C'
+_INSERT = b'I'
+
+
+def _tokens(data):
+    return [token for token in _TOKEN_END.split(data) if token]
+
+
+def encode(base, target):
+    """Delta rebuilding `target` from `base`"""
+    base_tokens = _tokens(base)
+    offsets = list(itertools.accumulate(map(len, base_tokens), initial=0))
+    anchors = {}
+    for i in range(len(base_tokens) - ANCHOR_TOKENS + 1):
+        anchors.setdefault(tuple(base_tokens[i:i + ANCHOR_TOKENS]), i)
+
+    target_tokens = _tokens(target)
+    delta, literal = [], []
+
+    def flush_literal():
+        if literal:
+            data = b''.join(literal)
+            delta.append(_INSERT + struct.pack('>I', len(data)) + data)
+            del literal[:]
+
+    j = 0
+    while j < len(target_tokens):
+        i = anchors.get(tuple(target_tokens[j:j + ANCHOR_TOKENS]))
+        if i is None:
+            literal.append(target_tokens[j])
+            j += 1
+            continue
+        end_i, end_j = i + ANCHOR_TOKENS, j + ANCHOR_TOKENS
+        while (end_i < len(base_tokens) and end_j < len(target_tokens) and
+               base_tokens[end_i] == target_tokens[end_j]):
+            end_i += 1
+            end_j += 1
+        flush_literal()
+        delta.append(_COPY + struct.pack('>II', offsets[i],
+                                         offsets[end_i] - offsets[i]))
+        j = end_j
+    flush_literal()
+    return b''.join(delta)
+
+
+def apply(base, delta):
+    """Rebuild the target of `delta` from `base`
+
+    :raises ValueError: if the delta is corrupt or doesn't fit `base`
+    """
+    parts, position = [], 0
+    try:
+        while position < len(delta):
+            op = delta[position:position + 1]
+            if op == _COPY:
+                offset, length = struct.unpack_from('>II', delta,
+                                                    position + 1)
+                position += 9
+                if offset + length > len(base):
+                    raise ValueError('Delta copies past the end of its base')
+                parts.append(base[offset:offset + length])
+            elif op == _INSERT:
+                length, = struct.unpack_from('>I', delta, position + 1)
+                position += 5
+                if position + length > len(delta):
+                    raise ValueError('Truncated delta')
+                parts.append(delta[position:position + length])
+                position += length
+            else:
+                raise ValueError('Corrupt delta')
+    except struct.error:
+        raise ValueError('Truncated delta')
+    return b''.join(parts)
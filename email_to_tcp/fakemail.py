@@ -0,0 +1,541 @@
+"""In-process stand-ins for an SMTP and an IMAP server.
+
+`FakeMailServer` accepts mail for any address over SMTP and serves each
+address's mailbox over IMAP, with just enough of both protocols for the
+tunnel: LOGIN, SELECT, UID FETCH/SEARCH/STORE/COPY/MOVE/EXPUNGE and IDLE.
+Delivery can be delayed and made lossy, so that the tunnel can be tested
+and measured (see `email_to_tcp.benchmark`) without a real provider.
+Any user name and password are accepted, and nothing is encrypted.
+"""
+import base64
+import logging
+import random
+import re
+import select
+import socket
+import socketserver
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES = 'IMAP4rev1 IDLE UIDPLUS MOVE'
+
+
+class Folder:
+    """The messages of one IMAP folder, as [uid, flags, data], oldest
+    first"""
+
+    def __init__(self):
+        self.messages = []
+        self.uid_next = 1
+
+    def append(self, data, flags=()):
+        self.messages.append([self.uid_next, set(flags), data])
+        self.uid_next += 1
+
+    def select(self, uid_set):
+        """The messages whose UIDs are in an IMAP `uid_set` ('1,4:*')"""
+        last = self.messages[-1][0] if self.messages else 0
+        selected = []
+        for part in uid_set.split(','):
+            low, _, high = part.partition(':')
+            low = last if low == '*' else int(low)
+            high = low if not high else last if high == '*' else int(high)
+            low, high = min(low, high), max(low, high)
+            selected += [message for message in self.messages
+                         if low <= message[0] <= high and
+                         message not in selected]
+        return sorted(selected)
+
+
+def _arguments(text):
+    """Split the arguments of an IMAP command: quoted strings are
+    unquoted, parenthesized lists and bracketed sections kept whole"""
+    arguments, i = [], 0
+    while i < len(text):
+        if text[i] == ' ':
+            i += 1
+        elif text[i] == '"':
+            j, value = i + 1, []
+            while text[j] != '"':
+                if text[j] == '\\':
+                    j += 1
+                value.append(text[j])
+                j += 1
+            arguments.append(''.join(value))
+            i = j + 1
+        else:
+            j, depth = i, 0
+            while j < len(text) and (depth or text[j] != ' '):
+                depth += {'(': 1, '[': 1, ')': -1, ']': -1}.get(text[j], 0)
+                j += 1
+            arguments.append(text[i:j])
+            i = j
+    return arguments
+
+
+def _header_fields(data, names):
+    """The header lines of `data` named in `names`, and a blank line"""
+    head = re.split(rb'\r?\n\r?\n', data, 1)[0]
+    names = {name.lower() for name in names}
+    lines, keep = [], False
+    for line in re.split(rb'\r?\n', head):
+        if line[:1] not in (b' ', b'\t'):
+            name = line.split(b':', 1)[0].strip().decode('ascii', 'replace')
+            keep = name.lower() in names
+        if keep:
+            lines.append(line + b'\r\n')
+    return b''.join(lines) + b'\r\n'
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, mail):
+        self.mail = mail
+        self.clients = set()
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        # Responses go out in several writes; don't let Nagle's algorithm
+        # hold them back for the client's delayed ACKs
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        self.clients.discard(request)
+        super().shutdown_request(request)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, code, text):
+        self.wfile.write(('%d %s\r\n' % (code, text)).encode('ascii'))
+
+    def handle(self):
+        self.reply(220, 'fakemail ESMTP ready')
+        recipients = []
+        # BDAT chunks received so far
+        chunks = []
+        for line in self.rfile:
+            command, _, argument = str(line, 'ascii', 'replace').strip() \
+                .partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.wfile.write(b'250-fakemail\r\n250-8BITMIME\r\n'
+                                 b'250-PIPELINING\r\n250-CHUNKING\r\n'
+                                 b'250 AUTH PLAIN LOGIN\r\n')
+            elif command in ('HELO', 'NOOP'):
+                self.reply(250, 'OK')
+            elif command == 'AUTH':
+                self.authenticate(argument.split())
+            elif command == 'MAIL':
+                recipients, chunks = [], []
+                self.reply(250, 'OK')
+            elif command == 'RCPT':
+                match = re.search(r'<([^>]*)>', argument)
+                recipients.append(match.group(1) if match else argument)
+                self.reply(250, 'OK')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply(503, 'No recipients')
+                    continue
+                self.reply(354, 'End data with <CR><LF>.<CR><LF>')
+                self.server.mail.deliver(recipients, self.read_data())
+                recipients = []
+                self.reply(250, 'OK: queued')
+            elif command == 'BDAT':
+                size, _, last = argument.partition(' ')
+                # The chunk is read even when it is refused
+                chunks.append(self.rfile.read(int(size)))
+                if not recipients:
+                    self.reply(503, 'No recipients')
+                elif last.strip().upper() == 'LAST':
+                    self.server.mail.deliver(recipients, b''.join(chunks))
+                    recipients, chunks = [], []
+                    self.reply(250, 'OK: queued')
+                else:
+                    self.reply(250, '%s octets received' % size)
+            elif command == 'RSET':
+                recipients, chunks = [], []
+                self.reply(250, 'OK')
+            elif command == 'QUIT':
+                self.reply(221, 'Bye')
+                return
+            else:
+                self.reply(502, 'Command not implemented')
+
+    def authenticate(self, argument):
+        """Accept any credentials, with AUTH PLAIN or LOGIN"""
+        mechanism = argument[0].upper() if argument else ''
+        if mechanism == 'PLAIN':
+            if len(argument) < 2:
+                self.reply(334, '')
+                self.rfile.readline()
+        elif mechanism == 'LOGIN':
+            for prompt in ('Username:', 'Password:'):
+                if prompt == 'Username:' and len(argument) > 1:
+                    continue
+                self.reply(334, str(base64.b64encode(prompt.encode()),
+                                    'ascii'))
+                self.rfile.readline()
+        else:
+            self.reply(504, 'Unrecognized authentication type')
+            return
+        self.reply(235, 'Authentication successful')
+
+    def read_data(self):
+        lines = []
+        for line in self.rfile:
+            if line in (b'.\r\n', b'.\n'):
+                break
+            lines.append(line[1:] if line.startswith(b'.') else line)
+        return b''.join(lines)
+
+
+class _IMAPHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.mail = self.server.mail
+        self.buffer = b''
+        self.user = None
+        self.folder = None
+        # UIDs below this have been announced with EXISTS
+        self.announced = 1
+
+    def readline(self):
+        while b'\n' not in self.buffer:
+            data = self.request.recv(2 ** 16)
+            if not data:
+                return None
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return str(line.rstrip(b'\r'), 'utf-8', 'replace')
+
+    def send(self, *parts):
+        self.request.sendall(b''.join(
+            part if isinstance(part, bytes) else part.encode('utf-8')
+            for part in parts))
+
+    def handle(self):
+        self.send('* OK [CAPABILITY %s] fakemail ready\r\n' % CAPABILITIES)
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            tag, _, line = line.partition(' ')
+            command, _, line = line.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, line = line.partition(' ')
+                command = 'UID_' + command.upper()
+            method = getattr(self, 'do_' + command, None)
+            if method is None:
+                self.send('%s BAD Unknown command\r\n' % tag)
+                continue
+            if self.folder is None and command not in (
+                    'CAPABILITY', 'NOOP', 'LOGIN', 'SELECT', 'EXAMINE',
+                    'LOGOUT'):
+                self.send('%s BAD No mailbox selected\r\n' % tag)
+                continue
+            try:
+                with self.mail.lock:
+                    result = method(_arguments(line))
+            except (ValueError, IndexError) as err:
+                result = 'BAD', str(err) or 'Invalid arguments'
+            if result is None:
+                return
+            status, text = result
+            if status == 'IDLE':
+                status, text = self.idle()
+                if status is None:
+                    return
+            if self.folder is not None and status == 'OK':
+                with self.mail.lock:
+                    self.announce()
+            self.send('%s %s %s\r\n' % (tag, status, text))
+
+    def announce(self):
+        """Tell the client about the messages that arrived since the last
+        command"""
+        if self.folder.uid_next > self.announced:
+            self.announced = self.folder.uid_next
+            self.send('* %d EXISTS\r\n' % len(self.folder.messages))
+
+    def idle(self):
+        self.send('+ idling\r\n')
+        wakeup, notify = socket.socketpair()
+        notify.setblocking(False)
+        self.mail.listeners.add(notify)
+        try:
+            while b'\n' not in self.buffer:
+                with self.mail.lock:
+                    self.announce()
+                readable, _, _ = select.select([self.request, wakeup],
+                                               [], [])
+                if wakeup in readable:
+                    wakeup.recv(64)
+                if self.request in readable:
+                    data = self.request.recv(2 ** 16)
+                    if not data:
+                        return None, None
+                    self.buffer += data
+        finally:
+            self.mail.listeners.discard(notify)
+            notify.close()
+            wakeup.close()
+        self.readline()  # DONE
+        return 'OK', 'IDLE terminated'
+
+    def do_CAPABILITY(self, arguments):
+        self.send('* CAPABILITY %s\r\n' % CAPABILITIES)
+        return 'OK', 'CAPABILITY completed'
+
+    def do_NOOP(self, arguments):
+        return 'OK', 'NOOP completed'
+
+    def do_LOGOUT(self, arguments):
+        self.send('* BYE fakemail logging out\r\n')
+        return 'OK', 'LOGOUT completed'
+
+    def do_LOGIN(self, arguments):
+        self.user = arguments[0].lower()
+        return 'OK', 'LOGIN completed'
+
+    def do_SELECT(self, arguments):
+        if self.user is None:
+            return 'NO', 'Not logged in'
+        self.folder = self.mail.folder(self.user, arguments[0])
+        self.announced = self.folder.uid_next
+        self.send('* %d EXISTS\r\n* 0 RECENT\r\n'
+                  '* FLAGS (\\Seen \\Deleted)\r\n'
+                  '* OK [UIDVALIDITY 1] UIDs valid\r\n'
+                  '* OK [UIDNEXT %d] Predicted next UID\r\n'
+                  % (len(self.folder.messages), self.folder.uid_next))
+        return 'OK', '[READ-WRITE] SELECT completed'
+
+    do_EXAMINE = do_SELECT
+
+    def do_IDLE(self, arguments):
+        return 'IDLE', None
+
+    def do_UID_FETCH(self, arguments):
+        uid_set, items = arguments[0], arguments[1]
+        items = _arguments(items[1:-1] if items.startswith('(') else items)
+        for message in self.folder.select(uid_set):
+            uid, flags, data = message
+            parts = ['UID %d' % uid]
+            literals = []
+            for item in items:
+                name = item.upper()
+                if name == 'UID':
+                    continue
+                if name == 'FLAGS':
+                    parts.append('FLAGS (%s)' % ' '.join(sorted(flags)))
+                    continue
+                section = re.match(r'(BODY(?:\.PEEK)?)\[(.*)\]$', name)
+                if name in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+                    literal = data
+                elif name == 'RFC822.HEADER' or section and \
+                        section.group(2) == 'HEADER':
+                    literal = re.split(rb'\r?\n\r?\n', data, 1)[0] + \
+                        b'\r\n\r\n'
+                elif section and section.group(2).startswith(
+                        'HEADER.FIELDS '):
+                    literal = _header_fields(
+                        data, _arguments(item[item.index('(') + 1:
+                                              item.index(')')]))
+                else:
+                    return 'BAD', 'Unsupported FETCH item %s' % item
+                if name in ('RFC822', 'BODY[]') or \
+                        section and section.group(1) == 'BODY':
+                    flags.add('\\Seen')
+                if name.startswith('BODY.PEEK'):
+                    name = 'BODY' + item[len('BODY.PEEK'):]
+                literals.append((name, literal))
+            seq = self.folder.messages.index(message) + 1
+            self.send('* %d FETCH (%s' % (seq, ' '.join(parts)))
+            for name, literal in literals:
+                self.send(' %s {%d}\r\n' % (name, len(literal)), literal)
+            self.send(')\r\n')
+        return 'OK', 'UID FETCH completed'
+
+    def do_UID_SEARCH(self, arguments):
+        criteria = []
+        for argument in arguments:
+            if argument.startswith('('):
+                criteria += _arguments(argument[1:-1])
+            else:
+                criteria.append(argument)
+        matches = []
+        for uid, flags, data in self.folder.messages:
+            keys, ok = list(criteria), True
+            while keys and ok:
+                key = keys.pop(0).upper()
+                if key == 'UNSEEN':
+                    ok = '\\Seen' not in flags
+                elif key == 'SEEN':
+                    ok = '\\Seen' in flags
+                elif key in ('SUBJECT', 'FROM'):
+                    ok = keys.pop(0).lower().encode() in \
+                        _header_fields(data, [key]).lower()
+                elif key != 'ALL':
+                    return 'BAD', 'Unsupported SEARCH key %s' % key
+            if ok:
+                matches.append(str(uid))
+        self.send('* SEARCH%s\r\n' % ''.join(' ' + uid for uid in matches))
+        return 'OK', 'UID SEARCH completed'
+
+    def do_UID_STORE(self, arguments):
+        uid_set, action, flags = arguments[0], arguments[1].upper(), \
+            set(_arguments(arguments[2].strip('()')))
+        for message in self.folder.select(uid_set):
+            if action.startswith('+'):
+                message[1] |= flags
+            elif action.startswith('-'):
+                message[1] -= flags
+            else:
+                message[1] = set(flags)
+            if not action.endswith('.SILENT'):
+                self.send('* %d FETCH (UID %d FLAGS (%s))\r\n' % (
+                    self.folder.messages.index(message) + 1, message[0],
+                    ' '.join(sorted(message[1]))))
+        return 'OK', 'UID STORE completed'
+
+    def do_UID_COPY(self, arguments):
+        target = self.mail.folder(self.user, arguments[1])
+        for _, flags, data in self.folder.select(arguments[0]):
+            target.append(data, flags)
+        self.mail.wake()
+        return 'OK', 'UID COPY completed'
+
+    def do_UID_MOVE(self, arguments):
+        self.do_UID_COPY(arguments)
+        self.expunge(self.folder.select(arguments[0]))
+        return 'OK', 'UID MOVE completed'
+
+    def do_UID_EXPUNGE(self, arguments):
+        self.expunge([message for message in self.folder.select(arguments[0])
+                      if '\\Deleted' in message[1]])
+        return 'OK', 'UID EXPUNGE completed'
+
+    def do_EXPUNGE(self, arguments):
+        self.expunge([message for message in self.folder.messages
+                      if '\\Deleted' in message[1]])
+        return 'OK', 'EXPUNGE completed'
+
+    def expunge(self, messages):
+        # Highest sequence numbers first, so the others stay valid
+        for seq in range(len(self.folder.messages), 0, -1):
+            if self.folder.messages[seq - 1] in messages:
+                del self.folder.messages[seq - 1]
+                self.send('* %d EXPUNGE\r\n' % seq)
+
+
+class FakeMailServer:
+    """An SMTP and an IMAP server on ephemeral ports of `host`
+
+    :param delay: Seconds between accepting an email and delivering it
+    :param loss: Fraction of emails that are silently dropped
+    :param seed: Seed of the random numbers that pick the lost emails
+    """
+
+    def __init__(self, host='127.0.0.1', delay=0, loss=0, seed=None):
+        self.host = host
+        self.delay = delay
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        # address: {folder name: Folder}
+        self.mailboxes = {}
+        # Sockets to write to when mail arrives; see _IMAPHandler.idle
+        self.listeners = set()
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.lost = 0
+        self.smtp_server = self.imap_server = None
+
+    @property
+    def smtp_port(self):
+        return self.smtp_server.server_address[1]
+
+    @property
+    def imap_port(self):
+        return self.imap_server.server_address[1]
+
+    def start(self):
+        self.smtp_server = _Server((self.host, 0), _SMTPHandler, self)
+        self.imap_server = _Server((self.host, 0), _IMAPHandler, self)
+        for server in (self.smtp_server, self.imap_server):
+            threading.Thread(target=server.serve_forever, daemon=True,
+                             name='fakemail').start()
+        logger.debug("Fake mail server on SMTP port %d, IMAP port %d",
+                     self.smtp_port, self.imap_port)
+        return self
+
+    def stop(self):
+        """Stop serving and drop every open session"""
+        for server in (self.smtp_server, self.imap_server):
+            server.shutdown()
+            server.server_close()
+            for client in list(server.clients):
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def configure(self, s, address):
+        """Point the settings `s` at this server, as the account
+        `address`"""
+        s.SMTP_SERVER = s.IMAP_SERVER = self.host
+        s.SMTP_PORT, s.IMAP_PORT = self.smtp_port, self.imap_port
+        s.SMTP_USE_SSL = s.IMAP_USE_SSL = False
+        s.SMTP_USER = s.IMAP_USER = s.FROM_EMAIL = address
+        s.SMTP_PASSWORD = s.IMAP_PASSWORD = 'password'
+        return s
+
+    def folder(self, address, name):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        with self.lock:
+            return self.mailboxes.setdefault(address.lower(), {}) \
+                .setdefault(name, Folder())
+
+    def deliver(self, recipients, data):
+        """Put an email into the Inbox of each recipient, after `delay`
+        seconds unless it is lost"""
+        if self.random.random() < self.loss:
+            self.lost += 1
+            logger.debug("Lost an email to %s", ', '.join(recipients))
+            return
+        if self.delay:
+            timer = threading.Timer(self.delay, self._store,
+                                    (recipients, data))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._store(recipients, data)
+
+    def _store(self, recipients, data):
+        with self.lock:
+            for recipient in recipients:
+                self.folder(recipient, 'INBOX').append(data)
+            self.delivered += 1
+            self.delivered_bytes += len(data)
+        self.wake()
+
+    def wake(self):
+        for listener in list(self.listeners):
+            try:
+                listener.send(b'!')
+            except OSError:
+                pass
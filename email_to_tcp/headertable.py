@@ -0,0 +1,508 @@
+"""Compact encoding of the heads of tunneled HTTP messages.
+
+Browsers send the same User-Agent, Accept and Cookie lines with every
+request, and servers the same headers with every response. In the
+spirit of HPACK (RFC 7541), each side replaces the header lines it has
+sent before with indexes into a table: a static table of common lines,
+and a dynamic table of the lines each side has sent the other.
+
+Emails get lost and arrive out of order, so unlike HPACK, a dynamic
+entry is only referred to once the other side has confirmed holding it:
+
+  - Every email carries the sender's `TABLE_HEADER`, a random id of the
+    running process (its epoch), which tells the other side that it can
+    decode packed heads, and whose table they are packed against.
+  - The first time a line is packed, it is sent in full along with the
+    id of its new entry. Until the other side acknowledges that id, in
+    the `ACK_HEADER` of an email it sends back, the line keeps being
+    sent in full (with the same id), so a lost email or acknowledgement
+    only costs a few bytes.
+  - The receiving side keeps the MAX_ENTRIES latest entries it has
+    seen, but the sending side only refers to its REFERENCED_ENTRIES
+    latest ones, and sends older lines again as new entries. An email
+    can thus be overtaken by others adding up to MAX_ENTRIES -
+    REFERENCED_ENTRIES entries and still be unpacked; one held up for
+    longer than that fails to unpack, and its message is lost.
+
+A restarted peer has a new epoch, and is packed for from scratch.
+Packed heads start with a NUL byte, which no HTTP message can, and are
+followed by the message body as it is.
+"""
+import collections
+import logging
+import threading
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# Epoch of the sending process, on every email
+TABLE_HEADER = 'X-Tunnel-Header-Table'
+# "<epoch of the recipient> <ids of its entries received>", e.g. "ab12 1-5,9"
+ACK_HEADER = 'X-Tunnel-Header-Ack'
+
+MAGIC = b'\x00'
+# Dynamic entries kept by the receiving side, for each peer
+MAX_ENTRIES = 256
+# Latest entries the sending side refers to; the rest of the receiving
+# side's window is slack for emails that arrive late
+REFERENCED_ENTRIES = MAX_ENTRIES // 2
+# Longer lines are sent in full every time
+MAX_ENTRY_BYTES = 4096
+# Heads are only packed up to this size
+MAX_HEAD_BYTES = 2 ** 16
+# Peers whose tables are kept
+MAX_PEERS = 16
+
+# Lines whose values seldom repeat, which would only push useful entries
+# out of the table (or, for credentials, shouldn't be kept at all)
+NOT_INDEXED = {
+    b'age', b'authorization', b'content-length', b'content-range',
+    b'date', b'etag', b'expires', b'if-modified-since', b'if-none-match',
+    b'last-modified', b'proxy-authorization', b'range', b'set-cookie',
+    b'x-tunnel-have', b'x-tunnel-delta', b'x-tunnel-transcoded',
+}
+
+# (name, value) pairs, with a value of None for names alone. Never
+# reorder or remove entries: peers refer to them by position.
+STATIC_TABLE = [(name.encode('iso-8859-1'),
+                 value if value is None else value.encode('iso-8859-1'))
+                for name, value in [
+    # Requests
+    ('Host', None),
+    ('User-Agent', None),
+    ('Accept', '*/*'),
+    ('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+               '*/*;q=0.8'),
+    ('Accept', 'text/css,*/*;q=0.1'),
+    ('Accept', 'image/avif,image/webp,*/*'),
+    ('Accept', 'image/avif,image/webp,image/apng,image/svg+xml,image/*,'
+               '*/*;q=0.8'),
+    ('Accept', None),
+    ('Accept-Language', 'en-US,en;q=0.5'),
+    ('Accept-Language', 'en-US,en;q=0.9'),
+    ('Accept-Language', None),
+    ('Accept-Encoding', 'gzip, deflate, br'),
+    ('Accept-Encoding', 'gzip, deflate, br, zstd'),
+    ('Accept-Encoding', 'gzip, deflate'),
+    ('Accept-Encoding', None),
+    ('Connection', 'keep-alive'),
+    ('Connection', 'close'),
+    ('Proxy-Connection', 'keep-alive'),
+    ('Referer', None),
+    ('Cookie', None),
+    ('Origin', None),
+    ('Upgrade-Insecure-Requests', '1'),
+    ('DNT', '1'),
+    ('Sec-GPC', '1'),
+    ('Pragma', 'no-cache'),
+    ('Cache-Control', 'no-cache'),
+    ('Cache-Control', 'max-age=0'),
+    ('Sec-Fetch-Dest', 'document'),
+    ('Sec-Fetch-Dest', 'script'),
+    ('Sec-Fetch-Dest', 'style'),
+    ('Sec-Fetch-Dest', 'image'),
+    ('Sec-Fetch-Dest', 'font'),
+    ('Sec-Fetch-Dest', 'empty'),
+    ('Sec-Fetch-Mode', 'navigate'),
+    ('Sec-Fetch-Mode', 'no-cors'),
+    ('Sec-Fetch-Mode', 'cors'),
+    ('Sec-Fetch-Site', 'none'),
+    ('Sec-Fetch-Site', 'same-origin'),
+    ('Sec-Fetch-Site', 'same-site'),
+    ('Sec-Fetch-Site', 'cross-site'),
+    ('Sec-Fetch-User', '?1'),
+    ('Priority', 'u=0, i'),
+    ('Priority', 'u=1'),
+    ('Priority', 'u=2'),
+    ('Priority', 'u=4'),
+    ('Priority', 'u=5, i'),
+    ('Priority', None),
+    ('If-None-Match', None),
+    ('If-Modified-Since', None),
+    ('Range', None),
+    ('Authorization', None),
+    ('Content-Type', 'application/x-www-form-urlencoded'),
+    ('X-Requested-With', 'XMLHttpRequest'),
+    ('X-Tunnel-Have', None),
+    # Responses
+    ('Date', None),
+    ('Server', None),
+    ('Content-Type', 'text/html; charset=utf-8'),
+    ('Content-Type', 'text/html; charset=UTF-8'),
+    ('Content-Type', 'text/html'),
+    ('Content-Type', 'text/css'),
+    ('Content-Type', 'text/css; charset=utf-8'),
+    ('Content-Type', 'application/javascript'),
+    ('Content-Type', 'text/javascript'),
+    ('Content-Type', 'application/json'),
+    ('Content-Type', 'application/json; charset=utf-8'),
+    ('Content-Type', 'image/png'),
+    ('Content-Type', 'image/jpeg'),
+    ('Content-Type', 'image/gif'),
+    ('Content-Type', 'image/webp'),
+    ('Content-Type', 'image/svg+xml'),
+    ('Content-Type', 'font/woff2'),
+    ('Content-Type', None),
+    ('Content-Length', None),
+    ('Cache-Control', 'private'),
+    ('Cache-Control', 'no-store'),
+    ('Cache-Control', 'public, max-age=31536000'),
+    ('Cache-Control', 'public, max-age=31536000, immutable'),
+    ('Cache-Control', None),
+    ('Expires', None),
+    ('Last-Modified', None),
+    ('ETag', None),
+    ('Age', None),
+    ('Vary', 'Accept-Encoding'),
+    ('Vary', 'Origin'),
+    ('Vary', None),
+    ('Accept-Ranges', 'bytes'),
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Origin', None),
+    ('Set-Cookie', None),
+    ('Location', None),
+    ('Content-Range', None),
+    ('Content-Security-Policy', None),
+    ('Strict-Transport-Security', 'max-age=31536000'),
+    ('Strict-Transport-Security', 'max-age=31536000; includeSubDomains'),
+    ('Strict-Transport-Security', None),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'SAMEORIGIN'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '0'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+    ('Referrer-Policy', None),
+    ('Alt-Svc', None),
+    ('Via', None),
+    ('X-Cache', None),
+    ('X-Tunnel-Delta', None),
+    ('X-Tunnel-Transcoded', None),
+]]
+
+# Indexes are 1-based: 0 marks the end of the head, or a name sent in full
+_STATIC_INDEX = {pair: index for index, pair in
+                 enumerate(STATIC_TABLE, 1) if pair[1] is not None}
+_STATIC_NAMES = {}
+for _index, (_name, _) in enumerate(STATIC_TABLE, 1):
+    _STATIC_NAMES.setdefault(_name, _index)
+
+# Kinds of fields, in the low bits of their first number
+_INDEXED, _LITERAL, _INSERTED = range(3)
+
+
+def _number(n):
+    """Unsigned LEB128 encoding of `n`"""
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7f, n >> 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _string(data):
+    return _number(len(data)) + data
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def number(self):
+        n = shift = 0
+        while True:
+            try:
+                byte = self.data[self.position]
+            except IndexError:
+                raise ValueError('Truncated packed head')
+            self.position += 1
+            n |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return n
+            shift += 7
+
+    def string(self):
+        length = self.number()
+        if self.position + length > len(self.data):
+            raise ValueError('Truncated packed head')
+        data = self.data[self.position:self.position + length]
+        self.position += length
+        return data
+
+
+def _split_lines(head):
+    """(start line, [(name, value)]) of a head ending with a blank line,
+    or None if packing it wouldn't give back the same bytes"""
+    lines = head[:-4].split(b'\r\n')
+    fields = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(b': ')
+        if not sep or not name or name[:1] in b' \t':
+            return None
+        fields.append((name, value))
+    return lines[0], fields
+
+
+def format_ids(ids):
+    """"1-3,7" for [1, 2, 3, 7]"""
+    ranges = []
+    for n in sorted(ids):
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b)
+                    for a, b in ranges)
+
+
+def parse_ids(text):
+    """Inverse of `format_ids`"""
+    ids = set()
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        first, _, last = part.partition('-')
+        ids.update(range(int(first), int(last or first) + 1))
+    return ids
+
+
+class Encoder:
+    """Packs the heads sent to one peer"""
+
+    def __init__(self):
+        # id: (name, value), oldest first
+        self._entries = collections.OrderedDict()
+        self._ids = {}
+        self._acknowledged = set()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def acknowledge(self, ids):
+        """The peer holds the entries `ids`"""
+        with self._lock:
+            self._acknowledged.update(
+                id_ for id_ in ids if id_ in self._entries)
+
+    def encode(self, head):
+        """Packed form of a head, or None if it can't be packed"""
+        lines = _split_lines(head)
+        if lines is None:
+            return None
+        start_line, fields = lines
+        out = [_string(start_line)]
+        with self._lock:
+            for name, value in fields:
+                out.append(self._field(name, value))
+        out.append(_number(0))
+        return b''.join(out)
+
+    def _field(self, name, value):
+        pair = (name, value)
+        index = _STATIC_INDEX.get(pair)
+        if index is not None:
+            return _number(index << 2 | _INDEXED)
+        id_ = self._ids.get(pair)
+        if id_ in self._acknowledged:
+            return _number((len(STATIC_TABLE) + id_) << 2 | _INDEXED)
+
+        name_index = _STATIC_NAMES.get(name, 0)
+        literal = (b'' if name_index else _string(name)) + _string(value)
+        if (name.lower() in NOT_INDEXED or
+                len(name) + len(value) > MAX_ENTRY_BYTES):
+            return _number(name_index << 2 | _LITERAL) + literal
+        if id_ is None:
+            id_ = self._add(pair)
+        return _number(name_index << 2 | _INSERTED) + literal + _number(id_)
+
+    def _add(self, pair):
+        id_ = self._next_id
+        self._next_id += 1
+        self._entries[id_] = pair
+        self._ids[pair] = id_
+        if len(self._entries) > REFERENCED_ENTRIES:
+            old_id, old_pair = self._entries.popitem(last=False)
+            del self._ids[old_pair]
+            self._acknowledged.discard(old_id)
+        return id_
+
+
+class Decoder:
+    """Unpacks the heads received from one peer"""
+
+    def __init__(self):
+        self._entries = {}
+        self._latest = 0
+        # Entries received since the last acknowledgement
+        self._received = set()
+        self._lock = threading.Lock()
+
+    def acknowledgements(self, limit=64):
+        """Ids of (up to `limit` of) the entries received since the last
+        call"""
+        with self._lock:
+            ids = sorted(self._received)[:limit]
+            self._received.difference_update(ids)
+        return ids
+
+    def decode(self, packed):
+        """Inverse of `Encoder.encode`; raises ValueError"""
+        reader = _Reader(packed)
+        lines = [reader.string()]
+        with self._lock:
+            while True:
+                number = reader.number()
+                if not number:
+                    break
+                lines.append(b': '.join(self._field(reader, number)))
+        if reader.position != len(packed):
+            raise ValueError('Trailing bytes after packed head')
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def _field(self, reader, number):
+        index, kind = number >> 2, number & 3
+        if kind == _INDEXED:
+            return self._entry(index)
+        if kind not in (_LITERAL, _INSERTED):
+            raise ValueError('Unknown kind of packed header %d' % kind)
+        name = self._entry(index)[0] if index else reader.string()
+        value = reader.string()
+        if kind == _INSERTED:
+            self._add(reader.number(), (name, value))
+        return name, value
+
+    def _entry(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        try:
+            return self._entries[index - len(STATIC_TABLE)]
+        except KeyError:
+            raise ValueError('Unknown header table entry %d' % index)
+
+    def _add(self, id_, pair):
+        if id_ <= self._latest - MAX_ENTRIES:
+            # The peer has already dropped it
+            return
+        self._entries[id_] = pair
+        self._received.add(id_)
+        self._latest = max(self._latest, id_)
+        if len(self._entries) > MAX_ENTRIES:
+            for old_id in [old_id for old_id in self._entries
+                           if old_id <= self._latest - MAX_ENTRIES]:
+                del self._entries[old_id]
+
+
+class Peer:
+    """The tables shared with one peer process"""
+
+    def __init__(self, tables, epoch):
+        self.tables = tables
+        self.epoch = epoch
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+
+    def email_headers(self):
+        """Headers for an email to this peer"""
+        return self.tables.email_headers(self)
+
+    def pack(self, data):
+        """Pack the head of a raw HTTP message"""
+        end = data.find(b'\r\n\r\n', 0, MAX_HEAD_BYTES)
+        if end == -1:
+            return data
+        packed = self.encoder.encode(data[:end + 4])
+        if packed is None:
+            return data
+        return MAGIC + _number(len(packed)) + packed + data[end + 4:]
+
+    def pack_stream(self, chunks):
+        """Pack the head of a raw HTTP message streamed in chunks (or
+        held in bytes)"""
+        if isinstance(chunks, (bytes, bytearray)):
+            chunks = [chunks]
+        chunks = iter(chunks)
+        data = b''
+        for chunk in chunks:
+            data += chunk
+            if b'\r\n\r\n' in data or len(data) > MAX_HEAD_BYTES:
+                break
+        yield self.pack(data)
+        yield from chunks
+
+    def unpack(self, data):
+        """Inverse of `pack`; raises ValueError"""
+        if not data.startswith(MAGIC):
+            return data
+        reader = _Reader(data)
+        reader.position = len(MAGIC)
+        length = reader.number()
+        end = reader.position + length
+        if end > len(data):
+            raise ValueError('Truncated packed head')
+        return (self.decoder.decode(data[reader.position:end]) +
+                data[end:])
+
+    def unpack_stream(self, chunks):
+        """Inverse of `pack_stream`"""
+        chunks = iter(chunks)
+        data = b''
+        for chunk in chunks:
+            data += chunk
+            if not data.startswith(MAGIC[:len(data)]):
+                break
+            try:
+                reader = _Reader(data)
+                reader.position = len(MAGIC)
+                length = reader.number()
+                if reader.position + length <= len(data):
+                    break
+            except ValueError:
+                pass  # The length is still incomplete
+        if data:
+            yield self.unpack(data)
+        yield from chunks
+
+
+class HeaderTables:
+    """This process's tables for each of its peers"""
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self._peers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def peer(self, headers):
+        """The sender of an email with `headers`, if it can unpack heads
+
+        Acknowledgements in the email are taken into account.
+        """
+        epoch = str(headers.get(TABLE_HEADER) or '').strip()
+        if not epoch:
+            return None
+        with self._lock:
+            peer = self._peers.get(epoch)
+            if peer is None:
+                peer = self._peers[epoch] = Peer(self, epoch)
+                if len(self._peers) > MAX_PEERS:
+                    self._peers.popitem(last=False)
+            self._peers.move_to_end(epoch)
+        ack = str(headers.get(ACK_HEADER) or '').split()
+        if len(ack) == 2 and ack[0] == self.epoch:
+            try:
+                peer.encoder.acknowledge(parse_ids(ack[1]))
+            except ValueError:
+                logger.debug("Invalid header table acknowledgement %s", ack)
+        return peer
+
+    def email_headers(self, peer=None):
+        """Headers for an email to `peer` (or to a peer not heard from)"""
+        headers = {TABLE_HEADER: self.epoch}
+        if peer is not None:
+            ids = peer.decoder.acknowledgements()
+            if ids:
+                headers[ACK_HEADER] = '%s %s' % (peer.epoch, format_ids(ids))
+        return headers
@@ -1,11 +1,15 @@
+import asyncio
+import functools
 from getpass import getpass
 import imaplib
 import logging
 import smtplib
 import socketserver
-from io import BytesIO
+import sys
+import threading
+import uuid
 
-from email_to_tcp import utils
+from email_to_tcp import cache, coalesce, headertable, metrics, sessions, utils
 
 
 logger = logging.getLogger(
@@ -16,43 +20,344 @@ settings = utils.proxy_settings
 
 class TCPProxyHandler(socketserver.BaseRequestHandler):
     chunk_size = 4096
-    email_connection = None  # Lazy evaluation necessary here
+    accounts = None  # Lazy evaluation necessary here
+    batcher = None
+    cache = None
+    coalescer = None
+    settings = settings
 
     def handle(self):
         """Handle the request"""
-        if TCPProxyHandler.email_connection is None:
+        if self.batcher is None:
             raise AttributeError(
                 "You must call TCPProxyHandler.connect(settings) "
                 "before starting the server.")
 
         logger.debug("%s connected", self.client_address[0])
         data = b''
-        while True:
-            try:
-                new_data = self.request.recv(self.chunk_size)
-            except BlockingIOError:
-                break
-            data += new_data
-            if not new_data or new_data.endswith(b'\r\n\r\n'):
-                break
+        with metrics.timed('client_read'):
+            while True:
+                try:
+                    new_data = self.request.recv(self.chunk_size)
+                except BlockingIOError:
+                    break
+                data += new_data
+                if not new_data or new_data.endswith(b'\r\n\r\n'):
+                    break
 
+        logger.debug("%s", data.split(b'\r\n', 1)[0])
+        if data.startswith(b'CONNECT '):
+            if self.server.start_session():
+                self.open_session(data)
+            else:
+                logger.warning("Refusing session: %s are open",
+                               self.settings.MAX_SESSIONS)
+                self.request.sendall(
+                    utils.error_response(503, 'Service Unavailable'))
+            return
+        if self.cache is not None:
+            response = self.cache.respond(data, self.tunnel)
+        else:
+            response = self.tunnel(data)
+        # Includes waiting for the rest of responses that span emails
+        with metrics.timed('client_write'):
+            for chunk in response:
+                self.request.sendall(chunk)
 
-        logger.debug("%s", data)
-        subject = self.email_connection.send(data)
+    def tunnel(self, data):
+        """Send a raw request through email, or share the response to an
+        identical one in flight; returns the response chunks"""
+        if self.coalescer is not None:
+            return self.coalescer.fetch(data, self.send)
+        return self.send(data)
 
-        response = self.email_connection.fetch(subject='Re: ' + subject)
-        logger.debug("Received response\n%s", response)
-        raw_data = BytesIO(utils.unpack(response))
+    def send(self, data):
+        """Send a raw request through email; returns the response chunks"""
+        response = self.batcher.submit(data, self.client_address[0]).result()
+        logger.debug("Received response")
+        return response
 
-        while True:
-            chunk = raw_data.read(self.chunk_size)
-            if not chunk:
-                break
-            self.request.sendall(chunk)
+    def open_session(self, data):
+        """Relay a CONNECT request's connection as a tunneled session"""
+        target = str(data.split()[1], 'iso-8859-1')
+        subject = utils.generate_subject()
+        # A session's frames all go through one account
+        account = self.accounts.choose()
+
+        def send(frames):
+            with account.pool.connection() as email_connection:
+                email_connection.send_many(
+                    frames, subject, self.batcher.encoding,
+                    headers={utils.CORRELATION_HEADER: session.id})
+
+        session = sessions.Session(uuid.uuid4().hex, send,
+                                   self.settings.SESSION_WINDOW,
+                                   self.settings.MAX_EMAIL_BYTES)
+
+        def on_reply(raw):
+            try:
+                _, attachments = utils.split_message(raw)
+            except Exception as err:
+                session.fail(err)
+                return
+            for attachment in attachments:
+                frame = sessions.Frame.from_headers(attachment.headers, b'')
+                if frame is not None and frame.session == session.id:
+                    frame.data = attachment.decode()
+                    session.receive(frame)
+
+        logger.info("Opening session %s to %s", session.id, target)
+        account.begin(session.id)
+        account.watcher.watch(session.id, on_reply, session.fail)
+        try:
+            self.request.sendall(
+                b'HTTP/1.1 200 Connection Established\r\n\r\n')
+            session.run(self.request, {sessions.CONNECT_HEADER: target})
+        finally:
+            account.end(session.id)
+        logger.info("Closed session %s", session.id)
 
     @classmethod
     def connect(cls, s):
-        cls.email_connection = utils.EmailConnection(s)
+        cls.settings = s
+        metrics.start(s)
+        accounts = []
+        for account_settings in utils.account_settings(s):
+            pool = utils.EmailConnectionPool(
+                account_settings, s.MAX_IN_FLIGHT, imap=False)
+            pool.warm(max(1, s.SPARE_CONNECTIONS))
+            pool.start_keepalive()
+            watcher = utils.ReplyWatcher(account_settings)
+            watcher.start()
+            accounts.append(utils.Account(
+                pool, watcher, account_settings.ACCOUNT_WEIGHT))
+        cls.accounts = utils.AccountSet(accounts, s.ACCOUNT_POLICY,
+                                        s.ACCOUNT_COOLDOWN)
+        cls.batcher = utils.RequestBatcher(
+            cls.accounts, s.BATCH_WINDOW, s.BATCH_MAX_BYTES)
+        if s.HEADER_TABLE:
+            cls.batcher.header_tables = headertable.HeaderTables()
+        cls.batcher.start()
+        if s.COALESCE:
+            cls.coalescer = coalesce.Coalescer(s.COALESCE_MAX_BYTES)
+        if s.CACHE_MEMORY_BYTES or (s.CACHE_DIR and s.CACHE_DISK_BYTES):
+            cls.cache = cache.ResponseCache(s)
+            cls.batcher.on_push = cls.cache.push
+
+
+class ThreadedTCPProxyServer(socketserver.ThreadingMixIn,
+                             socketserver.TCPServer):
+    """Serve each client on its own thread.
+
+    At most `max_in_flight` requests are handled at once; further
+    clients wait in the listen backlog until a slot frees up. CONNECT
+    sessions, which last as long as their connection, count against
+    `max_sessions` instead.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class,
+                 max_in_flight=utils.Settings.MAX_IN_FLIGHT,
+                 max_sessions=utils.Settings.MAX_SESSIONS):
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self._slots = threading.local()
+        super().__init__(server_address, handler_class)
+
+    def start_session(self):
+        """Trade the calling request's in-flight slot for a session slot;
+        returns False if all of them are taken"""
+        if not self.sessions.acquire(blocking=False):
+            return False
+        self._slots.session = True
+        self.in_flight.release()
+        return True
+
+    def process_request(self, request, client_address):
+        self.in_flight.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.in_flight.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        self._slots.session = False
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            if self._slots.session:
+                self.sessions.release()
+            else:
+                self.in_flight.release()
+
+
+async def iterate_in_executor(function, *args, buffered=8):
+    """Iterate over `function(*args)` on the default executor, yielding
+    each item as soon as it has been produced
+
+    The executor thread runs at most `buffered` items ahead, and stops
+    once the iteration is closed.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue(buffered)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item, error=None):
+        # Blocks while the queue is full; once stopped, the queue has
+        # been emptied for the one item that may still come
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(
+                items.put((item, error)), loop).result()
+
+    def produce():
+        iterator = None
+        try:
+            iterator = iter(function(*args))
+            for item in iterator:
+                put(item)
+                if stopped.is_set():
+                    break
+        except Exception as err:
+            put(done, err)
+        else:
+            put(done)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+        while not items.empty():
+            items.get_nowait()
+
+
+def blocking_iterator(chunks, loop):
+    """Iterate over the async iterable `chunks` of the event loop `loop`
+    from another thread"""
+    chunks = chunks.__aiter__()
+
+    async def next_chunk():
+        return await chunks.__anext__()
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(
+                next_chunk(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+class AsyncTCPProxyServer:
+    """Serve clients from an asyncio event loop.
+
+    Every client is a coroutine rather than a thread, so many more
+    requests can wait on their replies at once. Requests go through the
+    batcher, reply watcher and cache that `TCPProxyHandler.connect` sets
+    up; their SMTP and IMAP sessions keep running on threads of their
+    own, and the cache runs on the default executor (holding a thread
+    while a response it stores is still arriving).
+    """
+    chunk_size = TCPProxyHandler.chunk_size
+
+    def __init__(self, server_address, handler_class=TCPProxyHandler,
+                 max_in_flight=utils.Settings.MAX_IN_FLIGHT):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.max_in_flight = max_in_flight
+        self.in_flight = None
+        self.coalescer = None
+        if handler_class.coalescer is not None:
+            self.coalescer = coalesce.AsyncCoalescer(
+                handler_class.coalescer.max_bytes)
+
+    async def serve_forever(self):
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Handle the request"""
+        if self.handler_class.batcher is None:
+            raise AttributeError(
+                "You must call TCPProxyHandler.connect(settings) "
+                "before starting the server.")
+        try:
+            async with self.in_flight:
+                data = b''
+                with metrics.timed('client_read'):
+                    while True:
+                        new_data = await reader.read(self.chunk_size)
+                        data += new_data
+                        if not new_data or \
+                                new_data.endswith(b'\r\n\r\n'):
+                            break
+                logger.debug("%s", data.split(b'\r\n', 1)[0])
+                if data.startswith(b'CONNECT '):
+                    # Sessions relay their socket on threads; see
+                    # TCPProxyHandler.open_session
+                    logger.warning("CONNECT needs ENGINE=threads")
+                    writer.write(utils.error_response(501, 'Not Implemented'))
+                    return
+                await self.respond(data, writer)
+        finally:
+            writer.close()
+
+    async def respond(self, data, writer):
+        cache = self.handler_class.cache
+        client = (writer.get_extra_info('peername') or (None,))[0]
+        if cache is None:
+            response = await self.tunnel(data, client)
+            with metrics.timed('client_write'):
+                async for chunk in response:
+                    writer.write(chunk)
+                    await writer.drain()
+            return
+
+        loop = asyncio.get_running_loop()
+        lookup = await loop.run_in_executor(None, cache.lookup, data)
+        if lookup.chunks is not None:
+            chunks = iterate_in_executor(iter, lookup.chunks)
+        else:
+            # The cache reads the response as it is served, blocking
+            # until each email has arrived
+            response = await self.tunnel(lookup.request, client)
+            chunks = iterate_in_executor(
+                lookup.finish, blocking_iterator(response, loop))
+        try:
+            with metrics.timed('client_write'):
+                async for chunk in chunks:
+                    writer.write(chunk)
+                    await writer.drain()
+        finally:
+            await chunks.aclose()
+
+    async def tunnel(self, data, client=None):
+        """Send a raw request through email, or share the response to an
+        identical one in flight; returns an async iterable over the
+        response"""
+        if self.coalescer is not None:
+            return await self.coalescer.fetch(
+                data, functools.partial(self.send, client=client))
+        return await self.send(data, client)
+
+    async def send(self, data, client=None):
+        """Send a raw request through email; returns the response"""
+        return await asyncio.wrap_future(
+            self.handler_class.batcher.submit(data, client))
 
 
 def configure(s=utils.proxy_settings):
@@ -111,8 +416,20 @@ if __name__ == "__main__":
 
     TCPProxyHandler.connect(settings)
 
+    if settings.ENGINE == 'asyncio':
+        logger.info("Starting asyncio server... (stop with Ctrl-C)")
+        try:
+            asyncio.run(AsyncTCPProxyServer(
+                (HOST, PORT), TCPProxyHandler,
+                settings.MAX_IN_FLIGHT).serve_forever())
+        except KeyboardInterrupt:
+            print("Caught interrupt.")
+        sys.exit(0)
+
     # Create the server, binding to localhost on port 9999
-    tcp_server = socketserver.TCPServer((HOST, PORT), TCPProxyHandler)
+    tcp_server = ThreadedTCPProxyServer((HOST, PORT), TCPProxyHandler,
+                                        settings.MAX_IN_FLIGHT,
+                                        settings.MAX_SESSIONS)
     logger.debug("Server created.")
 
     logger.debug("Placing server into non-blocking mode.")
@@ -0,0 +1,277 @@
+"""Counters and latency histograms for every stage of the tunnel.
+
+Each stage of a request is timed into the `email_to_tcp_stage_seconds`
+histogram, labeled with the stage's name:
+
+  - local: client_read, pack_request, smtp_send, wait_reply,
+    imap_fetch_reply, unpack_reply, client_write
+  - remote: imap_fetch_request, unpack_request, forward, transcode,
+    pack_reply, smtp_reply
+
+Packing is streamed into the SMTP session, so smtp_send and smtp_reply
+include the time spent in pack_request and pack_reply, and forward
+includes transcode. Failures are
+counted per stage, and the bytes that stages produce or download in
+`email_to_tcp_stage_bytes_total`.
+
+With METRICS_PORT set, `start` serves the metrics in the Prometheus text
+format at http://METRICS_HOST:METRICS_PORT/metrics; with
+METRICS_LOG_INTERVAL set, it logs a summary of every stage that often.
+"""
+import bisect
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Email round trips take anything from milliseconds to minutes
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs)
+
+
+class Counter:
+    """A count per combination of label values"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """{label values: count}"""
+        with self._lock:
+            return dict(self._values)
+
+    def lines(self):
+        for key, value in sorted(self.values().items()):
+            yield '%s%s %s' % (self.name,
+                               _label_text(self.label_names, key), value)
+
+
+class Histogram:
+    """Observations per combination of label values, counted in buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values: [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def values(self):
+        """{label values: (count per bucket, sum)}"""
+        with self._lock:
+            return {key: (list(counts), total)
+                    for key, (counts, total) in self._values.items()}
+
+    def lines(self):
+        for key, (counts, total) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (
+                    self.name, _label_text(self.label_names, key,
+                                           [('le', bound)]), cumulative)
+            labels = _label_text(self.label_names, key)
+            yield '%s_sum%s %s' % (self.name, labels, total)
+            yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+class Registry:
+    """The metrics of a process"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, label_names=()):
+        metric = Counter(name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=BUCKETS):
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics, in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'email_to_tcp_stage_seconds',
+    'Seconds spent in each stage of a tunneled request', ('stage',))
+STAGE_ERRORS = REGISTRY.counter(
+    'email_to_tcp_stage_errors_total',
+    'Stages that failed with an exception', ('stage',))
+STAGE_BYTES = REGISTRY.counter(
+    'email_to_tcp_stage_bytes_total',
+    'Bytes produced or downloaded by each stage', ('stage',))
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Time a `with` block as `stage`, or count it as failed"""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    STAGE_SECONDS.observe(time.monotonic() - started, stage=stage)
+
+
+def observe(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def count_error(stage):
+    STAGE_ERRORS.inc(stage=stage)
+
+
+def count_bytes(stage, size):
+    STAGE_BYTES.inc(size, stage=stage)
+
+
+def timed_chunks(stage, chunks):
+    """Iterate over `chunks`, timing how long producing them takes as
+    `stage` and counting their bytes"""
+    seconds = size = 0
+    iterator = iter(chunks)
+    while True:
+        started = time.monotonic()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            break
+        except Exception:
+            STAGE_ERRORS.inc(stage=stage)
+            raise
+        seconds += time.monotonic() - started
+        size += len(chunk)
+        yield chunk
+    observe(stage, seconds)
+    count_bytes(stage, size)
+
+
+def summary(previous=None):
+    """Lines describing each stage since the `previous` histogram values
+    (see `Histogram.values`), and the current values"""
+    current = STAGE_SECONDS.values()
+    lines = []
+    for key, (counts, total) in sorted(current.items()):
+        before_counts, before_total = (previous or {}).get(
+            key, ([0] * len(counts), 0))
+        counts = [now - before for now, before in zip(counts, before_counts)]
+        count = sum(counts)
+        if not count:
+            continue
+        # Upper bound of the bucket that holds the 90th percentile
+        seen, p90 = 0, None
+        for bound, bucket_count in zip(STAGE_SECONDS.buckets, counts):
+            seen += bucket_count
+            if seen >= 0.9 * count:
+                p90 = bound
+                break
+        lines.append('%-20s %6d x %8.3fs, p90 %s' % (
+            key[0], count, (total - before_total) / count,
+            '<= %gs' % p90 if p90 is not None else
+            '> %gs' % STAGE_SECONDS.buckets[-1]))
+    return lines, current
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """Serve /metrics on a thread of its own; returns the server"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name='metrics').start()
+    logger.info("Serving metrics at http://%s:%d/metrics",
+                *server.server_address[:2])
+    return server
+
+
+def log_summaries(interval):
+    """Log a `summary` every `interval` seconds, on a thread of its own"""
+    def run():
+        previous = None
+        while True:
+            time.sleep(interval)
+            lines, previous = summary(previous)
+            if lines:
+                logger.info("Stages over the last %gs:\n%s", interval,
+                            '\n'.join(lines))
+
+    thread = threading.Thread(target=run, daemon=True, name='metrics-log')
+    thread.start()
+    return thread
+
+
+_started = threading.Lock()
+
+
+def start(s):
+    """Start the endpoint and log summaries that settings `s` ask for,
+    once per process (the local proxy and remote may share one)"""
+    if not _started.acquire(blocking=False):
+        return
+    if s.METRICS_PORT:
+        serve(s.METRICS_HOST, s.METRICS_PORT)
+    if s.METRICS_LOG_INTERVAL:
+        log_summaries(s.METRICS_LOG_INTERVAL)
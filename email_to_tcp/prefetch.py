@@ -0,0 +1,87 @@
+"""Discovery of the subresources an HTML page will ask for.
+
+With prefetching on, the remote parses every HTML page it relays, fetches
+the stylesheets, scripts and images the page links to on its own origin,
+and sends them in the same reply. Both sides build the requests for those
+subresources with `subresource_request`, so that the local cache files
+the pushed responses under the headers a browser request would match.
+"""
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+
+# Pages larger than this are relayed without being parsed
+MAX_PAGE_BYTES = 2 * 2 ** 20
+
+# Headers of the page request that are repeated for its subresources
+COPIED_HEADERS = ('User-Agent', 'Accept-Language', 'Cookie')
+
+# <link rel=...> values naming resources the page needs to render
+LINK_RELS = {'stylesheet', 'icon', 'preload', 'modulepreload'}
+
+
+class LinkParser(HTMLParser):
+    """Collect the subresource URLs of a page, as written in its HTML"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'base' and self.base is None:
+            self.base = attrs.get('href')
+        elif tag == 'link':
+            rels = set((attrs.get('rel') or '').lower().split())
+            if rels & LINK_RELS and attrs.get('href'):
+                self.links.append(attrs['href'])
+        elif tag in ('script', 'img') and attrs.get('src'):
+            self.links.append(attrs['src'])
+
+
+def is_html(headers):
+    return headers.get_content_type() in ('text/html',
+                                          'application/xhtml+xml')
+
+
+def subresources(page_url, html, limit):
+    """Absolute URLs of at most `limit` same-origin subresources
+
+    :param html: The page's body, as text
+    """
+    parser = LinkParser()
+    parser.feed(html)
+    parser.close()
+
+    base = urljoin(page_url, parser.base or '')
+    origin = urlsplit(page_url)[:2]
+    urls = []
+    for link in parser.links:
+        url, _ = urldefrag(urljoin(base, link.strip()))
+        if (urlsplit(url)[:2] == origin and url != page_url and
+                url not in urls):
+            urls.append(url)
+            if len(urls) == limit:
+                break
+    return urls
+
+
+def decode_page(body, headers):
+    """Text of an HTML page, in the charset its headers announce"""
+    try:
+        return body.decode(headers.get_content_charset() or 'utf-8',
+                           'replace')
+    except LookupError:
+        return body.decode('utf-8', 'replace')
+
+
+def subresource_request(url, page_headers):
+    """Raw GET request for a subresource of the page requested with
+    `page_headers`"""
+    lines = ['GET %s HTTP/1.1' % url, 'Host: %s' % urlsplit(url).netloc]
+    for name in COPIED_HEADERS:
+        value = page_headers.get(name)
+        if value:
+            lines.append('%s: %s' % (name, value))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
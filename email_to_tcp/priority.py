@@ -0,0 +1,148 @@
+"""Ordering tunneled requests by how much the user is waiting on them.
+
+Over a link with round trips of seconds, what a page feels like depends
+on what goes first far more than on throughput: the HTML document is
+needed before anything else can start, stylesheets and scripts before
+the page renders, images after that, and audio and video last. `rank`
+places a raw request in one of those classes, from its Sec-Fetch-Dest
+header when the browser sends one, and otherwise from its Accept header
+and the extension of its URL.
+
+The local proxy queues requests waiting for an email in a `FairQueue`,
+which also takes turns between clients, so that one client's hundred
+images don't hold up another's page. The remote ranks the requests it
+unpacks the same way, forwards them in that order (`PriorityExecutor`)
+and puts the best ranked responses first in its replies.
+"""
+from concurrent.futures import Future
+import heapq
+from http.client import parse_headers
+from io import BytesIO
+import itertools
+import os.path
+import queue
+import threading
+from urllib.parse import urlsplit
+
+
+DOCUMENT, SUBRESOURCE, IMAGE, MEDIA = range(4)
+
+# Sec-Fetch-Dest values; others (fetch, XHR, workers) are subresources
+DESTINATIONS = {
+    'document': DOCUMENT, 'iframe': DOCUMENT, 'frame': DOCUMENT,
+    'style': SUBRESOURCE, 'script': SUBRESOURCE, 'font': SUBRESOURCE,
+    'image': IMAGE,
+    'audio': MEDIA, 'video': MEDIA, 'track': MEDIA,
+}
+
+EXTENSIONS = {
+    '.html': DOCUMENT, '.htm': DOCUMENT, '.xhtml': DOCUMENT,
+    '.css': SUBRESOURCE, '.js': SUBRESOURCE, '.mjs': SUBRESOURCE,
+    '.woff': SUBRESOURCE, '.woff2': SUBRESOURCE, '.ttf': SUBRESOURCE,
+    '.otf': SUBRESOURCE,
+    '.png': IMAGE, '.jpg': IMAGE, '.jpeg': IMAGE, '.gif': IMAGE,
+    '.webp': IMAGE, '.avif': IMAGE, '.svg': IMAGE, '.ico': IMAGE,
+    '.bmp': IMAGE,
+    '.mp4': MEDIA, '.webm': MEDIA, '.mkv': MEDIA, '.mov': MEDIA,
+    '.avi': MEDIA, '.mp3': MEDIA, '.m4a': MEDIA, '.ogg': MEDIA,
+    '.oga': MEDIA, '.wav': MEDIA, '.flac': MEDIA, '.m3u8': MEDIA,
+}
+
+
+def rank(raw_request):
+    """Class of a raw HTTP request: DOCUMENT, SUBRESOURCE, IMAGE or
+    MEDIA, most urgent first"""
+    request_line, _, header_block = raw_request.partition(b'\r\n')
+    try:
+        url = str(request_line.split()[1], 'iso-8859-1')
+    except IndexError:
+        return SUBRESOURCE
+    headers = parse_headers(BytesIO(header_block.split(b'\r\n\r\n')[0] +
+                                    b'\r\n\r\n'))
+
+    destination = (headers.get('Sec-Fetch-Dest') or '').strip().lower()
+    if destination in DESTINATIONS:
+        return DESTINATIONS[destination]
+    # Only media players and download managers ask for parts of a file
+    if headers.get('Range'):
+        return MEDIA
+
+    accept = (headers.get('Accept') or '').split(',')[0].strip().lower()
+    if accept in ('text/html', 'application/xhtml+xml'):
+        return DOCUMENT
+    if accept == 'text/css':
+        return SUBRESOURCE
+    if accept.startswith('image/'):
+        return IMAGE
+    if accept.startswith(('video/', 'audio/')):
+        return MEDIA
+
+    extension = os.path.splitext(urlsplit(url).path)[1].lower()
+    return EXTENSIONS.get(extension, SUBRESOURCE)
+
+
+class FairQueue(queue.Queue):
+    """Queue of (rank, client, item) entries that hands out the best
+    ranked item first, and items of the same rank from each client in
+    turn (oldest first for each)"""
+
+    def _init(self, maxsize):
+        self.queue = []
+        # (rank, client): turn of the client's latest item of that rank,
+        # and how many of its items of that rank are queued; clients
+        # with none queued are forgotten, as they would go next anyway
+        self._turns = {}
+        # rank: turn of the latest item of that rank handed out
+        self._current = {}
+        self._order = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, entry):
+        rank, client, item = entry
+        latest, queued = self._turns.get((rank, client), (0, 0))
+        turn = max(latest, self._current.get(rank, 0)) + 1
+        self._turns[rank, client] = turn, queued + 1
+        heapq.heappush(self.queue,
+                       (rank, turn, next(self._order), client, item))
+
+    def _get(self):
+        rank, turn, _, client, item = heapq.heappop(self.queue)
+        self._current[rank] = turn
+        latest, queued = self._turns[rank, client]
+        if queued > 1:
+            self._turns[rank, client] = latest, queued - 1
+        else:
+            del self._turns[rank, client]
+        return item
+
+
+class PriorityExecutor:
+    """Pool of `max_workers` threads that run the best ranked of the
+    calls waiting for them first (see `FairQueue`)"""
+
+    def __init__(self, max_workers, name='worker'):
+        self._queue = FairQueue()
+        for number in range(max_workers):
+            threading.Thread(target=self._work, daemon=True,
+                             name='%s-%d' % (name, number)).start()
+
+    def submit(self, rank, client, fn, *args, **kwargs):
+        """Future for `fn(*args, **kwargs)`, run once no better ranked
+        call is waiting"""
+        future = Future()
+        self._queue.put((rank, client, (future, fn, args, kwargs)))
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
@@ -1,14 +1,22 @@
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
 from getpass import getpass
 import imaplib
+import itertools
 import logging
 from http.client import HTTPException, LineTooLong
 import os
 import smtplib
+import socket
 import sys
+import threading
+import time
 
 from requests.exceptions import RequestException
 
-from email_to_tcp import utils
+from email_to_tcp import (cache, headertable, metrics, prefetch, priority,
+                          sessions, transcode, utils)
 
 
 logger = logging.getLogger(
@@ -16,24 +24,372 @@ logger = logging.getLogger(
 
 
 def run(settings):
-    email_connection = utils.EmailConnection(s=settings)
+    metrics.start(settings)
+    session = utils.forwarding_session(settings.FORWARD_WORKERS)
+    workers = priority.PriorityExecutor(settings.FORWARD_WORKERS, 'forward')
+    transcoder = None
+    if settings.TRANSCODE:
+        transcoder = transcode.Transcoder(settings)
+    upstream_cache = None
+    if settings.REMOTE_CACHE_BYTES:
+        upstream_cache = cache.UpstreamCache(
+            settings.REMOTE_CACHE_BYTES, settings.CACHE_MAX_ENTRY_BYTES,
+            transcoder)
+    # Prefetches get threads of their own, as the page's forwarding
+    # thread waits on them.
+    prefetchers = None
+    if settings.PREFETCH:
+        prefetchers = ThreadPoolExecutor(settings.FORWARD_WORKERS)
+    header_tables = None
+    if settings.HEADER_TABLE:
+        header_tables = headertable.HeaderTables()
 
+    # Every account is read on a thread of its own, and requests are
+    # answered from the account they were sent to.
+    first, *others = utils.account_settings(settings)
+    for account in others:
+        threading.Thread(
+            target=serve, name='mailbox-%s' % account.IMAP_USER,
+            daemon=True,
+            args=(utils.EmailConnection(s=account), settings, session,
+                  workers, upstream_cache, prefetchers, transcoder,
+                  header_tables)).start()
+    serve(utils.EmailConnection(s=first), settings, session, workers,
+          upstream_cache, prefetchers, transcoder, header_tables)
+
+
+def serve(email_connection, settings, session, workers,
+          upstream_cache=None, prefetchers=None, transcoder=None,
+          header_tables=None):
+    """Answer the requests sent to the mailbox of `email_connection`"""
+    session_relay = SessionRelay(email_connection, settings.SESSION_WINDOW,
+                                 settings.MAX_EMAIL_BYTES)
     while True:
         email_candidate = \
             email_connection.fetch(subject=settings.MAIL_PREFIX)
-        raw_data = utils.unpack(email_candidate)
-        if not raw_data:
+        try:
+            frames = sessions.frames_of(email_candidate)
+        except ValueError as err:
+            logger.debug("Unable to unpack session frames: %s", err)
+            continue
+        if frames:
+            session_relay.deliver(email_candidate, frames)
+            continue
+        try:
+            with metrics.timed('unpack_request'):
+                tunneled = utils.unpack_all(email_candidate)
+        except utils.FormatException as err:
+            logger.debug("Unable to unpack email: %s", err)
+            continue
+        if not tunneled:
             logger.debug("No data unpacked...")
             continue
+        peer = None
+        if header_tables is not None:
+            peer = header_tables.peer(email_candidate)
+        if peer is not None:
+            tunneled = [(filename, unpack_head(peer, raw_data))
+                        for filename, raw_data in tunneled]
+
+        # Forward in the background so that a slow origin server doesn't
+        # hold up the emails behind it, the most urgent requests first.
+        filenames = [filename for filename, _ in tunneled]
+        ranks = [priority.rank(raw_data or b'') for _, raw_data in tunneled]
+        client = email_candidate['From']
+        pushed = []
+        futures = []
+        for rank, (filename, raw_data) in zip(ranks, tunneled):
+            if raw_data is None:
+                futures.append(Future())
+                futures[-1].set_result(None)
+            elif prefetchers is not None:
+                futures.append(workers.submit(
+                    rank, client, forward_and_prefetch, filename, raw_data,
+                    pushed, prefetchers, session, upstream_cache,
+                    settings.PREFETCH_MAX_RESOURCES, transcoder))
+            else:
+                futures.append(workers.submit(
+                    rank, client, forward, raw_data, session,
+                    upstream_cache=upstream_cache, transcoder=transcoder))
+        reply_when_done(email_connection, email_candidate,
+                        filenames, futures, settings.MAX_EMAIL_BYTES, pushed,
+                        ranks, peer)
+
+
+def unpack_head(peer, raw_data):
+    """`raw_data` with its head unpacked, or None if it can't be"""
+    try:
+        return peer.unpack(raw_data)
+    except ValueError as err:
+        logger.debug("Unable to unpack request head: %s", err)
+        return None
+
+
+def reply_when_done(email_connection, email_candidate, filenames, futures,
+                    max_email_bytes=utils.Settings.MAX_EMAIL_BYTES,
+                    pushed=(), ranks=None, peer=None):
+    """Reply to `email_candidate` as soon as all of its requests have
+    been forwarded.
+
+    Every request of a batch is answered in a single reply, unless the
+    responses add up to more than `max_email_bytes`: then the reply
+    continues in further emails (see `utils.iter_reply_slices`). Replies
+    are queued for `email_connection` to send, without waiting for them.
+    Requests that can't be forwarded get a 502 response, so that the
+    local side doesn't wait on them forever.
+
+    :param pushed: (filename, url, response chunks) of prefetched
+    subresources, filled in by the time the last future is done
+    :param ranks: `priority.rank` of each request; the most urgent
+    responses are put first, so that they arrive in the first email
+    :param peer: `headertable.Peer` of the sender, to pack response heads
+    for
+    """
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def pack(chunks):
+        return peer.pack_stream(chunks) if peer is not None else chunks
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        # Response bodies have been read by `forward`, and are streamed
+        # from memory or disk into the reply.
+        bodies = [(filename, utils.ResponseBody(pack(
+                      future.result() or
+                      utils.error_response(502, 'Bad Gateway'))))
+                  for filename, future in zip(filenames, futures)]
+        if ranks is not None:
+            bodies = [body for _, body in sorted(
+                zip(ranks, bodies), key=lambda ranked: ranked[0])]
+        taken = set(filenames)
+        for page, url, chunks in pushed:
+            filename = utils.generate_filename()
+            while filename in taken:
+                filename = utils.generate_filename()
+            taken.add(filename)
+            bodies.append((filename, utils.ResponseBody(pack(chunks), {
+                utils.PUSH_HEADER: url, utils.PUSH_FOR_HEADER: page})))
+        reply(bodies)
+
+    def reply(bodies):
+        # Queued for the connection's sending thread, so that forwarding
+        # threads don't wait on SMTP; each email is generated once the
+        # previous one has been sent.
+        try:
+            sent = email_connection.reply_many(
+                utils.iter_reply_slices(bodies, max_email_bytes),
+                email_candidate,
+                peer.email_headers() if peer is not None else None,
+                wait=False)
+        except Exception as err:
+            logger.error("Unable to reply to %s: %s",
+                         email_candidate['subject'], err)
+            return
+        sent.add_done_callback(functools.partial(replied, bodies))
+
+    def replied(bodies, sent):
+        if sent.exception() is not None:
+            logger.error("Unable to reply to %s: %s",
+                         email_candidate['subject'], sent.exception())
+            return
+        bodies = [(filename, body) for filename, body in bodies
+                  if not body.finished]
+        if bodies:
+            reply(bodies)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class SessionRelay:
+    """The remote ends of tunneled CONNECT sessions, with a socket each
+
+    Frames that arrive before their session's first one (emails may
+    arrive out of order) are kept for up to `early_timeout` seconds, and
+    up to `max_early_bytes` of them in all. The ids of the latest
+    `max_closed` sessions to close are remembered, so that their late
+    frames don't open them again.
+    """
+
+    def __init__(self, email_connection, window, max_bytes,
+                 connect_timeout=30, early_timeout=60,
+                 max_early_bytes=2 ** 23, max_closed=4096):
+        self.email_connection = email_connection
+        self.window = window
+        self.max_bytes = max_bytes
+        self.connect_timeout = connect_timeout
+        self.early_timeout = early_timeout
+        self.max_early_bytes = max_early_bytes
+        self.max_closed = max_closed
+        self._sessions = {}
+        self._closed = collections.OrderedDict()  # session id: None
+        self._early = {}  # session id: (deadline, [frame, ...])
+        self._early_bytes = 0
+        self._lock = threading.Lock()
+
+    def deliver(self, email_candidate, frames):
+        """Hand the frames of an email to their sessions, opening new ones"""
+        for frame in frames:
+            early = []
+            with self._lock:
+                self._expire_early()
+                session = self._sessions.get(frame.session)
+                if session is None and frame.session not in self._closed:
+                    if not frame.connect:
+                        self._keep_early(frame)
+                        continue
+                    session = self._open(frame, email_candidate)
+                    early = self._pop_early(frame.session)
+            if session is None:
+                logger.debug("Frame for closed session %s", frame.session)
+                continue
+            for early_frame in early:
+                session.receive(early_frame)
+            session.receive(frame)
+
+    def _keep_early(self, frame):
+        if self._early_bytes + len(frame.data) > self.max_early_bytes:
+            logger.warning("Dropping early frame of session %s",
+                           frame.session)
+            return
+        deadline = time.monotonic() + self.early_timeout
+        self._early.setdefault(frame.session, (deadline, []))[1].append(
+            frame)
+        self._early_bytes += len(frame.data)
+
+    def _pop_early(self, session_id):
+        _, frames = self._early.pop(session_id, (None, []))
+        self._early_bytes -= sum(len(frame.data) for frame in frames)
+        return frames
+
+    def _expire_early(self):
+        now = time.monotonic()
+        for session_id, (deadline, _) in list(self._early.items()):
+            if deadline < now:
+                logger.debug("Frames for unknown session %s expired",
+                             session_id)
+                self._pop_early(session_id)
+
+    def _open(self, frame, email_candidate):
+        def send(frames):
+            self.email_connection.reply_many(frames, email_candidate)
+
+        session = sessions.Session(frame.session, send, self.window,
+                                   self.max_bytes)
+        self._sessions[frame.session] = session
+        threading.Thread(target=self._relay, args=(session, frame.connect),
+                         name='session', daemon=True).start()
+        return session
+
+    def _relay(self, session, target):
         try:
+            host, _, port = target.strip().rpartition(':')
+            sock = socket.create_connection((host.strip('[]'), int(port)),
+                                            self.connect_timeout)
+            sock.settimeout(None)
+        except (OSError, ValueError) as err:
+            logger.info("Unable to connect session %s to %s: %s",
+                        session.id, target, err)
+            try:
+                session.send([session.frame(b'', close=True)])
+            except Exception as err:
+                logger.error("Unable to close session %s: %s",
+                             session.id, err)
+        else:
+            logger.debug("Session %s connected to %s", session.id, target)
+            session.run(sock)
+        finally:
+            with self._lock:
+                self._sessions.pop(session.id, None)
+                self._closed[session.id] = None
+                if len(self._closed) > self.max_closed:
+                    self._closed.popitem(last=False)
+
+
+def forward(raw_data, session=None, chunk_size=2 ** 16,
+            upstream_cache=None, transcoder=None):
+    """Forward one raw request; returns an iterator over the HTTP
+    response (status line, headers and body), or None
+
+    Responses are transcoded by `transcoder`, or by `upstream_cache`'s
+    own when there is a cache. The whole response is read before it is
+    returned (see `utils.spool`), so that a slow origin server holds up
+    only its own request rather than the reply it goes in, and one that
+    fails halfway gets a 502 rather than a truncated response.
+    """
+    try:
+        with metrics.timed('forward'):
             forwarder = utils.Forwarder(raw_data)
-            response = forwarder.forward()
-        except (ValueError, HTTPException, LineTooLong,
-                RequestException, AttributeError) as err:
-            logger.debug("Unable to forward email: %s", err)
+            if upstream_cache is not None:
+                chunks = upstream_cache.forward(forwarder, session,
+                                                chunk_size)
+            else:
+                # Meant for an upstream cache, never for the origin
+                del forwarder.headers[cache.HAVE_HEADER]
+                response = forwarder.forward(session, stream=True)
+                logger.debug("Received response\n%s", response)
+                head = utils.response_head(response)
+                body = response.iter_content(chunk_size)
+                if transcoder is not None:
+                    head, body = transcoder.transcode(head, body)
+                chunks = itertools.chain([head], body)
+            return utils.spool(chunks, chunk_size)
+    except (ValueError, HTTPException, LineTooLong,
+            RequestException, AttributeError, OSError) as err:
+        logger.debug("Unable to forward email: %s", err)
+        return None
+
+
+def forward_and_prefetch(filename, raw_data, pushed, prefetchers,
+                         session=None, upstream_cache=None,
+                         max_resources=utils.Settings.PREFETCH_MAX_RESOURCES,
+                         transcoder=None):
+    """`forward`, then fetch the same-origin subresources of HTML pages
+
+    Cacheable subresource responses are appended to `pushed` as
+    (filename, url, response chunks), before the page is returned.
+    """
+    chunks = forward(raw_data, session, upstream_cache=upstream_cache,
+                     transcoder=transcoder)
+    if chunks is None:
+        return None
+    request = utils.Forwarder(raw_data)
+    head, body = cache.split_head(chunks)
+    status, headers = cache.parse_response_head(head)
+    if (request.method.upper() != 'GET' or status != 200 or
+            not prefetch.is_html(headers)):
+        return itertools.chain([head], body)
+    html, complete = cache.read_at_most(body, prefetch.MAX_PAGE_BYTES)
+    page = itertools.chain([head, html], body)
+    if not complete:
+        return page
+
+    urls = prefetch.subresources(
+        request.path, prefetch.decode_page(html, headers), max_resources)
+    futures = [(url, prefetchers.submit(
+                    forward, prefetch.subresource_request(
+                        url, request.headers),
+                    session, upstream_cache=upstream_cache,
+                    transcoder=transcoder))
+               for url in urls]
+    count = 0
+    for url, future in futures:
+        response = future.result()
+        if response is None:
             continue
-        logger.debug("Received response\n%s", response)
-        email_connection.reply(response.content, email_candidate)
+        head, body = cache.split_head(response)
+        status, headers = cache.parse_response_head(head)
+        if status == 200 and \
+                'no-store' not in cache.parse_cache_control(headers):
+            pushed.append((filename, url, itertools.chain([head], body)))
+            count += 1
+    logger.debug("Prefetched %d of %d subresources of %s",
+                 count, len(urls), request.path)
+    return page
 
 
 def configure(s=utils.proxy_settings):
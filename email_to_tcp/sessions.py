@@ -0,0 +1,185 @@
+"""Long-lived TCP sessions (HTTP CONNECT) tunneled over email.
+
+The local proxy answers a CONNECT request itself and from then on relays
+the client's bytes in numbered data frames: attachments that carry the
+session id in X-Tunnel-Session and a sequence number in X-Tunnel-Frame.
+The first frame of a session names its destination in X-Tunnel-Connect,
+and the last one carries X-Tunnel-Close. Whatever a socket sends within
+`window` seconds goes out as one frame, in one email.
+
+The remote opens a socket for every new session, writes the frames it
+receives in sequence order (emails may arrive out of order), and sends
+back what the destination sends, in frames of its own, as replies to the
+session's first email. Both ends run the same `Session` class.
+"""
+import logging
+import queue
+import select
+import socket
+import threading
+
+from email_to_tcp import compression
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_HEADER = 'X-Tunnel-Session'
+FRAME_HEADER = 'X-Tunnel-Frame'
+CONNECT_HEADER = 'X-Tunnel-Connect'
+CLOSE_HEADER = 'X-Tunnel-Close'
+
+# Tells the writer thread to stop, without closing the socket
+_STOP = object()
+
+
+class Frame:
+    """One numbered piece of a session's byte stream"""
+
+    def __init__(self, session, seq, data, connect=None, close=False):
+        self.session = session
+        self.seq = seq
+        self.data = data
+        self.connect = connect
+        self.close = close
+
+    @classmethod
+    def from_headers(cls, headers, data):
+        """Frame of an attachment, or None if it isn't one"""
+        session = headers.get(SESSION_HEADER)
+        if not session:
+            return None
+        return cls(str(session).strip(), int(headers.get(FRAME_HEADER, 0)),
+                   data, headers.get(CONNECT_HEADER),
+                   bool(headers.get(CLOSE_HEADER)))
+
+
+def frames_of(message):
+    """The session frames among the parts of an email `Message`"""
+    frames = []
+    for part in message.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+        data = part.get_payload(decode=True) or b''
+        frame = Frame.from_headers(part, data)
+        if frame is not None:
+            frame.data = compression.decompress(
+                data, part.get(compression.ENCODING_HEADER))
+            frames.append(frame)
+    return frames
+
+
+def read_available(sock, window, max_bytes, wait=True):
+    """Read what `sock` sends within `window` seconds of its first byte
+
+    :param wait: Wait for the first byte; otherwise give up after
+    `window` seconds
+    :return: (data, eof)
+    """
+    data = b''
+    timeout = None if wait else window
+    while len(data) < max_bytes:
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            break
+        chunk = sock.recv(min(2 ** 16, max_bytes - len(data)))
+        if not chunk:
+            return data, True
+        data += chunk
+        timeout = window
+    return data, False
+
+
+class Session:
+    """One end of a tunneled TCP session
+
+    :param send: Function sending a list of frame attachments
+    (filename, data, headers) to the other end, in one email
+    """
+
+    def __init__(self, session_id, send, window=0.2, max_bytes=2 ** 20):
+        self.id = session_id
+        self.send = send
+        self.window = window
+        self.max_bytes = max_bytes
+        self.peer_closed = False
+        self._seq = 0
+        self._received = {}
+        self._next = 0
+        self._incoming = queue.Queue()
+        self._lock = threading.Lock()
+
+    def frame(self, data, close=False, headers=None):
+        """Attachment for the next frame sent to the other end"""
+        headers = dict(headers or {}, **{SESSION_HEADER: self.id,
+                                         FRAME_HEADER: str(self._seq)})
+        if close:
+            headers[CLOSE_HEADER] = '1'
+        self._seq += 1
+        return '%s-%d' % (self.id, self._seq - 1), data, headers
+
+    def receive(self, frame):
+        """Queue the data of a frame from the other end, in order"""
+        with self._lock:
+            self._received[frame.seq] = frame
+            while self._next in self._received:
+                frame = self._received.pop(self._next)
+                self._next += 1
+                if frame.data:
+                    self._incoming.put(frame.data)
+                if frame.close:
+                    self._incoming.put(None)
+
+    def fail(self, err):
+        logger.warning("Session %s failed: %s", self.id, err)
+        self._incoming.put(None)
+
+    def run(self, sock, first_headers=None):
+        """Relay between `sock` and the other end until either closes"""
+        writer = threading.Thread(target=self._write, args=(sock,),
+                                  name='session-writer', daemon=True)
+        writer.start()
+        try:
+            self._read(sock, first_headers)
+        finally:
+            self._incoming.put(_STOP)
+            writer.join()
+            sock.close()
+
+    def _read(self, sock, headers):
+        first = True
+        while True:
+            try:
+                data, eof = read_available(sock, self.window,
+                                           self.max_bytes, wait=not first)
+            except OSError:
+                data, eof = b'', True
+            if self.peer_closed:
+                return
+            if data or eof or headers:
+                try:
+                    self.send([self.frame(data, eof, headers)])
+                except Exception as err:
+                    logger.error("Unable to send frame of session %s: %s",
+                                 self.id, err)
+                    return
+            if eof:
+                return
+            first, headers = False, None
+
+    def _write(self, sock):
+        while True:
+            data = self._incoming.get()
+            if data is _STOP:
+                return
+            if data is None:
+                self.peer_closed = True
+                break
+            try:
+                sock.sendall(data)
+            except OSError:
+                break
+        try:
+            # Wakes the reader up with an end of file
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
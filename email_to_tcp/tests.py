@@ -1,15 +1,42 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import email
 import imaplib
+import itertools
+import json
+import os
+import random
+import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import logging
 import smtplib
 
-from email_to_tcp import utils
+import requests
+
+from email_to_tcp import (benchmark, cache, coalesce, compression, delta,
+                          fakemail, headertable, local, metrics, priority,
+                          remote, sessions, transcode, utils)
 
 
 logger = logging.getLogger(__name__)
 
 
+def sent_by(handle):
+    """`EmailConnection.reply_many` stand-in that hands the attachments
+    to `handle`, and returns a done Future as a queued reply would"""
+    def reply_many(attachments, initial_email, headers=None, wait=True):
+        handle(attachments)
+        future = Future()
+        future.set_result('Re: x')
+        return future
+    return reply_many
+
+
 class TestEmailUtilities(unittest.TestCase):
     """Tests for encoding and decoding file names associated with data"""
 
@@ -34,6 +61,112 @@ class TestEmailUtilities(unittest.TestCase):
         unpacked = utils.unpack(payload)
         self.assertEqual(unpacked, self.request)
 
+    def test_packing_many(self):
+        """Test packing several payloads into one email."""
+
+        attachments = [('first.pkt', self.request), ('second.pkt', b'2')]
+        payload = utils.pack_many('mccoy@localhost',
+                                  ['smtp2tcp@localhost'],
+                                  'TestSubject',
+                                  attachments)
+        self.assertEqual(utils.unpack_all(payload.as_bytes()), attachments)
+        self.assertEqual(utils.unpack(payload), b'2')
+
+    def test_compressed_packing(self):
+        """Compressed payloads are marked and transparently unpacked."""
+
+        payload = utils.pack('mccoy@localhost',
+                             ['smtp2tcp@localhost'],
+                             'TestSubject',
+                             self.request * 10, encoding='zlib')
+        attachment = payload.get_payload()[0]
+        self.assertEqual(attachment[compression.ENCODING_HEADER], 'zlib')
+        self.assertLess(len(attachment.get_payload(decode=True)),
+                        len(self.request))
+        self.assertEqual(utils.unpack(payload.as_string()),
+                         self.request * 10)
+
+    def test_incompressible_packing(self):
+        """Payloads that don't shrink are sent raw."""
+
+        payload = utils.pack('mccoy@localhost',
+                             ['smtp2tcp@localhost'],
+                             'TestSubject',
+                             b'x', encoding='zlib')
+        attachment = payload.get_payload()[0]
+        self.assertIsNone(attachment[compression.ENCODING_HEADER])
+        self.assertEqual(utils.unpack(payload), b'x')
+
+    def test_negotiation(self):
+        """Only encodings advertised by the peer are used."""
+
+        self.assertIsNone(compression.negotiate(None))
+        self.assertIsNone(compression.negotiate('lzma'))
+        self.assertEqual(compression.negotiate('lzma, ZLIB'), 'zlib')
+        payload = utils.pack('a@b', ['c@d'], 'TestSubject', b'')
+        self.assertEqual(
+            compression.negotiate(payload[compression.ACCEPT_HEADER]),
+            next(iter(compression.CODECS)))
+
+    def test_streaming(self):
+        """Streamed payloads are packed and unpacked chunk by chunk."""
+
+        body = random.Random(0).randbytes(256000)
+        chunks = (body[i:i + 1000] for i in range(0, len(body), 1000))
+        raw = b''.join(utils.iter_pack_many(
+            'mccoy@localhost', ['smtp2tcp@localhost'], 'TestSubject',
+            [('streamed.pkt', chunks), ('small.pkt', self.request)],
+            encoding='zlib'))
+
+        headers, attachments = utils.split_message(raw)
+        self.assertEqual(headers['Subject'], 'TestSubject')
+        self.assertEqual([a.filename for a in attachments],
+                         ['streamed.pkt', 'small.pkt'])
+        decoded = list(attachments[0].iter_decode(chunk_size=4096))
+        self.assertGreater(len(decoded), 1)
+        self.assertEqual(b''.join(decoded), body)
+        self.assertEqual(attachments[1].decode(), self.request)
+        self.assertEqual(utils.unpack_all(raw)[0][1], body)
+
+    def test_send_stream(self):
+        """Streamed messages are sent with dot-stuffing."""
+
+        smtp = mock.Mock()
+        smtp.mail.return_value = smtp.rcpt.return_value = (250, b'OK')
+        smtp.docmd.return_value = (354, b'Go ahead')
+        smtp.getreply.return_value = (250, b'Queued')
+        utils.send_stream(smtp, 'a@b', ['c@d'],
+                          iter([b'Subject: x\r\n\r\n', b'.hidden\r\n']))
+        self.assertEqual(smtp.send.call_args_list, [
+            mock.call(b'Subject: x\r\n\r\n'),
+            mock.call(b'..hidden\r\n'),
+            mock.call(b'.\r\n')])
+
+    def test_send_pipelined(self):
+        """Pipelined messages are written before any reply is read."""
+
+        def broken():
+            yield b'Subject: y\r\n'
+            raise OSError('gone')
+
+        smtp = mock.Mock()
+        smtp.getreply.side_effect = [
+            (250, b'OK'), (250, b'OK'), (250, b'Queued'),
+            (250, b'OK'), (550, b'No such user'), (250, b'Queued'),
+            (250, b'OK'), (250, b'OK'), (250, b'Reset')]
+        errors = utils.send_pipelined(smtp, [
+            ('a@b', ['c@d'], [b'Subject: x\r\n\r\n', b'.kept\r\n']),
+            ('a@b', ['e@f'], [b'Subject: z\r\n\r\n']),
+            ('a@b', ['c@d'], broken())])
+        written = b''.join(call[0][0] for call in smtp.send.call_args_list)
+        self.assertTrue(written.startswith(
+            b'MAIL FROM:<a@b>\r\nRCPT TO:<c@d>\r\n'
+            b'BDAT 21 LAST\r\nSubject: x\r\n\r\n.kept\r\n'))
+        self.assertTrue(written.endswith(b'RSET\r\n'))
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], smtplib.SMTPRecipientsRefused)
+        self.assertIsInstance(errors[2], OSError)
+
     def test_linebreaks(self):
         """Test base64_encode
         and base64_decode"""
@@ -45,6 +178,1424 @@ class TestEmailUtilities(unittest.TestCase):
             self.request)
 
 
+class TestConnectionPool(unittest.TestCase):
+    """Tests for the per-request email connection pool."""
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, 'EmailConnection')
+        self.connection_class = patcher.start()
+        self.connection_class.side_effect = \
+            lambda s, **kwargs: mock.Mock()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        """Connections are returned to the pool and reused."""
+        pool = utils.EmailConnectionPool(utils.Settings(), size=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertIs(first, second)
+        self.assertEqual(self.connection_class.call_count, 1)
+
+    def test_concurrent_checkout(self):
+        """Concurrent requests never share a connection."""
+        pool = utils.EmailConnectionPool(utils.Settings(), size=2)
+        with pool.connection() as first, pool.connection() as second:
+            self.assertIsNot(first, second)
+
+    def test_failed_connection_dropped(self):
+        """A connection that raised is closed and not reused."""
+        pool = utils.EmailConnectionPool(utils.Settings(), size=1)
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as broken:
+                raise RuntimeError
+        broken.close.assert_called_once_with()
+        with pool.connection() as fresh:
+            self.assertIsNot(broken, fresh)
+
+    def test_check_idle(self):
+        """Dead idle connections are replaced by healthy spares."""
+        settings = utils.Settings()
+        settings.SPARE_CONNECTIONS = 2
+        pool = utils.EmailConnectionPool(settings, size=4)
+        pool.warm(2)
+        dead = pool._idle.queue[0]
+        dead.is_alive.return_value = False
+
+        pool.check_idle()
+        dead.close.assert_called_once_with()
+        self.assertEqual(pool._idle.qsize(), 2)
+        self.assertNotIn(dead, pool._idle.queue)
+
+
+class TestReconnect(unittest.TestCase):
+    """Tests for reopening dropped sessions."""
+
+    def setUp(self):
+        patcher = mock.patch.object(utils.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.settings = utils.Settings()
+
+    def test_backoff(self):
+        """Transient failures are retried with growing delays."""
+        connect = mock.Mock(side_effect=[ConnectionRefusedError,
+                                         ConnectionRefusedError, 'ok'])
+        self.assertEqual(
+            utils.connect_with_backoff(connect, self.settings), 'ok')
+        delay = self.settings.RECONNECT_DELAY
+        self.assertEqual(self.sleep.call_args_list,
+                         [mock.call(delay), mock.call(2 * delay)])
+
+    def test_no_retry_on_bad_password(self):
+        """Authentication failures are not retried."""
+        connect = mock.Mock(side_effect=smtplib.SMTPAuthenticationError(
+            535, b'Bad credentials'))
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            utils.connect_with_backoff(connect, self.settings)
+        self.assertEqual(connect.call_count, 1)
+
+    def test_watcher_outlasts_outage(self):
+        """The reply watcher fails waiting requests during a long outage,
+        and goes on watching once the server is back."""
+        self.settings.RECONNECT_MAX_DELAY = 0.01
+        with mock.patch.object(utils, 'imap_connect') as imap_connect:
+            dropped, fresh = mock.Mock(), mock.Mock()
+            for imap in (dropped, fresh):
+                imap.capabilities = ('IMAP4REV1', 'IDLE')
+                imap.response.return_value = ('EXISTS', [None])
+                imap.uid.return_value = ('OK', [None])
+            back = threading.Event()
+            fresh.idle.side_effect = lambda timeout: (
+                back.set(), time.sleep(0.01), ('OK', []))[-1]
+            imap_connect.return_value = dropped
+            watcher = utils.ReplyWatcher(self.settings)
+            self.addCleanup(watcher.stop)
+            waiting = watcher.expect('one')
+
+            imap_connect.side_effect = \
+                [OSError('down')] * self.settings.RECONNECT_ATTEMPTS + \
+                [fresh]
+            dropped.idle.side_effect = OSError('dropped')
+            watcher.start()
+            self.assertIsInstance(waiting.exception(5), OSError)
+            self.assertTrue(back.wait(5))
+            self.assertTrue(watcher.is_alive())
+            self.assertIs(watcher.imap, fresh)
+
+        watcher.stop()
+        self.assertIsInstance(watcher.expect('two').exception(0),
+                              utils.EmailException)
+
+    def test_sendmail_reconnects(self):
+        """A message sent on a dropped SMTP session is sent again."""
+        with mock.patch.object(utils, 'smtp_connect') as smtp_connect:
+            dropped, fresh = mock.Mock(), mock.Mock()
+            dropped.sendmail.side_effect = smtplib.SMTPServerDisconnected
+            smtp_connect.side_effect = [dropped, fresh]
+            connection = utils.EmailConnection(self.settings, imap=False)
+            connection.sendmail('a@b', ['c@d'], 'message')
+        fresh.sendmail.assert_called_once_with('a@b', ['c@d'], 'message')
+
+    def test_broken_stream(self):
+        """A message failing to generate doesn't spoil the ones queued
+        after it."""
+        def broken():
+            yield b'Subject: x\r\n\r\n'
+            raise OSError('gone')
+
+        with mock.patch.object(utils, 'smtp_connect') as smtp_connect:
+            halfway, fresh = mock.Mock(), mock.Mock()
+            halfway.has_extn.return_value = False
+            halfway.mail.return_value = halfway.rcpt.return_value = \
+                (250, b'OK')
+            halfway.docmd.return_value = (354, b'Go ahead')
+            halfway.close.side_effect = lambda: setattr(
+                halfway.sendmail, 'side_effect',
+                smtplib.SMTPServerDisconnected)
+            smtp_connect.side_effect = [halfway, fresh]
+            connection = utils.EmailConnection(self.settings, imap=False)
+            failed = connection.submit('a@b', ['c@d'], broken())
+            connection.sendmail('a@b', ['c@d'], 'message')
+        self.assertIsInstance(failed.exception(), OSError)
+        fresh.sendmail.assert_called_once_with('a@b', ['c@d'], 'message')
+
+
+class TestMailboxWaiter(unittest.TestCase):
+    """Tests for IDLE detection and the polling fallback."""
+
+    def setUp(self):
+        self.settings = utils.Settings()
+        self.settings.POLL_MIN_INTERVAL = 1
+        self.settings.POLL_MAX_INTERVAL = 8
+        self.settings.POLL_BUDGET = 3
+        self.waiter = utils.MailboxWaiter(self.settings)
+        self.imap = mock.Mock(capabilities=('IMAP4REV1',))
+        self.imap.response.return_value = ('EXISTS', [None])
+
+    def test_idle_detection(self):
+        """IDLE is used only if the server advertises it."""
+        self.waiter.attach(self.imap)
+        self.assertFalse(self.waiter.use_idle)
+        self.imap.capabilities += ('IDLE',)
+        self.waiter.attach(self.imap)
+        self.waiter.wait(self.imap, busy=True)
+        self.imap.idle.assert_called_once_with(timeout=90)
+
+    def test_missed_exists(self):
+        """New mail announced outside IDLE ends the wait at once."""
+        self.imap.capabilities += ('IDLE',)
+        self.waiter.attach(self.imap)
+        self.imap.response.return_value = ('EXISTS', [b'7'])
+        self.assertEqual(self.waiter.wait(self.imap, busy=True),
+                         ('OK', [b'7']))
+        self.imap.idle.assert_not_called()
+
+        # Announced while IDLE starts
+        self.waiter.idle_recheck = 0.01
+        self.imap.response.side_effect = [('EXISTS', [None]),
+                                          ('EXISTS', [b'8'])]
+        idle_ended = threading.Event()
+        self.imap._end_idle.side_effect = idle_ended.set
+        self.imap.idle.side_effect = lambda timeout: (
+            idle_ended.wait(5), ('OK', [b'IDLE terminated']))[1]
+        self.assertEqual(self.waiter.wait(self.imap, busy=True),
+                         ('OK', [b'8']))
+
+    def test_backoff(self):
+        """Polls are fast while busy and back off while idle."""
+        intervals = [self.waiter.next_interval(busy)
+                     for busy in (True, False, False, False, False, True)]
+        self.assertEqual(intervals, [1, 2, 4, 8, 8, 1])
+
+    def test_budget(self):
+        """No more than POLL_BUDGET polls are made per minute."""
+        now = utils.time.monotonic()
+        self.assertEqual(self.waiter.budget_delay(), 0)
+        self.waiter._polls.extend([now - 70, now - 30, now - 20, now - 10])
+        self.assertAlmostEqual(self.waiter.budget_delay(), 30, places=0)
+        self.assertEqual(len(self.waiter._polls), 3)
+
+
+class TestReplyWatcher(unittest.TestCase):
+    """Tests for routing replies to waiting requests."""
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, 'imap_connect')
+        self.imap = patcher.start().return_value
+        self.imap.capabilities = ('IMAP4REV1', 'IDLE')
+        self.imap.response.return_value = ('EXISTS', [None])
+        self.addCleanup(patcher.stop)
+        # Messages 1 to 6 predate the watcher
+        self.messages = {6: utils.pack('a@b', ['c@d'], '[MailTunnel] old',
+                                       b'old')}
+        self.mailbox(self.messages)
+        self.watcher = utils.ReplyWatcher(utils.Settings())
+
+    def mailbox(self, messages):
+        """Answer UID FETCH from a {uid: message} dictionary.
+
+        Fetching a full message marks it as seen.
+        """
+        def uid(command, *args):
+            self.assertEqual(command, 'fetch')
+            uids = []
+            for part in args[0].split(','):
+                if part == '*':
+                    uids.append(max(messages))
+                elif part.endswith(':*'):
+                    start = int(part[:-2])
+                    uids += [uid for uid in messages if uid >= start] or \
+                        [max(messages)]
+                else:
+                    uids.append(int(part))
+            data = []
+            for uid in uids:
+                message = messages[uid]
+                if args[1] == '(UID)':
+                    data.append(b'1 (UID %d)' % uid)
+                    continue
+                if 'HEADER.FIELDS' in args[1]:
+                    literal = 'Subject: {}\r\n{}: {}\r\n\r\n'.format(
+                        message['subject'], utils.CORRELATION_HEADER,
+                        message[utils.CORRELATION_HEADER]).encode()
+                else:
+                    literal = messages.pop(uid).as_bytes()
+                data += [(b'1 (UID %d {0}' % uid, literal), b')']
+            return 'OK', data
+        self.imap.uid.side_effect = uid
+
+    def reply(self, correlation_id, data):
+        return utils.pack('a@b', ['c@d'], 'Re: [MailTunnel] x', data,
+                          headers={utils.CORRELATION_HEADER: correlation_id})
+
+    def test_routing(self):
+        """Each reply goes to its own waiter, without searching."""
+        self.assertEqual(self.watcher.index.next_uid, 7)
+        first = self.watcher.expect('one')
+        second = self.watcher.expect('two')
+        self.messages.update({
+            # The request itself, when both ends share the mailbox
+            7: utils.pack('a@b', ['c@d'], '[MailTunnel] x', b'request',
+                          headers={utils.CORRELATION_HEADER: 'one'}),
+            8: self.reply('two', b'2'),
+            9: self.reply('one', b'1'),
+            10: self.reply('other', b'x'),
+        })
+        self.watcher.poll()
+
+        self.assertEqual(utils.unpack(first.result(0)), b'1')
+        self.assertEqual(utils.unpack(second.result(0)), b'2')
+        self.assertEqual(self.watcher.index.next_uid, 11)
+
+        # Only new messages are looked at on the next wakeup
+        third = self.watcher.expect('three')
+        self.messages[11] = self.reply('three', b'3')
+        self.imap.uid.reset_mock()
+        self.watcher.poll()
+        self.assertEqual(utils.unpack(third.result(0)), b'3')
+        self.assertEqual(self.imap.uid.call_args_list[0][0][1], '11:*')
+
+        # The unclaimed reply is not fetched again
+        self.watcher.expect('four')
+        self.imap.uid.reset_mock()
+        self.watcher.poll()
+        self.assertEqual(self.imap.uid.call_count, 1)
+
+    def test_fetch(self):
+        """The remote picks up unseen requests, then only new ones."""
+        with mock.patch.object(utils, 'smtp_connect'):
+            connection = utils.EmailConnection(utils.Settings())
+        uid = self.imap.uid.side_effect
+        self.imap.uid.side_effect = lambda command, *args: (
+            ('OK', [b'6']) if command == 'search' else uid(command, *args))
+
+        self.assertEqual(utils.unpack(connection.fetch('[mailtunnel]')),
+                         b'old')
+        self.imap.idle.assert_not_called()
+        self.imap.idle.return_value = ('OK', [b'EXISTS'])
+        self.messages[7] = utils.pack('a@b', ['c@d'], 'Re: [MailTunnel] a',
+                                      b'reply')
+        self.messages[8] = utils.pack('a@b', ['c@d'], '[MailTunnel] a', b'a')
+        self.assertEqual(utils.unpack(connection.fetch('[mailtunnel]')),
+                         b'a')
+
+    def test_housekeeping(self):
+        """Processed emails are moved away or expunged in batches."""
+        settings = utils.Settings()
+        settings.HOUSEKEEPING_BATCH = 2
+        housekeeper = utils.Housekeeper(settings)
+        imap = mock.Mock(capabilities=('IMAP4REV1', 'UIDPLUS'))
+        imap.uid.return_value = ('OK', [None])
+
+        housekeeper.processed([7])
+        housekeeper.sweep(imap)
+        imap.uid.assert_not_called()
+        housekeeper.processed([9])
+        housekeeper.sweep(imap)
+        self.assertEqual(imap.uid.call_args_list, [
+            mock.call('store', '7,9', '+FLAGS.SILENT', r'(\Deleted)'),
+            mock.call('expunge', '7,9')])
+
+        imap.reset_mock()
+        imap.capabilities = ('IMAP4REV1',)
+        housekeeper.processed([8])
+        housekeeper.sweep(imap, force=True)
+        imap.uid.assert_called_once_with('store', '8', '+FLAGS.SILENT',
+                                         r'(\Deleted)')
+        imap.expunge.assert_not_called()
+
+        settings.ARCHIVE_FOLDER = 'Tunnel/Done'
+        housekeeper = utils.Housekeeper(settings)
+        imap.reset_mock()
+        imap.capabilities = ('IMAP4REV1', 'MOVE')
+        housekeeper.processed([10, 11])
+        housekeeper.sweep(imap)
+        imap.uid.assert_called_once_with('move', '10,11', 'Tunnel/Done')
+
+
+class TestRequestBatcher(unittest.TestCase):
+    """Tests for sending several requests in one email."""
+
+    def test_batch(self):
+        """Queued requests share one email and get their own response."""
+        pool = mock.MagicMock(size=1)
+        connection = pool.connection.return_value.__enter__.return_value
+        sent = threading.Event()
+        connection.send_many.side_effect = \
+            lambda *args, **kwargs: sent.set()
+        watcher = mock.Mock()
+
+        batcher = utils.RequestBatcher(
+            utils.AccountSet([utils.Account(pool, watcher)]))
+        first, second = batcher.submit(b'one'), batcher.submit(b'two')
+        batcher.start()
+        self.assertTrue(sent.wait(1))
+
+        (attachments, subject, _), kwargs = connection.send_many.call_args
+        self.assertEqual([data for _, data in attachments],
+                         [b'one', b'two'])
+        (correlation_id, on_reply, _), _ = watcher.watch.call_args
+        self.assertEqual(kwargs['headers'],
+                         {utils.CORRELATION_HEADER: correlation_id})
+
+        on_reply(b''.join(utils.iter_pack_many(
+            'a@b', ['c@d'], 'Re: ' + subject,
+            [(name, data.upper()) for name, data in attachments])))
+        self.assertEqual(b''.join(first.result(1)), b'ONE')
+        self.assertEqual(b''.join(second.result(1)), b'TWO')
+        watcher.discard.assert_called_once_with(correlation_id)
+
+    def test_priority(self):
+        """Requests waiting for a free account go in order of priority."""
+        pool = mock.MagicMock(size=1)
+        connection = pool.connection.return_value.__enter__.return_value
+        sent, release = [], threading.Event()
+
+        def send_many(attachments, *args, **kwargs):
+            sent.extend(data for _, data in attachments)
+            release.wait(5)
+        connection.send_many.side_effect = send_many
+
+        batcher = utils.RequestBatcher(
+            utils.AccountSet([utils.Account(pool, mock.Mock())]),
+            max_bytes=1)
+        image = b'GET http://a.com/%d.png HTTP/1.1\r\n\r\n'
+        batcher.submit(image % 1)
+        batcher.start()
+        while not sent:
+            time.sleep(0.01)
+        batcher.submit(image % 2)
+        batcher.submit(b'GET http://a.com/ HTTP/1.1\r\n'
+                       b'Accept: text/html\r\n\r\n')
+        release.set()
+        while len(sent) < 3:
+            time.sleep(0.01)
+        self.assertEqual([data.split()[1] for data in sent],
+                         [b'http://a.com/1.png', b'http://a.com/',
+                          b'http://a.com/2.png'])
+
+    def test_push(self):
+        """Responses pushed along with a page go to `on_push`."""
+        pool = mock.MagicMock(size=1)
+        connection = pool.connection.return_value.__enter__.return_value
+        sent = threading.Event()
+        connection.send_many.side_effect = \
+            lambda *args, **kwargs: sent.set()
+        watcher = mock.Mock()
+        pushed = []
+        stored = threading.Event()
+
+        def on_push(url, page_request, chunks):
+            pushed.append((url, page_request, b''.join(chunks)))
+            stored.set()
+
+        batcher = utils.RequestBatcher(
+            utils.AccountSet([utils.Account(pool, watcher)]))
+        batcher.on_push = on_push
+        page = batcher.submit(b'page')
+        batcher.start()
+        self.assertTrue(sent.wait(1))
+        (attachments, subject, _), _ = connection.send_many.call_args
+        (correlation_id, on_reply, _), _ = watcher.watch.call_args
+        name = attachments[0][0]
+
+        on_reply(b''.join(utils.iter_pack_many(
+            'a@b', ['c@d'], 'Re: ' + subject,
+            [(name, b'PAGE'),
+             ('pushed', b'STYLE', {utils.PUSH_HEADER: 'http://a/s.css',
+                                   utils.PUSH_FOR_HEADER: name})])))
+        self.assertEqual(b''.join(page.result(1)), b'PAGE')
+        self.assertTrue(stored.wait(1))
+        self.assertEqual(pushed, [('http://a/s.css', b'page', b'STYLE')])
+        watcher.discard.assert_called_once_with(correlation_id)
+
+    def test_failover(self):
+        """A batch that can't be sent goes out from the next account."""
+        accounts = []
+        for _ in range(2):
+            pool = mock.MagicMock(size=1)
+            accounts.append(utils.Account(pool, mock.Mock()))
+        throttled = accounts[0].pool.connection.return_value.__enter__\
+            .return_value
+        throttled.send_many.side_effect = smtplib.SMTPDataError(
+            450, 'Too many messages')
+        account_set = utils.AccountSet(accounts)
+        account_set.candidates = lambda: list(accounts)
+
+        batcher = utils.RequestBatcher(account_set)
+        batcher._send([(b'one', Future())])
+        connection = accounts[1].pool.connection.return_value.__enter__\
+            .return_value
+        connection.send_many.assert_called_once()
+        accounts[0].watcher.discard.assert_called_once()
+        self.assertEqual([account.outstanding for account in accounts],
+                         [0, 1])
+        self.assertGreater(accounts[0].resting_until, time.monotonic())
+
+
+class TestAccountSet(unittest.TestCase):
+    """Tests for spreading requests over several email accounts."""
+
+    def accounts(self, *weights):
+        return [utils.Account(mock.Mock(size=1), mock.Mock(), weight)
+                for weight in weights]
+
+    def test_least_outstanding(self):
+        """Requests go to the account with the least outstanding work."""
+        accounts = self.accounts(1, 2)
+        account_set = utils.AccountSet(accounts)
+        chosen = []
+        for n in range(6):
+            account = account_set.choose()
+            account.begin(n)
+            chosen.append(accounts.index(account))
+        self.assertEqual(sorted(chosen), [0, 0, 1, 1, 1, 1])
+
+        account_set.rest(accounts[1])
+        self.assertIs(account_set.choose(), accounts[0])
+
+    def test_round_robin(self):
+        """Accounts take turns in proportion to their weights."""
+        accounts = self.accounts(1, 3)
+        account_set = utils.AccountSet(accounts, 'round-robin')
+        chosen = [accounts.index(account_set.choose()) for _ in range(8)]
+        self.assertEqual(chosen.count(1), 6)
+
+    def test_account_settings(self):
+        """ACCOUNTS_FILE adds accounts that inherit the main settings."""
+        settings = utils.Settings()
+        settings.SMTP_USER = settings.IMAP_USER = 'main@example.com'
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as accounts:
+            json.dump([{'smtp_user': 'two@example.com',
+                        'SMTP_PASSWORD': 'secret', 'ACCOUNT_WEIGHT': 2}],
+                      accounts)
+            accounts.flush()
+            settings.ACCOUNTS_FILE = accounts.name
+            main, second = utils.account_settings(settings)
+
+            self.assertIs(main, settings)
+            self.assertEqual((second.IMAP_USER, second.FROM_EMAIL,
+                              second.IMAP_PASSWORD, second.ACCOUNT_WEIGHT),
+                             ('two@example.com', 'two@example.com',
+                              'secret', 2))
+            self.assertEqual(second.SMTP_SERVER, settings.SMTP_SERVER)
+
+            accounts.seek(0)
+            json.dump([{'SMTP_USR': 'typo'}], accounts)
+            accounts.truncate()
+            accounts.flush()
+            with self.assertRaises(ValueError):
+                utils.account_settings(settings)
+
+
+class TestPriority(unittest.TestCase):
+    """Tests for sending the most urgent requests first."""
+
+    def test_rank(self):
+        """Requests are ranked by their headers, then their URL."""
+        def rank(url, *headers):
+            return priority.rank(b'\r\n'.join(
+                [b'GET %s HTTP/1.1' % url] + list(headers) + [b'', b'']))
+
+        self.assertEqual(rank(b'http://a.com/', b'Accept: text/html,*/*'),
+                         priority.DOCUMENT)
+        self.assertEqual(rank(b'http://a.com/x', b'Sec-Fetch-Dest: style',
+                              b'Accept: text/html'), priority.SUBRESOURCE)
+        self.assertEqual(rank(b'http://a.com/logo.png?v=2',
+                              b'Accept: */*'), priority.IMAGE)
+        self.assertEqual(rank(b'http://a.com/x', b'Accept: image/webp'),
+                         priority.IMAGE)
+        self.assertEqual(rank(b'http://a.com/film', b'Range: bytes=0-'),
+                         priority.MEDIA)
+        self.assertEqual(rank(b'http://a.com/api'), priority.SUBRESOURCE)
+        self.assertEqual(priority.rank(b'one'), priority.SUBRESOURCE)
+
+    def test_fair_queue(self):
+        """Better ranks go first, then each client takes its turn."""
+        fair = priority.FairQueue()
+        for rank, client, item in [
+                (priority.IMAGE, 'a', 'a1'), (priority.IMAGE, 'a', 'a2'),
+                (priority.IMAGE, 'a', 'a3'), (priority.IMAGE, 'b', 'b1'),
+                (priority.DOCUMENT, 'b', 'page')]:
+            fair.put((rank, client, item))
+        self.assertEqual([fair.get_nowait() for _ in range(5)],
+                         ['page', 'a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(fair._turns, {})
+        fair.put((priority.IMAGE, 'a', 'a4'))
+        fair.put((priority.IMAGE, 'b', 'b2'))
+        fair.put((priority.IMAGE, 'a', 'a5'))
+        self.assertEqual([fair.get_nowait() for _ in range(3)],
+                         ['a4', 'b2', 'a5'])
+
+    def test_reply_order(self):
+        """The most urgent responses come first in the reply."""
+        connection = mock.Mock()
+        replies = []
+        connection.reply_many.side_effect = sent_by(
+            lambda attachments: replies.append(
+                [(name, b''.join(data)) for name, data, _ in attachments]))
+        futures = [Future(), Future()]
+        remote.reply_when_done(connection, 'email', ['image', 'page'],
+                               futures, ranks=[priority.IMAGE,
+                                               priority.DOCUMENT])
+        for future in futures:
+            future.set_result(iter([b'x']))
+        self.assertEqual([name for name, _ in replies[0]], ['page', 'image'])
+
+
+class TestRemote(unittest.TestCase):
+    """Tests for the remote forwarding loop."""
+
+    def test_reply_when_done(self):
+        """A batch is answered once, after its last request finishes."""
+        connection = mock.Mock()
+        replies = []
+        connection.reply_many.side_effect = sent_by(
+            lambda attachments: replies.append(
+                [(name, b''.join(data)) for name, data, _ in attachments]))
+        futures = [Future(), Future()]
+        remote.reply_when_done(connection, 'email', ['a', 'b'], futures)
+
+        futures[1].set_result(iter([b'B']))
+        connection.reply_many.assert_not_called()
+        futures[0].set_result(None)
+        self.assertEqual(replies, [
+            [('a', utils.error_response(502, 'Bad Gateway')), ('b', b'B')]])
+
+    def test_chunked_reply(self):
+        """Large responses continue in further emails."""
+        connection = mock.Mock()
+        emails = []
+        connection.reply_many.side_effect = sent_by(
+            lambda attachments: emails.append(b''.join(utils.iter_pack_many(
+                'a@b', ['c@d'], 'Re: x', attachments))))
+        future = Future()
+        future.set_result(iter([b'0123456789'] * 3))
+        remote.reply_when_done(connection, 'email', ['big'], [future],
+                               max_email_bytes=12)
+        self.assertEqual(len(emails), 3)
+
+        # Emails may arrive in any order
+        response = utils.ChunkedResponse()
+        for raw in reversed(emails):
+            _, attachments = utils.split_message(raw)
+            more = any(a.headers[utils.MORE_HEADER] for a in attachments)
+            response.add(int(attachments[0].headers[utils.SEQ_HEADER]),
+                         attachments[0], more)
+        self.assertTrue(response.complete)
+        self.assertEqual(b''.join(response), b'0123456789' * 3)
+
+    def test_broken_body(self):
+        """An origin failing halfway through a body spoils only its own
+        response."""
+        def body(chunk_size):
+            yield b'part'
+            raise requests.exceptions.ChunkedEncodingError('dropped')
+
+        response = mock.Mock(status_code=200, reason='OK', raw=mock.Mock(
+            headers={'Content-Type': 'text/plain'}))
+        response.iter_content.side_effect = body
+        with mock.patch.object(utils.Forwarder, 'forward',
+                               return_value=response):
+            self.assertIsNone(remote.forward(
+                b'GET http://a.com/ HTTP/1.1\r\nHost: a.com\r\n\r\n'))
+
+        # Bodies failing as the reply is written are cut short alone
+        connection = mock.Mock()
+        replies = []
+        connection.reply_many.side_effect = sent_by(
+            lambda attachments: replies.append(
+                [(name, b''.join(data)) for name, data, _ in attachments]))
+        futures = [Future(), Future()]
+        futures[0].set_result(body(None))
+        futures[1].set_result(iter([b'B']))
+        remote.reply_when_done(connection, 'email', ['a', 'b'], futures)
+        self.assertEqual(replies, [[('a', b'part'), ('b', b'B')]])
+
+    def test_have_header(self):
+        """The cache's digest header never reaches the origin server."""
+        forwarded = []
+
+        def forward(forwarder, session=None, stream=False):
+            forwarded.append(forwarder.headers[cache.HAVE_HEADER])
+            return mock.Mock(status_code=200, reason='OK',
+                             raw=mock.Mock(headers={'A': 'b'}),
+                             iter_content=lambda size: iter([b'body']))
+
+        with mock.patch.object(utils.Forwarder, 'forward', autospec=True,
+                               side_effect=forward):
+            response = remote.forward(cache.add_header(
+                b'GET http://a.com/ HTTP/1.1\r\nHost: a.com\r\n\r\n',
+                cache.HAVE_HEADER, 'digest'))
+        self.assertEqual(b''.join(response)[-4:], b'body')
+        self.assertEqual(forwarded, [None])
+
+    def test_prefetch(self):
+        """Same-origin subresources of HTML pages are pushed."""
+        html = b'<html><head><link rel="stylesheet" href="/s.css">' \
+               b'<script src="http://other.com/x.js"></script></head>' \
+               b'<body><img src="logo.png#top"><a href="/next">next</a>' \
+               b'</body></html>'
+        responses = {
+            'http://a.com/': b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: text/html\r\n\r\n' + html,
+            'http://a.com/s.css': b'HTTP/1.1 200 OK\r\n\r\nSTYLE',
+            'http://a.com/logo.png': b'HTTP/1.1 404 Not Found\r\n\r\n',
+        }
+        requests = []
+
+        def forward(raw_data, *args, **kwargs):
+            requests.append(raw_data)
+            return iter([responses[utils.Forwarder(raw_data).path]])
+
+        pushed = []
+        with mock.patch.object(remote, 'forward', side_effect=forward), \
+                ThreadPoolExecutor(2) as prefetchers:
+            page = remote.forward_and_prefetch(
+                'page', b'GET http://a.com/ HTTP/1.1\r\nHost: a.com\r\n'
+                        b'User-Agent: test\r\n\r\n', pushed, prefetchers)
+            self.assertEqual(b''.join(page), responses['http://a.com/'])
+        self.assertEqual(len(requests), 3)
+        self.assertIn(b'User-Agent: test\r\n', requests[1])
+        self.assertEqual([(name, url, b''.join(chunks))
+                          for name, url, chunks in pushed],
+                         [('page', 'http://a.com/s.css',
+                           responses['http://a.com/s.css'])])
+
+    def test_session(self):
+        """CONNECT sessions relay bytes both ways until either end closes."""
+        echo = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(echo.close)
+
+        def serve_echo():
+            connection, _ = echo.accept()
+            with connection:
+                for data in iter(lambda: connection.recv(1024), b''):
+                    connection.sendall(data)
+        threading.Thread(target=serve_echo, daemon=True).start()
+
+        def to_local(frames, email_candidate):
+            for _, data, headers in frames:
+                local_end.receive(sessions.Frame.from_headers(headers, data))
+
+        connection = mock.Mock()
+        connection.reply_many.side_effect = to_local
+        relay = remote.SessionRelay(connection, window=0.01,
+                                    max_bytes=2 ** 16)
+
+        def to_remote(frames):
+            message = email.message_from_bytes(b''.join(
+                utils.iter_pack_many('a@b', ['c@d'], 'x', frames)))
+            relay.deliver(message, sessions.frames_of(message))
+
+        local_end = sessions.Session('s1', to_remote, window=0.01)
+        client, proxy_side = socket.socketpair()
+        session = threading.Thread(target=local_end.run, args=(
+            proxy_side, {sessions.CONNECT_HEADER: '127.0.0.1:%d'
+                         % echo.getsockname()[1]}))
+        session.start()
+
+        client.sendall(b'hello')
+        self.assertEqual(client.recv(1024), b'hello')
+        client.close()
+        session.join(5)
+        self.assertFalse(session.is_alive())
+        for _ in range(100):
+            if not relay._sessions:
+                break
+            time.sleep(0.01)
+        self.assertEqual(relay._sessions, {})
+
+    def test_early_frames(self):
+        """Frames overtaking their session's first one are kept for it."""
+        def frame(seq, data, connect=None):
+            return sessions.Frame('s1', seq, data, connect)
+
+        with mock.patch.object(remote.SessionRelay, '_relay'):
+            relay = remote.SessionRelay(mock.Mock(), 0.01, 2 ** 16,
+                                        max_early_bytes=3)
+            relay.deliver(None, [frame(2, b'c'), frame(1, b'b'),
+                                 frame(3, b'dd')])
+            relay.deliver(None, [frame(0, b'a', '127.0.0.1:1')])
+            session = relay._sessions['s1']
+            self.assertEqual([session._incoming.get_nowait()
+                              for _ in range(2)], [b'a', b'b'])
+            self.assertEqual(session._incoming.get_nowait(), b'c')
+            self.assertTrue(session._incoming.empty())
+
+            relay = remote.SessionRelay(mock.Mock(), 0.01, 2 ** 16,
+                                        early_timeout=0)
+            relay.deliver(None, [frame(1, b'b')])
+            time.sleep(0.01)
+            relay.deliver(None, [frame(0, b'a', '127.0.0.1:1')])
+            self.assertEqual(relay._early, {})
+            self.assertEqual(relay._early_bytes, 0)
+
+    def test_closed_sessions(self):
+        """Only the latest closed sessions are remembered."""
+        relay = remote.SessionRelay(mock.Mock(), 0.01, 2 ** 16,
+                                    max_closed=2)
+        for session_id in ('s1', 's2', 's3'):
+            relay._relay(mock.Mock(id=session_id), 'no port')
+        self.assertEqual(list(relay._closed), ['s2', 's3'])
+
+
+class TestTranscode(unittest.TestCase):
+    """Tests for shrinking responses on the remote."""
+
+    def setUp(self):
+        self.settings = utils.Settings()
+        self.settings.TRANSCODE_MEDIA_MAX_BYTES = 100
+        self.transcoder = transcode.Transcoder(self.settings)
+
+    def test_minify(self):
+        """Minifying keeps strings, preformatted text and line breaks."""
+        self.assertEqual(
+            transcode.minify_css(b'/* top */\na > b ,  c {\n  color : red ;'
+                                 b'\n  content: "a  /* b */";\n}\n'
+                                 b'a:hover .x { margin: 0 auto }'),
+            b'a>b,c{color :red;content:"a  /* b */";}'
+            b'a:hover .x{margin:0 auto}')
+        self.assertEqual(
+            transcode.minify_js(b'  // note\n  var a = 1\n\n  f(a)\n'),
+            b'var a = 1\nf(a)')
+        for script in (b'var a = `x\n\n  y`\n',
+                       b'x = 1\n/* a\n// b */ y = 2'):
+            self.assertEqual(transcode.minify_js(script), script)
+        self.assertEqual(
+            transcode.minify_html(
+                b'<html>\n  <!-- note -->\n  <p>a    b</p>\n'
+                b'  <pre>  x\n\n  y</pre>\n'
+                b'  <style> p { color: red } </style>\n</html>\n'),
+            b'<html>\n<p>a b</p>\n<pre>  x\n\n  y</pre>\n'
+            b'<style>p{color:red}</style>\n</html>\n')
+        self.assertEqual(
+            transcode.minify_html(
+                b'<input value="a   b" title=\'a\n   b > c\'>  x\n'
+                b'<script type="text/template">\n  // a\n</script>\n'
+                b'<script type="module">\n  // a\n  f()\n</script>'),
+            b'<input value="a   b" title=\'a\n   b > c\'> x\n'
+            b'<script type="text/template">\n  // a\n</script>\n'
+            b'<script type="module">f()</script>')
+
+    def test_transcode(self):
+        """Rewritten responses get the headers of their new body."""
+        head = (b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/html; charset=utf-8\r\n'
+                b'Connection: close\r\n\r\n')
+        body = b'<p>\n    ' + b'x ' * 20 + b'   </p>\n'
+        new_head, new_body = self.transcoder.transcode(
+            head, iter([body[:10], body[10:]]))
+        new_body = b''.join(new_body)
+        _, headers = cache.parse_response_head(new_head)
+        self.assertLess(len(new_body), len(body))
+        self.assertEqual(headers['Content-Length'], str(len(new_body)))
+        self.assertEqual(headers['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(headers[transcode.TRANSCODED_HEADER], str(len(body)))
+
+        # Other responses are relayed untouched
+        for head in (b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: application/zip\r\n\r\n',
+                     b'HTTP/1.1 404 Not Found\r\n'
+                     b'Content-Type: text/html\r\n\r\n'):
+            new_head, new_body = self.transcoder.transcode(head, iter([body]))
+            self.assertEqual((new_head, b''.join(new_body)), (head, body))
+
+    def test_media(self):
+        """Audio and video over the limit are replaced by a notice."""
+        head = b'HTTP/1.1 200 OK\r\nContent-Type: video/mp4\r\n\r\n'
+        new_head, body = self.transcoder.transcode(head, iter([b'v' * 60]))
+        self.assertEqual((new_head, b''.join(body)), (head, b'v' * 60))
+
+        chunks = iter([b'v' * 60] * 5)
+        new_head, body = self.transcoder.transcode(head, chunks)
+        status, headers = cache.parse_response_head(new_head)
+        self.assertEqual(headers.get_content_type(), 'text/plain')
+        self.assertIn('no-store', cache.parse_cache_control(headers))
+        self.assertIn(b'video/mp4', b''.join(body))
+        # The rest of the video isn't downloaded
+        self.assertEqual(len(list(chunks)), 3)
+
+    @unittest.skipUnless(transcode.Image, "Pillow is not installed")
+    def test_image(self):
+        """Images are scaled down and re-encoded."""
+        from io import BytesIO
+        output = BytesIO()
+        transcode.Image.effect_noise((400, 300), 64).convert('RGB').save(
+            output, 'PNG')
+        head = b'HTTP/1.1 200 OK\r\nContent-Type: image/png\r\n\r\n'
+        self.settings.TRANSCODE_IMAGE_MAX_SIZE = 100
+        new_head, body = transcode.Transcoder(self.settings).transcode(
+            head, iter([output.getvalue()]))
+        _, headers = cache.parse_response_head(new_head)
+        self.assertEqual(headers['Content-Type'], 'image/jpeg')
+        with transcode.Image.open(BytesIO(b''.join(body))) as image:
+            self.assertEqual(image.size, (100, 75))
+
+
+class TestHeaderTable(unittest.TestCase):
+    """Tests for packing the heads of tunneled HTTP messages."""
+
+    request = (b'GET http://a.com/s.css HTTP/1.1\r\nHost: a.com\r\n'
+               b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) Firefox/128.0'
+               b'\r\nAccept: text/css,*/*;q=0.1\r\n'
+               b'Cookie: session=0123456789abcdef\r\n'
+               b'If-None-Match: "v1"\r\n\r\nbody')
+
+    def setUp(self):
+        self.local = headertable.HeaderTables()
+        self.remote = headertable.HeaderTables()
+        self.to_remote = self.local.peer(self.remote.email_headers())
+        self.to_local = self.remote.peer(self.local.email_headers())
+
+    def reply(self):
+        """Acknowledge what the remote has received"""
+        self.local.peer(self.remote.email_headers(self.to_local))
+
+    def test_round_trip(self):
+        """Lines are sent in full until the other side has them."""
+        first = self.to_remote.pack(self.request)
+        self.assertTrue(first.startswith(headertable.MAGIC))
+        self.assertLess(len(first), len(self.request))
+        self.assertEqual(self.to_local.unpack(first), self.request)
+        # Not acknowledged yet
+        self.assertEqual(self.to_remote.pack(self.request), first)
+
+        self.reply()
+        packed = self.to_remote.pack(self.request)
+        self.assertLess(len(packed), len(first) // 2)
+        self.assertEqual(self.to_local.unpack(packed), self.request)
+        self.assertEqual(b''.join(self.to_local.unpack_stream(
+            packed[i:i + 1] for i in range(len(packed)))), self.request)
+
+        # Heads that wouldn't come back the same are sent as they are
+        for raw in (b'GET / HTTP/1.1\r\nHost:a.com\r\n\r\n', b'partial'):
+            self.assertEqual(self.to_remote.pack(raw), raw)
+
+    def test_lost_email(self):
+        """Lost and reordered emails don't desynchronize the tables."""
+        lost = self.to_remote.pack(self.request)
+        other = self.request.replace(b'Firefox/128.0', b'Firefox/129.0')
+        late = self.to_remote.pack(other)
+        self.to_local.unpack(late)
+        self.reply()
+        # The lost email's lines that the remote has seen are indexed
+        packed = self.to_remote.pack(self.request)
+        self.assertLess(len(packed), len(lost))
+        self.assertEqual(self.to_local.unpack(packed), self.request)
+
+        # Emails overtaken by others adding many entries still unpack
+        def lines(numbers):
+            return b'GET / HTTP/1.1\r\n' + b''.join(
+                b'X-Line: %d\r\n' % n for n in numbers) + b'\r\n'
+        self.to_local.unpack(self.to_remote.pack(lines(range(250))))
+        for _ in range(4):
+            self.reply()
+        overtaken = self.to_remote.pack(self.request)
+        slack = headertable.MAX_ENTRIES - headertable.REFERENCED_ENTRIES
+        self.to_local.unpack(self.to_remote.pack(
+            lines(range(1000, 1000 + slack))))
+        self.assertEqual(self.to_local.unpack(overtaken), self.request)
+
+        # A restarted remote is packed for from scratch
+        restarted = headertable.HeaderTables()
+        to_restarted = self.local.peer(restarted.email_headers())
+        to_local = restarted.peer(self.local.email_headers())
+        with self.assertRaises(ValueError):
+            to_local.unpack(packed)
+        self.assertEqual(
+            to_local.unpack(to_restarted.pack(self.request)), self.request)
+
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for the local HTTP response cache."""
+
+    request = b'GET http://example.com/style.css HTTP/1.1\r\n' \
+              b'Host: example.com\r\n\r\n'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings = utils.Settings()
+        self.settings.CACHE_DIR = directory.name
+        self.cache = cache.ResponseCache(self.settings)
+        self.fetched = []
+
+    def fetch(self, *responses):
+        """Fake tunnel answering with `responses` in turn"""
+        responses = list(responses)
+
+        def fetch(raw_request):
+            self.fetched.append(raw_request)
+            return iter([responses.pop(0)])
+        return fetch
+
+    def test_freshness(self):
+        """Freshness follows Cache-Control, Expires and Last-Modified."""
+        def lifetime(head):
+            _, headers = cache.parse_response_head(
+                b'HTTP/1.1 200 OK\r\n' + head + b'\r\n')
+            return cache.freshness_lifetime(headers, now=0)
+
+        self.assertEqual(lifetime(b'Cache-Control: max-age=60\r\n'), 60)
+        self.assertEqual(lifetime(b'Cache-Control: no-cache, max-age=60'
+                                  b'\r\n'), 0)
+        self.assertEqual(lifetime(
+            b'Date: Mon, 01 Jan 2024 00:00:00 GMT\r\n'
+            b'Expires: Mon, 01 Jan 2024 01:00:00 GMT\r\n'), 3600)
+        self.assertEqual(lifetime(
+            b'Date: Mon, 11 Jan 2024 00:00:00 GMT\r\n'
+            b'Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT\r\n'), 86400)
+        self.assertEqual(lifetime(b''), 0)
+
+    def test_hit(self):
+        """Fresh responses are served without touching the tunnel."""
+        fetch = self.fetch(b'HTTP/1.1 200 OK\r\n'
+                           b'Cache-Control: max-age=60\r\n\r\nbody')
+        first = b''.join(self.cache.respond(self.request, fetch))
+        second = b''.join(self.cache.respond(self.request, fetch))
+        self.assertEqual(len(self.fetched), 1)
+        self.assertTrue(first.endswith(b'\r\n\r\nbody'))
+        self.assertTrue(second.startswith(b'HTTP/1.1 200 OK\r\nAge: 0\r\n'))
+        self.assertTrue(second.endswith(b'\r\n\r\nbody'))
+
+        # The entry survives in the on-disk store
+        reopened = cache.ResponseCache(self.settings)
+        b''.join(reopened.respond(self.request, fetch))
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_revalidation(self):
+        """Stale responses are revalidated with their ETag."""
+        fetch = self.fetch(
+            b'HTTP/1.1 200 OK\r\nETag: "v1"\r\n\r\nbody',
+            b'HTTP/1.1 304 Not Modified\r\nETag: "v1"\r\n\r\n')
+        b''.join(self.cache.respond(self.request, fetch))
+        response = b''.join(self.cache.respond(self.request, fetch))
+        self.assertIn(b'If-None-Match: "v1"\r\n', self.fetched[1])
+        self.assertIn(('%s: %s' % (cache.HAVE_HEADER, cache.body_digest(
+            b'body'))).encode('ascii'), self.fetched[1])
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(response.endswith(b'\r\n\r\nbody'))
+
+    def test_no_store(self):
+        """Responses marked no-store are never cached."""
+        response = b'HTTP/1.1 200 OK\r\n' \
+                   b'Cache-Control: no-store, max-age=60\r\n\r\nbody'
+        fetch = self.fetch(response, response)
+        for _ in range(2):
+            self.assertEqual(
+                b''.join(self.cache.respond(self.request, fetch)), response)
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_disk_eviction(self):
+        """The disk store is trimmed back to its size limit."""
+        store = cache.DiskStore(self.settings.CACHE_DIR, max_bytes=600)
+        for index in range(3):
+            key = 'http://example.com/%d' % index
+            store.put(cache.CacheEntry(
+                key, {}, b'HTTP/1.1 200 OK\r\n\r\n', b'x' * 200, 0, 60))
+            # Oldest first, whatever the file system's time resolution
+            os.utime(store._path(key), (index, index))
+        self.assertLessEqual(store.size, 600)
+        self.assertIsNone(store.get('http://example.com/0'))
+        self.assertIsNotNone(store.get('http://example.com/2'))
+
+    def test_upstream_revalidation(self):
+        """The remote answers with a 304 when the local copy is current."""
+        upstream = cache.UpstreamCache(2 ** 20, 2 ** 20)
+        responses = []
+
+        def origin(status, headers, body=b''):
+            response = mock.Mock(status_code=status, reason='OK',
+                                 headers=headers)
+            response.raw.headers = headers
+            response.iter_content.return_value = iter([body])
+            responses.append(response)
+
+        def forward(request):
+            forwarder = utils.Forwarder(request)
+            with mock.patch.object(utils.Forwarder, 'forward',
+                                   side_effect=lambda *a, **k:
+                                   responses.pop(0)):
+                chunks = b''.join(upstream.forward(forwarder))
+            return forwarder, chunks
+
+        origin(200, {'ETag': '"v1"'}, b'body')
+        _, first = forward(self.request)
+        self.assertTrue(first.endswith(b'\r\n\r\nbody'))
+
+        # The origin confirms the remote's copy, which is the local one
+        origin(304, {'ETag': '"v1"'})
+        have = cache.add_header(
+            self.request, cache.HAVE_HEADER, cache.body_digest(b'body'))
+        forwarder, second = forward(have)
+        self.assertEqual(forwarder.headers['If-None-Match'], '"v1"')
+        self.assertIsNone(forwarder.headers[cache.HAVE_HEADER])
+        self.assertEqual(second, b'HTTP/1.1 304 Not Modified\r\n'
+                                 b'ETag: "v1"\r\nConnection: close\r\n\r\n')
+
+        # Without validators, the body hash still avoids resending it
+        origin(200, {}, b'body')
+        _, third = forward(have.replace(b'style.css', b'other.css'))
+        self.assertTrue(third.startswith(b'HTTP/1.1 304 Not Modified'))
+
+        origin(200, {}, b'new body')
+        _, fourth = forward(have.replace(b'style.css', b'new.css'))
+        self.assertTrue(fourth.endswith(b'\r\n\r\nnew body'))
+
+        # Responses that can't be cached are relayed without buffering
+        read = []
+
+        def body():
+            for chunk in (b'no', b'store'):
+                read.append(chunk)
+                yield chunk
+        origin(200, {'Cache-Control': 'no-store'})
+        responses[-1].iter_content.return_value = body()
+        with mock.patch.object(utils.Forwarder, 'forward',
+                               return_value=responses.pop()):
+            chunks = upstream.forward(utils.Forwarder(self.request))
+        self.assertEqual(read, [])
+        self.assertTrue(b''.join(chunks).endswith(b'\r\n\r\nnostore'))
+
+    def test_delta(self):
+        """Changed bodies are sent as deltas against the local copy."""
+        old = b''.join(b'<li>Story %d</li>\n' % i for i in range(500))
+        new = old.replace(b'Story 250', b'Breaking news') + b'<p>end</p>'
+        patch = delta.encode(old, new)
+        self.assertLess(len(patch), len(new) // 10)
+        self.assertEqual(delta.apply(old, patch), new)
+        with self.assertRaises(ValueError):
+            delta.apply(old[:100], patch)
+
+        upstream = cache.UpstreamCache(2 ** 20, 2 ** 20)
+        bodies, relayed = [old, new], []
+
+        def fetch(raw_request):
+            self.fetched.append(raw_request)
+            response = mock.Mock(status_code=200, reason='OK',
+                                 headers={'ETag': '"%d"' % len(bodies)})
+            response.raw.headers = response.headers
+            response.iter_content.return_value = iter([bodies.pop(0)])
+            with mock.patch.object(utils.Forwarder, 'forward',
+                                   return_value=response):
+                chunks = list(upstream.forward(utils.Forwarder(raw_request)))
+            relayed.append(b''.join(chunks))
+            return chunks
+
+        b''.join(self.cache.respond(self.request, fetch))
+        response = b''.join(self.cache.respond(self.request, fetch))
+        self.assertTrue(response.endswith(b'\r\n\r\n' + new))
+        self.assertIn(cache.DELTA_HEADER.encode('ascii'), relayed[1])
+        self.assertLess(len(relayed[1]), len(new) // 10)
+        self.assertNotIn(cache.DELTA_HEADER.encode('ascii'), response)
+        self.assertEqual(self.cache.get(
+            'http://example.com/style.css').body, new)
+
+
+class TestCoalescer(unittest.TestCase):
+    """Tests for sharing replies between identical requests."""
+
+    request = TestResponseCache.request
+
+    def setUp(self):
+        self.coalescer = coalesce.Coalescer(max_bytes=10)
+        self.sent = []
+        self.release = threading.Event()
+
+    def send(self, raw_request):
+        """Fake tunnel answering once `release` is set"""
+        self.sent.append(raw_request)
+        self.assertTrue(self.release.wait(5))
+        return iter([b'HTTP/1.1 200 OK\r\n\r\n', b'body'])
+
+    def fetch_in_background(self, send):
+        """Fetch on another thread, once `send` has been called"""
+        result = Future()
+
+        def fetch():
+            try:
+                result.set_result(b''.join(
+                    self.coalescer.fetch(self.request, send)))
+            except Exception as err:
+                result.set_exception(err)
+        threading.Thread(target=fetch).start()
+        while not self.sent:
+            time.sleep(0.01)
+        return result
+
+    def test_key(self):
+        """Only identical requests a shared cache could answer match."""
+        key = coalesce.coalescing_key
+        self.assertEqual(key(self.request), key(self.request))
+        self.assertNotEqual(key(self.request), key(self.request.replace(
+            b'\r\n\r\n', b'\r\nAccept-Language: fr\r\n\r\n')))
+        self.assertIsNone(key(self.request.replace(b'GET', b'POST')))
+        self.assertIsNone(key(self.request.replace(
+            b'\r\n\r\n', b'\r\nAuthorization: Basic eA==\r\n\r\n')))
+        self.assertIsNone(key(self.request + b'body'))
+
+    def test_shared(self):
+        """Requests in flight share one reply; later ones send again."""
+        first = self.fetch_in_background(self.send)
+        second = self.coalescer.fetch(self.request, self.send)
+        self.release.set()
+        self.assertEqual(b''.join(second), b'HTTP/1.1 200 OK\r\n\r\nbody')
+        self.assertEqual(first.result(5), b'HTTP/1.1 200 OK\r\n\r\nbody')
+        self.assertEqual(len(self.sent), 1)
+
+        b''.join(self.coalescer.fetch(self.request, self.send))
+        self.assertEqual(len(self.sent), 2)
+
+    def test_failure(self):
+        """Requests sharing a reply that fails fail too."""
+        def send(raw_request):
+            self.sent.append(raw_request)
+            self.release.wait(5)
+            raise utils.EmailException('lost')
+
+        first = self.fetch_in_background(send)
+        second = self.coalescer.fetch(self.request, send)
+        self.release.set()
+        with self.assertRaises(utils.EmailException):
+            b''.join(second)
+        with self.assertRaises(utils.EmailException):
+            first.result(5)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_max_bytes(self):
+        """Large replies stop taking new requests."""
+        self.release.set()
+        response = self.coalescer.fetch(self.request, self.send)
+        next(response)
+        # The head alone is over max_bytes
+        b''.join(self.coalescer.fetch(self.request, self.send))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(next(response), b'body')
+        self.assertEqual(self.coalescer._in_flight, {})
+
+
+class TestAsyncProxy(unittest.TestCase):
+    """Tests for the asyncio proxy server."""
+
+    def test_many_clients(self):
+        """Clients waiting on their replies don't hold a thread each."""
+        responses = []
+
+        def submit(data, client=None):
+            response = utils.ChunkedResponse()
+            responses.append((data, response))
+            future = Future()
+            future.set_result(response)
+            return future
+
+        batcher = mock.Mock()
+        batcher.submit.side_effect = submit
+        handler = type('Handler', (local.TCPProxyHandler,),
+                       {'batcher': batcher, 'cache': None})
+        proxy = local.AsyncTCPProxyServer(('127.0.0.1', 0), handler, 100)
+        threads = threading.active_count()
+
+        def reply():
+            for data, response in responses:
+                response.add(0, utils.Attachment('x', {}, data.upper()),
+                             False)
+
+        async def clients():
+            proxy.in_flight = asyncio.Semaphore(proxy.max_in_flight)
+            server = await asyncio.start_server(proxy.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            streams = [await asyncio.open_connection('127.0.0.1', port)
+                       for _ in range(50)]
+            for index, (_, writer) in enumerate(streams):
+                writer.write(b'GET /%d HTTP/1.1\r\n\r\n' % index)
+            while len(responses) < len(streams):
+                await asyncio.sleep(0.01)
+            self.assertLessEqual(threading.active_count(), threads)
+            threading.Thread(target=reply).start()
+            replies = [await reader.read() for reader, _ in streams]
+            server.close()
+            await server.wait_closed()
+            return replies
+
+        replies = asyncio.run(asyncio.wait_for(clients(), 10))
+        self.assertEqual(replies[3], b'GET /3 HTTP/1.1\r\n\r\n'.upper())
+
+    def test_cache_streaming(self):
+        """Responses pass through the cache as their emails arrive."""
+        settings = utils.Settings()
+        settings.CACHE_DIR = ''
+        response = utils.ChunkedResponse()
+        sent = Future()
+        sent.set_result(response)
+        batcher = mock.Mock()
+        batcher.submit.return_value = sent
+        handler = type('Handler', (local.TCPProxyHandler,),
+                       {'batcher': batcher,
+                        'cache': cache.ResponseCache(settings)})
+        proxy = local.AsyncTCPProxyServer(('127.0.0.1', 0), handler)
+        head = b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n\r\n'
+
+        async def client():
+            proxy.in_flight = asyncio.Semaphore(1)
+            server = await asyncio.start_server(proxy.handle, '127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', server.sockets[0].getsockname()[1])
+            writer.write(b'GET http://a.com/ HTTP/1.1\r\n\r\n')
+            response.add(0, utils.Attachment('x', {}, head + b'first'),
+                         True)
+            first = await reader.readexactly(len(head) + 5)
+            response.add(1, utils.Attachment('x', {}, b' second'), False)
+            rest = await reader.read()
+            server.close()
+            await server.wait_closed()
+            return first, rest
+
+        first, rest = asyncio.run(asyncio.wait_for(client(), 10))
+        self.assertEqual(first, head + b'first')
+        self.assertEqual(rest, b' second')
+        self.assertEqual(handler.cache.get('http://a.com/').body,
+                         b'first second')
+
+    def test_executor_iteration(self):
+        """The executor runs only a little ahead, and stops when closed."""
+        produced = []
+        closed = threading.Event()
+
+        def numbers():
+            try:
+                for number in itertools.count():
+                    produced.append(number)
+                    yield number
+            finally:
+                closed.set()
+
+        async def consume():
+            chunks = local.iterate_in_executor(numbers, buffered=2)
+            self.assertEqual(await chunks.__anext__(), 0)
+            await asyncio.sleep(0.1)
+            self.assertLessEqual(len(produced), 5)
+            await chunks.aclose()
+
+        asyncio.run(asyncio.wait_for(consume(), 10))
+        self.assertTrue(closed.wait(5))
+
+    def test_coalescing(self):
+        """Identical requests share one trip through email."""
+        response = utils.ChunkedResponse()
+        sent = Future()
+        sent.set_result(response)
+        batcher = mock.Mock()
+        batcher.submit.return_value = sent
+        handler = type('Handler', (local.TCPProxyHandler,),
+                       {'batcher': batcher, 'cache': None,
+                        'coalescer': coalesce.Coalescer()})
+        proxy = local.AsyncTCPProxyServer(('127.0.0.1', 0), handler)
+
+        async def clients():
+            proxy.in_flight = asyncio.Semaphore(2)
+            server = await asyncio.start_server(proxy.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            streams = [await asyncio.open_connection('127.0.0.1', port)
+                       for _ in range(2)]
+            for _, writer in streams:
+                writer.write(b'GET http://a.com/ HTTP/1.1\r\n\r\n')
+                await asyncio.sleep(0.1)
+            response.add(0, utils.Attachment('x', {}, b'shared'), False)
+            replies = [await reader.read() for reader, _ in streams]
+            server.close()
+            await server.wait_closed()
+            return replies
+
+        replies = asyncio.run(asyncio.wait_for(clients(), 10))
+        self.assertEqual(replies, [b'shared', b'shared'])
+        self.assertEqual(batcher.submit.call_count, 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the stage timings."""
+
+    def test_render(self):
+        """Metrics are served in the Prometheus text format."""
+        registry = metrics.Registry()
+        seconds = registry.histogram('seconds', 'Time', ('stage',),
+                                     buckets=(0.1, 1))
+        errors = registry.counter('errors_total', 'Errors', ('stage',))
+        seconds.observe(0.05, stage='send')
+        seconds.observe(0.5, stage='send')
+        errors.inc(stage='a "b"')
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP seconds Time',
+            '# TYPE seconds histogram',
+            'seconds_bucket{stage="send",le="0.1"} 1',
+            'seconds_bucket{stage="send",le="1"} 2',
+            'seconds_bucket{stage="send",le="+Inf"} 2',
+            'seconds_sum{stage="send"} 0.55',
+            'seconds_count{stage="send"} 2',
+            '# HELP errors_total Errors',
+            '# TYPE errors_total counter',
+            'errors_total{stage="a \\"b\\""} 1'])
+
+    def test_stages(self):
+        """Stages are timed, failures and bytes counted."""
+        _, before = metrics.summary()
+        with metrics.timed('test_stage'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timed('test_stage'):
+                raise ValueError
+        self.assertEqual(
+            b''.join(metrics.timed_chunks('test_stage', [b'ab', b'c'])),
+            b'abc')
+
+        lines, _ = metrics.summary(before)
+        self.assertEqual([line.split()[:2] for line in lines],
+                         [['test_stage', '2']])
+        self.assertEqual(metrics.STAGE_ERRORS.values()[('test_stage',)], 1)
+        self.assertEqual(metrics.STAGE_BYTES.values()[('test_stage',)], 3)
+
+        server = metrics.serve('127.0.0.1', 0)
+        try:
+            body = requests.get('http://127.0.0.1:%d/metrics'
+                                % server.server_address[1]).text
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('email_to_tcp_stage_seconds_count'
+                      '{stage="test_stage"} 2', body)
+
+
+class TestEndToEnd(unittest.TestCase):
+    """Tests through the whole tunnel, over a fake mail server."""
+
+    def test_benchmark(self):
+        """Requests cross the tunnel and are measured."""
+        results = benchmark.run(requests=6, concurrency=3, size=5000,
+                                timeout=10)
+        self.assertEqual(results['failed'], 0)
+        self.assertGreater(results['mail_bytes_per_request'], 0)
+        seconds, = [line for line in benchmark.report(results, results)
+                    if line.startswith('seconds')]
+        self.assertIn('+0.0%', seconds)
+
+    def test_pipelined_submissions(self):
+        """Queued emails are all delivered, pipelined or not."""
+        for pipelining in (True, False):
+            with fakemail.FakeMailServer() as mail:
+                s = mail.configure(utils.Settings(), 'local@example.com')
+                s.SMTP_PIPELINING = pipelining
+                connection = utils.EmailConnection(s, imap=False)
+                sent = [connection.submit(
+                    'local@example.com', ['remote@example.com'],
+                    iter([b'Subject: %d\r\n\r\nbody\r\n' % i]))
+                    for i in range(5)]
+                for future in sent:
+                    future.result(timeout=10)
+                connection.close()
+                self.assertEqual(mail.delivered, 5)
+
+
 class TestProxy(unittest.TestCase):
     """Tests for the proxy servers."""
 
@@ -80,6 +1631,45 @@ class TestProxy(unittest.TestCase):
         server.select()
         server.close()
 
+    def test_session_limit(self):
+        """Sessions have slots of their own, and are refused beyond them."""
+        opened = threading.Event()
+        closing = threading.Event()
+
+        def open_session(handler, data):
+            opened.set()
+            closing.wait(10)
+
+        response = utils.ChunkedResponse()
+        response.add(0, utils.Attachment('x', {}, b'response'), False)
+        sent = Future()
+        sent.set_result(response)
+        batcher = mock.Mock()
+        batcher.submit.return_value = sent
+        handler = type('Handler', (local.TCPProxyHandler,),
+                       {'batcher': batcher, 'cache': None,
+                        'open_session': open_session})
+        server = local.ThreadedTCPProxyServer(('127.0.0.1', 0), handler,
+                                              max_in_flight=1,
+                                              max_sessions=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(closing.set)
+
+        def request(data):
+            with socket.create_connection(server.server_address, 5) as sock:
+                sock.sendall(data)
+                return sock.recv(1024)
+
+        with socket.create_connection(server.server_address) as session:
+            session.sendall(b'CONNECT a.com:443 HTTP/1.1\r\n\r\n')
+            self.assertTrue(opened.wait(5))
+            self.assertTrue(request(b'CONNECT b.com:443 HTTP/1.1\r\n\r\n')
+                            .startswith(b'HTTP/1.1 503 '))
+            self.assertEqual(request(b'GET / HTTP/1.1\r\n\r\n'),
+                             b'response')
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,264 @@
+"""Shrinking responses on the remote before they are emailed.
+
+With TRANSCODE=1, the remote rewrites the responses it relays to cost
+less email, at some cost in fidelity:
+
+  - JPEG, PNG, WebP and still GIF images are scaled down to fit within
+    TRANSCODE_IMAGE_MAX_SIZE pixels and re-encoded at
+    TRANSCODE_IMAGE_QUALITY (JPEG, or WebP for WebP images, or a 256
+    color PNG for images with transparency). This needs the Pillow
+    package; without it, images are relayed as they are.
+  - HTML, CSS and JavaScript are minified. The minifiers only remove
+    what can't change how a page behaves (comments, indentation, runs of
+    whitespace between tags), and leave JavaScript that has template
+    literals or block comments alone.
+  - Audio and video larger than TRANSCODE_MEDIA_MAX_BYTES are replaced
+    by a short notice saying what was dropped, without downloading the
+    rest of them.
+
+A rewritten response is only relayed if it is smaller, and gets the
+Content-Type and Content-Length of its new body, and an
+X-Tunnel-Transcoded header with the size of the original (or the limit
+it went over).
+"""
+from io import BytesIO
+import itertools
+import logging
+import re
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from email_to_tcp import cache, metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the original body, in a rewritten response
+TRANSCODED_HEADER = 'X-Tunnel-Transcoded'
+
+# Larger bodies are relayed as they are, rather than held in memory
+MAX_BODY_BYTES = 16 * 2 ** 20
+
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/gif'}
+JAVASCRIPT_TYPES = {'application/javascript', 'text/javascript',
+                    'application/x-javascript', 'application/ecmascript'}
+
+
+def shrink_image(data, quality, max_size):
+    """(data, content type) of the image `data` scaled down to fit in
+    `max_size` pixels and re-encoded, or None if it can't be"""
+    if Image is None:
+        return None
+    with Image.open(BytesIO(data)) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        webp = image.format == 'WEBP'
+        transparent = (image.mode in ('RGBA', 'LA', 'PA') or
+                       'transparency' in image.info)
+        image.thumbnail((max_size, max_size))
+        output = BytesIO()
+        if webp:
+            image.save(output, 'WEBP', quality=quality)
+            return output.getvalue(), 'image/webp'
+        if transparent:
+            image.convert('RGBA').quantize(
+                256, method=Image.Quantize.FASTOCTREE).save(
+                    output, 'PNG', optimize=True)
+            return output.getvalue(), 'image/png'
+        image.convert('RGB').save(output, 'JPEG', quality=quality,
+                                  optimize=True, progressive=True)
+        return output.getvalue(), 'image/jpeg'
+
+
+# Strings, and runs of whitespace and comments
+_CSS_TOKENS = re.compile(
+    rb'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|((?:\s|/\*.*?\*/)+)', re.S)
+# Characters that need no whitespace before or after them
+_CSS_PUNCTUATION = b'{};,>'
+
+
+def minify_css(css):
+    """`css` without comments and unneeded whitespace"""
+    def replace(match):
+        string, space = match.groups()
+        if string:
+            return string
+        before = css[match.start() - 1:match.start()]
+        after = css[match.end():match.end() + 1]
+        if (not before or not after or before in _CSS_PUNCTUATION + b':'
+                or after in _CSS_PUNCTUATION):
+            return b''
+        return b' '
+    return _CSS_TOKENS.sub(replace, css)
+
+
+def minify_js(js):
+    """`js` without indentation, blank lines and whole-line comments
+
+    Lines are never joined, so that automatic semicolon insertion works
+    as before. Scripts with template literals or line continuations,
+    whose strings could hold any of those, and scripts with block
+    comments, which could hold lines that look like code or comments,
+    are returned unchanged.
+    """
+    if (b'`' in js or b'\\\n' in js or b'\\\r\n' in js or
+            b'/*' in js):
+        return js
+    lines = (line.strip() for line in js.splitlines())
+    return b'\n'.join(line for line in lines
+                      if line and not line.startswith(b'//'))
+
+
+# Elements whose content isn't HTML, or whose whitespace matters
+_HTML_RAW = re.compile(
+    rb'(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)', re.I | re.S)
+# Comments, tags (whose quoted attribute values may hold anything) and
+# the text between them
+_HTML_TOKENS = re.compile(
+    rb'(<!--.*?-->)|(<(?:"[^"]*"|\'[^\']*\'|[^\'">])*>)|([^<]+|<)', re.S)
+# Type of a <script> element, if it has one
+_SCRIPT_TYPE = re.compile(rb'\stype\s*=\s*["\']?([^"\'\s;>]*)', re.I)
+
+
+def _collapse(text):
+    text = re.sub(rb'\s*\n\s*', b'\n', text)
+    return re.sub(rb'[ \t\f]+', b' ', text)
+
+
+def _markup(html):
+    """`html` without comments, except Internet Explorer's conditional
+    ones, and with runs of whitespace collapsed outside of tags"""
+    parts, text = [], []
+    for comment, tag, other in _HTML_TOKENS.findall(html):
+        if other:
+            text.append(other)
+        elif tag or comment.startswith(b'<!--[if'):
+            parts += [_collapse(b''.join(text)), tag or comment]
+            text = []
+    parts.append(_collapse(b''.join(text)))
+    return b''.join(parts)
+
+
+def _is_javascript(start_tag):
+    match = _SCRIPT_TYPE.search(start_tag)
+    if match is None:
+        return True
+    script_type = str(match.group(1), 'ascii', 'replace').lower()
+    return script_type in JAVASCRIPT_TYPES | {'', 'module'}
+
+
+def minify_html(html):
+    """`html` without comments and runs of whitespace, minifying the
+    content of <style> and JavaScript <script> elements"""
+    parts, position = [], 0
+    for match in _HTML_RAW.finditer(html):
+        start_tag, name, content, end_tag = match.groups()
+        parts.append(_markup(html[position:match.start()]))
+        if name.lower() == b'style':
+            content = minify_css(content)
+        elif name.lower() == b'script' and _is_javascript(start_tag):
+            content = minify_js(content)
+        parts += [start_tag, content, end_tag]
+        position = match.end()
+    parts.append(_markup(html[position:]))
+    return b''.join(parts)
+
+
+def notice(content_type, size):
+    """(head, body iterator) of a response standing in for a dropped
+    body of more than `size` bytes"""
+    text = ('The tunnel dropped this %s of more than %d bytes to save '
+            'bandwidth.' % (content_type, size)).encode('ascii')
+    head = ('HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/plain; charset=us-ascii\r\n'
+            'Content-Length: %d\r\n'
+            'Cache-Control: no-store\r\n'
+            '%s: %d\r\n'
+            'Connection: close\r\n\r\n' % (
+                len(text), TRANSCODED_HEADER, size)).encode('ascii')
+    return head, iter([text])
+
+
+class Transcoder:
+    """Rewrites responses by content type, following the TRANSCODE_*
+    settings `s`"""
+
+    def __init__(self, s):
+        self.image_quality = s.TRANSCODE_IMAGE_QUALITY
+        self.image_max_size = s.TRANSCODE_IMAGE_MAX_SIZE
+        self.media_max_bytes = s.TRANSCODE_MEDIA_MAX_BYTES
+
+    def transcode(self, head, body):
+        """Rewrite a response
+
+        :param head: Status line and headers
+        :param body: Iterator over the body
+        :return: (head, body iterator) of the response to relay
+        """
+        status, headers = cache.parse_response_head(head)
+        if status != 200 or headers.get('Content-Type') is None:
+            return head, body
+        content_type = headers.get_content_type()
+        if content_type.split('/')[0] in ('audio', 'video'):
+            return self._limit_media(head, body, content_type)
+        rewrite = self._rewriter(content_type)
+        if rewrite is None:
+            return head, body
+
+        data, complete = cache.read_at_most(body, MAX_BODY_BYTES)
+        if not complete:
+            return head, itertools.chain([data], body)
+        try:
+            with metrics.timed('transcode'):
+                shrunk = rewrite(data)
+        except Exception as err:
+            logger.debug("Unable to transcode %s: %s", content_type, err)
+            shrunk = None
+        if shrunk is None or len(shrunk[0]) >= len(data):
+            return head, iter([data])
+
+        new_data, new_type = shrunk
+        if new_type == content_type:
+            # Keeping parameters such as the charset
+            new_type = headers.get('Content-Type')
+        for name in ('Content-Type', 'Content-Length', TRANSCODED_HEADER):
+            head = cache.remove_header(head, name)
+        head = cache.add_header(head, 'Content-Type', new_type)
+        head = cache.add_header(head, 'Content-Length', len(new_data))
+        head = cache.add_header(head, TRANSCODED_HEADER, len(data))
+        logger.debug("Transcoded %s from %d to %d bytes", content_type,
+                     len(data), len(new_data))
+        return head, iter([new_data])
+
+    def _rewriter(self, content_type):
+        """Function from a body of `content_type` to (data, content type)
+        of its rewritten version (or None), if there is one"""
+        if content_type in IMAGE_TYPES:
+            if Image is None:
+                return None
+            return lambda data: shrink_image(data, self.image_quality,
+                                             self.image_max_size)
+        if content_type == 'text/html':
+            minify = minify_html
+        elif content_type == 'text/css':
+            minify = minify_css
+        elif content_type in JAVASCRIPT_TYPES:
+            minify = minify_js
+        else:
+            return None
+        return lambda data: (minify(data), content_type)
+
+    def _limit_media(self, head, body, content_type):
+        """Replace an audio or video body larger than the limit with a
+        notice"""
+        if not self.media_max_bytes:
+            return head, body
+        data, complete = cache.read_at_most(body, self.media_max_bytes)
+        if complete:
+            return head, iter([data])
+        logger.debug("Dropped more than %d bytes of %s",
+                     self.media_max_bytes, content_type)
+        return notice(content_type, self.media_max_bytes)
@@ -1,14 +1,27 @@
 from io import BytesIO
+import asyncio
 import base64
-
+import binascii
+import collections
+import contextlib
+import copy
+import functools
+import json
 import os
+import queue
+import re
 import smtplib
 import imaplib
 import logging
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import email
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
+import email.parser
+import email.policy
 
 import getpass
 from http.client import parse_headers
@@ -18,6 +31,8 @@ import petname
 import imaplib2
 import requests
 
+from email_to_tcp import compression, metrics, priority
+
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +74,153 @@ class Settings:
 
     MAIL_PREFIX = '[MailTunnel]'
 
+    # Mailbox the tunnel's emails are read from. A dedicated folder
+    # (filled by a filter rule on the server) keeps them out of the Inbox.
+    IMAP_FOLDER = os.environ.get('IMAP_FOLDER', 'INBOX')
+
+    # Processed tunnel emails are deleted (HOUSEKEEPING=0 keeps them),
+    # HOUSEKEEPING_BATCH at a time or every HOUSEKEEPING_INTERVAL seconds,
+    # so that the mailbox doesn't grow without bound (servers without
+    # UIDPLUS only get them flagged \Deleted, leaving the expunge to the
+    # server or mail client). With ARCHIVE_FOLDER set, they are moved to
+    # that folder instead, as an audit trail.
+    HOUSEKEEPING = os.environ.get('HOUSEKEEPING', '1') != '0'
+    HOUSEKEEPING_BATCH = int(os.environ.get('HOUSEKEEPING_BATCH', '50'))
+    HOUSEKEEPING_INTERVAL = float(os.environ.get('HOUSEKEEPING_INTERVAL',
+                                                 '60'))
+    ARCHIVE_FOLDER = os.environ.get('ARCHIVE_FOLDER', '')
+
+    # Servers without IMAP IDLE (or all servers, if IMAP_USE_IDLE=0) are
+    # polled every POLL_MIN_INTERVAL seconds while requests are
+    # outstanding, backing off to POLL_MAX_INTERVAL while none are, and
+    # never more than POLL_BUDGET times a minute.
+    IMAP_USE_IDLE = os.environ.get('IMAP_USE_IDLE', '1') != '0'
+    POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', '2'))
+    POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', '60'))
+    POLL_BUDGET = int(os.environ.get('POLL_BUDGET', '30'))
+
+    # Requests arriving within BATCH_WINDOW seconds of each other are sent
+    # in one email, up to BATCH_MAX_BYTES of request data. With a window
+    # of 0, only requests that are already queued are batched together.
+    BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW', '0'))
+    BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', str(2 ** 20)))
+
+    # Number of requests the remote forwards to origin servers at once
+    FORWARD_WORKERS = int(os.environ.get('FORWARD_WORKERS', '8'))
+
+    # Local response cache: recently used responses are kept in memory,
+    # and all cacheable ones in CACHE_DIR on disk (set CACHE_DIR to an
+    # empty string to keep the cache in memory only). Responses larger
+    # than CACHE_MAX_ENTRY_BYTES are not cached.
+    CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(
+        os.path.expanduser('~'), '.cache', 'email_to_tcp'))
+    CACHE_MEMORY_BYTES = int(os.environ.get('CACHE_MEMORY_BYTES',
+                                            str(32 * 2 ** 20)))
+    CACHE_DISK_BYTES = int(os.environ.get('CACHE_DISK_BYTES',
+                                          str(512 * 2 ** 20)))
+    CACHE_MAX_ENTRY_BYTES = int(os.environ.get('CACHE_MAX_ENTRY_BYTES',
+                                               str(16 * 2 ** 20)))
+
+    # Identical GET requests made while one is waiting on its reply share
+    # that reply rather than each sending an email (COALESCE=0 turns this
+    # off). A shared response takes new requests until it is complete, or
+    # until COALESCE_MAX_BYTES of it would have to be held for them.
+    COALESCE = os.environ.get('COALESCE', '1') != '0'
+    COALESCE_MAX_BYTES = int(os.environ.get('COALESCE_MAX_BYTES',
+                                            str(8 * 2 ** 20)))
+
+    # The remote keeps up to REMOTE_CACHE_BYTES of origin responses in
+    # memory to answer revalidations from the local cache (0 disables).
+    REMOTE_CACHE_BYTES = int(os.environ.get('REMOTE_CACHE_BYTES',
+                                            str(64 * 2 ** 20)))
+
+    # Both sides replace the header lines of the HTTP messages they tunnel
+    # with indexes into tables they share (see `headertable`), once the
+    # other side has been heard to support it; HEADER_TABLE=0 turns this
+    # off.
+    HEADER_TABLE = os.environ.get('HEADER_TABLE', '1') != '0'
+
+    # With PREFETCH=1, the remote fetches up to PREFETCH_MAX_RESOURCES
+    # same-origin stylesheets, scripts and images linked from each HTML
+    # page, and sends them along with the page for the local cache.
+    PREFETCH = os.environ.get('PREFETCH', '0') != '0'
+    PREFETCH_MAX_RESOURCES = int(os.environ.get('PREFETCH_MAX_RESOURCES',
+                                                '32'))
+
+    # With TRANSCODE=1, the remote shrinks the responses it relays (see
+    # `transcode`): images are scaled down to TRANSCODE_IMAGE_MAX_SIZE
+    # pixels and re-encoded at TRANSCODE_IMAGE_QUALITY (needs Pillow),
+    # HTML, CSS and JavaScript are minified, and audio and video larger
+    # than TRANSCODE_MEDIA_MAX_BYTES are dropped (0 keeps them all).
+    TRANSCODE = os.environ.get('TRANSCODE', '0') != '0'
+    TRANSCODE_IMAGE_QUALITY = int(os.environ.get('TRANSCODE_IMAGE_QUALITY',
+                                                 '40'))
+    TRANSCODE_IMAGE_MAX_SIZE = int(os.environ.get('TRANSCODE_IMAGE_MAX_SIZE',
+                                                  '1280'))
+    TRANSCODE_MEDIA_MAX_BYTES = int(os.environ.get(
+        'TRANSCODE_MEDIA_MAX_BYTES', str(2 * 2 ** 20)))
+
+    # CONNECT sessions send what a socket has sent within SESSION_WINDOW
+    # seconds of its first byte as one frame, in one email. The local
+    # proxy keeps up to MAX_SESSIONS of them open besides its
+    # MAX_IN_FLIGHT requests, and refuses further ones.
+    SESSION_WINDOW = float(os.environ.get('SESSION_WINDOW', '0.2'))
+    MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', '32'))
+
+    # Responses are split across several reply emails once a reply holds
+    # MAX_EMAIL_BYTES of payload, keeping each email well under the
+    # attachment limits of common providers (~25 MB after base64).
+    MAX_EMAIL_BYTES = int(os.environ.get('MAX_EMAIL_BYTES',
+                                         str(10 * 2 ** 20)))
+
+    # The local proxy serves clients from a thread each ('threads'), or
+    # from an asyncio event loop ('asyncio'), which copes with many more
+    # concurrent clients.
+    ENGINE = os.environ.get('ENGINE', 'threads')
+
+    # Maximum number of requests the local proxy keeps waiting on
+    # replies at once. Each in-flight request holds its own email session.
+    MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', '8'))
+
+    # ACCOUNTS_FILE names a JSON list of further email accounts to spread
+    # the tunnel over, each an object of the settings that differ from the
+    # ones above (see `account_settings`). The local proxy sends each
+    # batch from the account with the fewest requests outstanding for its
+    # ACCOUNT_WEIGHT (ACCOUNT_POLICY=least-outstanding), or from each in
+    # turn (round-robin), and rests an account for ACCOUNT_COOLDOWN
+    # seconds after a failed send. The remote reads every account.
+    ACCOUNTS_FILE = os.environ.get('ACCOUNTS_FILE', '')
+    ACCOUNT_WEIGHT = float(os.environ.get('ACCOUNT_WEIGHT', '1'))
+    ACCOUNT_POLICY = os.environ.get('ACCOUNT_POLICY', 'least-outstanding')
+    ACCOUNT_COOLDOWN = float(os.environ.get('ACCOUNT_COOLDOWN', '60'))
+
+    # Dropped SMTP/IMAP sessions are reopened up to RECONNECT_ATTEMPTS
+    # times, waiting RECONNECT_DELAY seconds at first and twice as long
+    # after every failure, up to RECONNECT_MAX_DELAY. The IMAP sessions
+    # that read tunnel emails then start over every RECONNECT_MAX_DELAY
+    # seconds, however long the server stays down.
+    RECONNECT_ATTEMPTS = int(os.environ.get('RECONNECT_ATTEMPTS', '5'))
+    RECONNECT_DELAY = float(os.environ.get('RECONNECT_DELAY', '1'))
+    RECONNECT_MAX_DELAY = float(os.environ.get('RECONNECT_MAX_DELAY', '60'))
+
+    # Idle pooled sessions are checked with NOOP every KEEPALIVE_INTERVAL
+    # seconds, and SPARE_CONNECTIONS healthy ones are kept open so that
+    # requests never wait on a TLS + AUTH handshake.
+    KEEPALIVE_INTERVAL = float(os.environ.get('KEEPALIVE_INTERVAL', '60'))
+    SPARE_CONNECTIONS = int(os.environ.get('SPARE_CONNECTIONS', '1'))
+
+    # The SMTP extensions that let a session send several messages without
+    # waiting on each command (PIPELINING with CHUNKING) are used when the
+    # server offers them, unless SMTP_PIPELINING=0.
+    SMTP_PIPELINING = os.environ.get('SMTP_PIPELINING', '1') != '0'
+
+    # Stage timings (see `metrics`) are served in the Prometheus format on
+    # METRICS_HOST:METRICS_PORT, and summarized in the log every
+    # METRICS_LOG_INTERVAL seconds; 0 turns either off.
+    METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+    METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '0'))
+
     def __init__(self, **kwargs):
         self._configured = False
 
@@ -118,38 +280,417 @@ proxy_settings = Settings()
 settings = Settings()
 
 
+def account_settings(s):
+    """Settings of every email account the tunnel uses
+
+    The first account is `s` itself. Every entry of ACCOUNTS_FILE adds a
+    copy of `s` with the entry's settings; IMAP_USER and FROM_EMAIL follow
+    its SMTP_USER, and IMAP_PASSWORD its SMTP_PASSWORD, unless given.
+
+    :raises ValueError: if an entry names an unknown setting
+    """
+    accounts = [s]
+    if not s.ACCOUNTS_FILE:
+        return accounts
+    with open(os.path.expanduser(s.ACCOUNTS_FILE)) as accounts_file:
+        entries = json.load(accounts_file)
+    for entry in entries:
+        account = copy.copy(s)
+        entry = {key.upper(): value for key, value in entry.items()}
+        if 'SMTP_USER' in entry:
+            account.IMAP_USER = account.FROM_EMAIL = entry['SMTP_USER']
+        if 'SMTP_PASSWORD' in entry:
+            account.IMAP_PASSWORD = entry['SMTP_PASSWORD']
+        for key, value in entry.items():
+            if key.startswith('_') or not hasattr(s, key):
+                raise ValueError('Unknown setting %s in %s'
+                                 % (key, s.ACCOUNTS_FILE))
+            setattr(account, key, value)
+        accounts.append(account)
+    return accounts
+
+
 def generate_filename():
     """Convert data into a unique filename"""
     name = petname.Generate(3, '-')
     return name + '.pkt'
 
 
-def pack(mail_from, recipient_list, subject, data):
+def pack(mail_from, recipient_list, subject, data, encoding=None,
+         headers=None):
     """"Pack TCP request data into an email"""
+    return pack_many(mail_from, recipient_list, subject,
+                     [(generate_filename(), data)], encoding, headers)
+
+
+def pack_many(mail_from, recipient_list, subject, attachments,
+              encoding=None, headers=None):
+    """Pack several TCP payloads into one email, one attachment each
 
-    # Base message
-    package = MIMEMultipart()
-    package['Subject'] = subject
-    package['To'] = recipient_list[0]
-    package['From'] = mail_from
+    :param attachments: iterable of (filename, data) pairs. The filename
+    identifies the payload within the email; replies reuse it.
+    :param encoding: Compression the recipient has agreed to accept
+    (see the `compression` module), or None to send raw payloads.
+    :param headers: Extra headers of the email, e.g. its correlation id
+    """
+    return email.message_from_bytes(b''.join(iter_pack_many(
+        mail_from, recipient_list, subject, attachments, encoding,
+        headers)))
+
+
+def _header_block(headers):
+    """Render (name, value) pairs as a CRLF-terminated header block"""
+    block = ''.join(email.policy.SMTP.fold(name, value)
+                    for name, value in headers)
+    return block.encode('ascii') + b'\r\n'
+
+
+def _iter_base64(chunks):
+    """Base64-encode a stream of byte chunks into 76 character lines"""
+    line_bytes = 57  # Encodes to exactly 76 characters
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        cut = len(pending) - len(pending) % line_bytes
+        if cut:
+            yield base64.encodebytes(pending[:cut]).replace(b'\n', b'\r\n')
+            pending = pending[cut:]
+    if pending:
+        yield base64.encodebytes(pending).replace(b'\n', b'\r\n')
+
+
+def iter_pack_many(mail_from, recipient_list, subject, attachments,
+                   encoding=None, headers=None):
+    """Generate the wire format of `pack_many` in CRLF-terminated chunks
+
+    Attachment data may be bytes, or an iterable of byte chunks (e.g. a
+    streamed HTTP response) that is compressed and encoded as it is
+    consumed, so that only about one chunk is held in memory at a time.
+    Attachments may also be (filename, data, headers) triples, adding
+    the `headers` dictionary to the attachment's MIME headers.
+    `attachments` is consumed lazily, one attachment at a time.
+    """
+    boundary = '=' * 15 + uuid.uuid4().hex + '=='
+    yield _header_block([
+        ('Content-Type', 'multipart/mixed; boundary="%s"' % boundary),
+        ('MIME-Version', '1.0'),
+        ('Subject', subject),
+        ('To', recipient_list[0]),
+        ('From', mail_from),
+        (compression.ACCEPT_HEADER, compression.accept_encoding()),
+    ] + list((headers or {}).items()))
+
+    for filename, data, *extra_headers in attachments:
+        if isinstance(data, (bytes, bytearray)):
+            data, used_encoding = compression.compress(data, encoding)
+            chunks = [data]
+        else:
+            used_encoding = encoding
+            chunks = (compression.compress_stream(data, encoding)
+                      if encoding else data)
+
+        headers = [('Content-Type', 'application/octet-stream'),
+                   ('MIME-Version', '1.0'),
+                   ('Content-Transfer-Encoding', 'base64')]
+        if used_encoding:
+            headers.append((compression.ENCODING_HEADER, used_encoding))
+        for extra in extra_headers:
+            headers.extend(extra.items())
+        headers.append(('Content-Disposition',
+                        'attachment; filename="%s"' % filename))
+
+        yield ('--%s\r\n' % boundary).encode('ascii')
+        yield _header_block(headers)
+        yield from _iter_base64(chunks)
 
-    # Create attachment
-    attachment_type = 'application/octet-stream'
-    maintype, subtype = attachment_type.split('/', 1)
-    attachment = MIMEBase(maintype, subtype)
-    attachment.set_payload(data)
+    yield ('--%s--\r\n' % boundary).encode('ascii')
 
-    # Add to base message
-    email.encoders.encode_base64(attachment)
-    attachment.add_header('Content-Disposition', 'attachment',
-                          filename=generate_filename())
-    package.attach(attachment)
 
-    return package
+class Attachment:
+    """One attachment of a raw message, located without decoding it
+
+    `body` is a memoryview into the raw message, so splitting a batch
+    reply into its attachments copies nothing.
+    """
+
+    def __init__(self, filename, headers, body):
+        self.filename = filename
+        self.headers = headers
+        self.body = body
+
+    def iter_decode(self, chunk_size=2 ** 16):
+        """Yield the decoded (and decompressed) payload in chunks"""
+        chunks = self._iter_transfer_decode(chunk_size)
+        return compression.decompress_stream(
+            chunks, self.headers.get(compression.ENCODING_HEADER))
+
+    def _iter_transfer_decode(self, chunk_size):
+        transfer_encoding = str(self.headers.get(
+            'Content-Transfer-Encoding', '')).strip().lower()
+        body, start = self.body, 0
+        while start < len(body):
+            end = min(start + chunk_size, len(body))
+            if transfer_encoding == 'base64' and end < len(body):
+                # Cut at a line end: lines hold whole base64 quanta
+                end = bytes(body[start:end]).rfind(b'\n') + start + 1 \
+                    or end
+            chunk = body[start:end]
+            start = end
+            if transfer_encoding == 'base64':
+                yield binascii.a2b_base64(chunk)
+            else:
+                yield bytes(chunk)
+
+    def decode(self):
+        """The whole decoded payload"""
+        return b''.join(self.iter_decode())
+
+
+def split_message(raw):
+    """Split a raw RFC822 message into its headers and attachments
+
+    Only the header blocks are parsed; attachment bodies are returned as
+    memoryviews into `raw`, ready to be decoded chunk by chunk.
+
+    :return: (headers, [Attachment, ...]) where headers is an
+    `email.message.Message` holding only the top-level headers
+    """
+    raw = bytes(raw)
+    view = memoryview(raw)
+    headers, body_start = _parse_header_block(raw, 0)
+    boundary = headers.get_param('boundary')
+    if not boundary:
+        raise FormatException('Message is not multipart')
+
+    delimiter = b'--' + boundary.encode('ascii')
+    attachments = []
+    position = raw.find(delimiter, body_start)
+    while position != -1:
+        part_start = position + len(delimiter)
+        if raw.startswith(b'--', part_start):
+            break  # Closing delimiter
+        part_headers, content_start = _parse_header_block(
+            raw, raw.find(b'\n', part_start) + 1)
+        position = raw.find(b'\n' + delimiter, content_start)
+        content_end = len(raw) if position == -1 else position
+        filename = part_headers.get_filename()
+        if filename:
+            attachments.append(Attachment(
+                filename, part_headers, view[content_start:content_end]))
+        if position != -1:
+            position += 1
+    return headers, attachments
+
+
+def _parse_header_block(raw, start):
+    """Parse the headers starting at `start`; returns the headers and
+    the offset of the body that follows them"""
+    end = raw.find(b'\r\n\r\n', start)
+    separator = 4
+    bare_end = raw.find(b'\n\n', start)
+    if end == -1 or (bare_end != -1 and bare_end < end):
+        end, separator = bare_end, 2
+    if end == -1:
+        end, separator = len(raw), 0
+    headers = email.parser.BytesHeaderParser().parsebytes(raw[start:end])
+    return headers, end + separator
+
+
+# Responses split across several emails (see `iter_reply_slices`)
+SEQ_HEADER = 'X-Tunnel-Seq'
+MORE_HEADER = 'X-Tunnel-More'
+
+# Responses the remote sends unasked (see `remote.forward_and_prefetch`):
+# the URL they answer, and the filename of the request whose page
+# linked to it.
+PUSH_HEADER = 'X-Tunnel-Push'
+PUSH_FOR_HEADER = 'X-Tunnel-Push-For'
+
+
+class ResponseBody:
+    """Response body that is sent one email-sized slice at a time
+
+    :param headers: Extra attachment headers for every slice
+    """
+
+    def __init__(self, data, headers=None):
+        if isinstance(data, (bytes, bytearray)):
+            data = [data]
+        self._chunks = iter(data)
+        self.headers = headers or {}
+        self._pushback = b''
+        self.finished = False
+        self.seq = 0
+
+    def _next_chunk(self):
+        if self._pushback:
+            chunk, self._pushback = self._pushback, b''
+            return chunk
+        try:
+            for chunk in self._chunks:
+                if chunk:
+                    return chunk
+        except Exception as err:
+            # Only this body is cut short; the reply goes on
+            logger.error("Response body failed after %d slices: %s",
+                         self.seq, err)
+        self.finished = True
+        return None
+
+    def slice(self, budget):
+        """Yield chunks until the shared `budget` ([bytes left in the
+        email]) is used up or the body is finished"""
+        while budget[0] > 0:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return
+            if len(chunk) > budget[0]:
+                chunk, self._pushback = chunk[:budget[0]], chunk[budget[0]:]
+            budget[0] -= len(chunk)
+            yield chunk
+
+    def has_more(self):
+        """Whether data is left after the last slice"""
+        if self.finished or self._pushback:
+            return not self.finished
+        self._pushback = self._next_chunk() or b''
+        return not self.finished
+
+
+def iter_reply_slices(bodies, max_bytes):
+    """Attachments for the next email of a reply that may span several
+
+    Every unfinished body gets the next slice of its data, numbered with
+    an X-Tunnel-Seq header, until the email holds `max_bytes` of
+    payload; the remaining bodies get empty slices. A body that
+    continues in the next email is followed by an empty X-Tunnel-More
+    marker attachment, written once its slice has been consumed.
+
+    :param bodies: list of (filename, ResponseBody) pairs
+    """
+    budget = [max_bytes]
+    for filename, body in bodies:
+        if body.finished:
+            continue
+        yield filename, body.slice(budget), dict(
+            body.headers, **{SEQ_HEADER: str(body.seq)})
+        body.seq += 1
+        if body.has_more():
+            yield filename, b'', {MORE_HEADER: '1'}
+
+
+class ChunkedResponse:
+    """Response that arrives in one or more emails, possibly out of order
+
+    Iterating yields the decoded payload in order, blocking until the
+    next slice has arrived; `async for` waits without blocking the
+    event loop. The first slice is passed through `unpack`, if set
+    (e.g. `headertable.Peer.unpack_stream`).
+    """
+
+    def __init__(self):
+        self.unpack = None
+        self._slices = {}
+        self._received = 0
+        self._final = None
+        self._error = None
+        self._condition = threading.Condition()
+        self._listeners = []
+
+    def _changed(self):
+        # Called with the condition held
+        self._condition.notify_all()
+        listeners, self._listeners = self._listeners, []
+        for listener in listeners:
+            listener()
+
+    def add(self, seq, attachment, more):
+        """Slice number `seq`; `more` tells whether others follow it"""
+        with self._condition:
+            self._slices[seq] = attachment
+            self._received += 1
+            if not more:
+                self._final = seq
+            self._changed()
+
+    def fail(self, err):
+        with self._condition:
+            self._error = err
+            self._changed()
+
+    @property
+    def complete(self):
+        """Whether every slice has arrived"""
+        with self._condition:
+            return (self._final is not None and
+                    self._received == self._final + 1)
+
+    def __iter__(self):
+        seq = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: seq in self._slices or self._error)
+                if seq not in self._slices:
+                    raise self._error
+                attachment = self._slices.pop(seq)
+                last = seq == self._final
+            yield from self._decode(seq, attachment)
+            if last:
+                return
+            seq += 1
+
+    async def _wait_for(self, predicate):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if predicate():
+                    return
+                changed = loop.create_future()
+                self._listeners.append(functools.partial(
+                    loop.call_soon_threadsafe, _resolve, changed))
+            await changed
+
+    async def __aiter__(self):
+        seq = 0
+        while True:
+            await self._wait_for(lambda: seq in self._slices or self._error)
+            with self._condition:
+                if seq not in self._slices:
+                    raise self._error
+                attachment = self._slices.pop(seq)
+                last = seq == self._final
+            for chunk in self._decode(seq, attachment):
+                yield chunk
+            if last:
+                return
+            seq += 1
+
+    def _decode(self, seq, attachment):
+        chunks = attachment.iter_decode()
+        if seq == 0 and self.unpack is not None:
+            return self.unpack(chunks)
+        return chunks
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
 
 
 def unpack(message):
-    """Unpack the message payload (inverse of pack)"""
+    """Unpack the message payload (inverse of pack)
+
+    If the message holds several attachments, the last one is returned;
+    use `unpack_all` for batches.
+    """
+    attachments = unpack_all(message)
+    return attachments[-1][1] if attachments else None
+
+
+def unpack_all(message):
+    """List the (filename, payload) pairs of a message (inverse of
+    pack_many)"""
 
     if isinstance(message, str):
         message = email.message_from_string(message)
@@ -161,7 +702,7 @@ def unpack(message):
             'Argument message must be either str, bytes, or MIME '
             'email message, not type {}'.format(type(message)))
 
-    payload = None
+    attachments = []
     for part in message.walk():
         if part.get_content_maintype() == 'multipart':
             continue
@@ -170,8 +711,15 @@ def unpack(message):
             logger.debug("No filename")
             continue
         payload = part.get_payload(decode=True)
-        logger.debug("Email payload: %s", payload)
-    return payload
+        try:
+            payload = compression.decompress(
+                payload, part.get(compression.ENCODING_HEADER))
+        except Exception as err:
+            raise FormatException(
+                'Unable to decompress {}: {}'.format(filename, err))
+        logger.debug("Email payload: %d bytes", len(payload))
+        attachments.append((filename, payload))
+    return attachments
 
 
 def base64_encode(data):
@@ -211,124 +759,1446 @@ class Forwarder:
         headers = csrf.join(request_lines[1:])
         self.headers = parse_headers(BytesIO(headers))
 
-    def forward(self):
+    def forward(self, session=None, stream=False):
         """
         Forward request to its destination. Returns a
         requests.Response object
+
+        :param session: Optional `requests.Session` whose kept-alive
+        connections should be reused.
+        :param stream: Return as soon as the headers have arrived and
+        leave the body to be read with `iter_content()`.
         """
         logger.debug("path = %s", self.path)
-        self.response = requests.request(
+        self.response = (session or requests).request(
             method=self.method.lower(),
-            url=self.path, headers=self.headers)
+            url=self.path, headers=self.headers, stream=stream)
         return self.response
 
 
+# Headers that describe the origin connection rather than the relayed
+# response. The body is relayed decoded (see `Response.iter_content`)
+# and delimited by closing the client connection.
+_RELAY_DROPPED_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-connection',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+    'content-encoding', 'content-length',
+}
+
+
+def response_head(response):
+    """Status line and headers of a `requests.Response`, as relayed to
+    the local proxy's client"""
+    lines = ['HTTP/1.1 %d %s' % (response.status_code,
+                                 response.reason or '')]
+    raw_headers = getattr(response.raw, 'headers', None) or response.headers
+    for name, value in raw_headers.items():
+        if name.lower() not in _RELAY_DROPPED_HEADERS:
+            lines.append('%s: %s' % (name, value))
+    lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+
+def error_response(status, reason):
+    """A minimal HTTP response for requests the tunnel couldn't serve"""
+    return ('HTTP/1.1 %d %s\r\nContent-Length: 0\r\n'
+            'Connection: close\r\n\r\n' % (status, reason)).encode('ascii')
+
+
+# Bodies read by `spool` are kept in memory up to this size, and in a
+# temporary file beyond it
+SPOOL_MEMORY_BYTES = 2 ** 20
+
+
+def spool(chunks, chunk_size=2 ** 16, max_memory=SPOOL_MEMORY_BYTES):
+    """Read an iterator of byte chunks to its end, so that errors reading
+    it are raised here rather than while it is being sent on
+
+    :return: iterator over the same bytes, read back from memory or, past
+    `max_memory` bytes, from a temporary file
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_memory)
+    try:
+        for chunk in chunks:
+            spooled.write(chunk)
+    except BaseException:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return _read_spooled(spooled, chunk_size)
+
+
+def _read_spooled(spooled, chunk_size):
+    with spooled:
+        yield from iter(functools.partial(spooled.read, chunk_size), b'')
+
+
+def forwarding_session(pool_size):
+    """A `requests.Session` that keeps up to `pool_size` connections
+    alive per origin, for sharing between forwarding threads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def smtp_connect(s):
+    """Open and log in to an SMTP session described by settings `s`"""
+    logger.debug("Starting SMTP server...")
+    if s.SMTP_USE_SSL:
+        smtp = smtplib.SMTP_SSL(s.SMTP_SERVER, s.SMTP_PORT)
+    else:
+        smtp = smtplib.SMTP(s.SMTP_SERVER, s.SMTP_PORT)
+
+    # TODO(?): Handle non-auth SMTP. (Open relays are rare...)
+    smtp.login(s.SMTP_USER, s.SMTP_PASSWORD)
+    return smtp
+
+
+def imap_connect(s):
+    """Open, log in to and select the mailbox of an IMAP session"""
+    logger.debug("Starting IMAP server...")
+    if s.IMAP_USE_SSL:
+        imap = imaplib2.IMAP4_SSL(s.IMAP_SERVER, s.IMAP_PORT)
+    else:
+        imap = imaplib2.IMAP4(s.IMAP_SERVER, s.IMAP_PORT)
+    imap.login(s.IMAP_USER, s.IMAP_PASSWORD)
+    imap.select(s.IMAP_FOLDER)
+    return imap
+
+
+def is_transient(err):
+    """Whether `err` means the session dropped and should be reopened"""
+    if isinstance(err, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(err, (OSError, imaplib2.IMAP4.abort))
+
+
+def connect_with_backoff(connect, s):
+    """Call `connect(s)`, retrying transient failures with exponential
+    backoff as configured by the RECONNECT_* settings"""
+    delay = s.RECONNECT_DELAY
+    attempt = 1
+    while True:
+        try:
+            return connect(s)
+        except Exception as err:
+            if not is_transient(err) or attempt >= s.RECONNECT_ATTEMPTS:
+                raise
+            logger.warning("Connection failed (%s), retrying in %.1fs",
+                           err, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, s.RECONNECT_MAX_DELAY)
+        attempt += 1
+
+
+def connect_until_up(connect, s, on_failure=None, stopped=None):
+    """`connect_with_backoff`, starting over RECONNECT_MAX_DELAY seconds
+    after every round of failed attempts, for sessions that have to
+    outlast an outage of any length
+
+    :param on_failure: Called with the error of every failed round
+    :param stopped: Event that ends the attempts; None is returned then
+    """
+    stopped = stopped or threading.Event()
+    while not stopped.is_set():
+        try:
+            return connect_with_backoff(connect, s)
+        except Exception as err:
+            if not is_transient(err):
+                raise
+            logger.error("Unable to reconnect (%s), trying again in %.1fs",
+                         err, s.RECONNECT_MAX_DELAY)
+            if on_failure is not None:
+                on_failure(err)
+        stopped.wait(s.RECONNECT_MAX_DELAY)
+    return None
+
+
+def generate_subject():
+    """Subject line for a new tunnel request"""
+    return Settings.MAIL_PREFIX + ' ' + petname.Generate(3, ' ')
+
+
+def normalize_subject(subject):
+    """Collapse the whitespace that mail servers may add when folding"""
+    return ' '.join(str(subject).split())
+
+
+def _as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'surrogateescape')
+    return value
+
+
+def _contains(value, text):
+    """Case-insensitive substring match of a header, as IMAP SEARCH
+    does; always true for an empty `text`"""
+    if not text:
+        return True
+    return normalize_subject(text).lower() in \
+        normalize_subject(value or '').lower()
+
+
+def _starts_with(value, text):
+    if not text:
+        return True
+    return normalize_subject(value or '').lower().startswith(
+        normalize_subject(text).lower())
+
+
+def message_from_raw(raw):
+    """Parse a message returned by an IMAP FETCH (str or bytes)"""
+    if isinstance(raw, bytes):
+        return email.message_from_bytes(raw)
+    return email.message_from_string(raw)
+
+
+def fetch_items(data):
+    """Yield (uid, literal) pairs from the data of an IMAP UID FETCH"""
+    for item in data:
+        if not isinstance(item, tuple):
+            continue
+        match = re.search(r'UID (\d+)', _as_text(item[0]))
+        if match:
+            yield match.group(1), item[1]
+
+
+# Ties a tunneled email to its replies; replies repeat the request's id
+CORRELATION_HEADER = 'X-Tunnel-Id'
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+def _uids(data):
+    uids = []
+    for item in data or []:
+        # An empty mailbox answers with no FETCH response: [None]
+        text = _as_text(item[0] if isinstance(item, tuple) else item) or ''
+        uids += [int(uid) for uid in re.findall(r'UID (\d+)', text)]
+    return uids
+
+
+class MailboxIndex:
+    """Finds new messages by UID rather than by searching the mailbox
+
+    Every scan fetches the headers of the messages from the next UID we
+    haven't seen on (like UIDNEXT), so its cost depends on how many
+    messages have arrived since the last scan, not on how big the
+    mailbox has grown. UIDs outlive a session, so the index is kept
+    across reconnects.
+    """
+    FIELDS = ('Subject', 'From', CORRELATION_HEADER)
+
+    def __init__(self):
+        self.next_uid = None
+        self._unseen = []
+
+    def start(self, imap, unseen=False):
+        """Start indexing from the current end of the mailbox
+
+        :param unseen: Also report the messages that are already unseen
+        on the first scan
+        """
+        if self.next_uid is not None:
+            return
+        status, data = imap.uid('fetch', '*', '(UID)')
+        uids = _uids(data) if status == 'OK' else []
+        self.next_uid = max(uids) + 1 if uids else 1
+        if unseen:
+            status, data = imap.uid('search', None, '(UNSEEN)')
+            self._unseen = [int(uid) for uid in data[0].split()]
+
+    @property
+    def backlog(self):
+        """Whether the next scan reports messages that were unseen"""
+        return bool(self._unseen)
+
+    def scan(self, imap):
+        """(uid, header `Message`) of the messages that arrived since the
+        last scan, oldest first"""
+        unseen, self._unseen = self._unseen, []
+        uid_set = ','.join(['%d:*' % self.next_uid] +
+                           [str(uid) for uid in unseen])
+        status, data = imap.uid(
+            'fetch', uid_set,
+            '(BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(self.FIELDS))
+        messages = {}
+        for uid, header in fetch_items(data):
+            uid = int(uid)
+            # 'n:*' matches the last message even if its UID is below n
+            if uid >= self.next_uid or uid in unseen:
+                messages[uid] = message_from_raw(header)
+        if messages:
+            self.next_uid = max(self.next_uid, max(messages) + 1)
+        return sorted(messages.items())
+
+
+class Housekeeper:
+    """Clears processed tunnel emails out of the mailbox, in batches
+
+    Messages are moved to the archive folder if one is set (with UID
+    MOVE, or COPY where the server lacks MOVE), or else flagged \\Deleted
+    and expunged. Without UIDPLUS, they are only flagged: a plain
+    EXPUNGE would also remove every other message flagged \\Deleted in
+    the folder, so it is left to the server or the mail client.
+    Only the thread that owns the IMAP session may call `sweep()`.
+    """
+
+    def __init__(self, s):
+        self.enabled = s.HOUSEKEEPING
+        self.batch = s.HOUSEKEEPING_BATCH
+        self.interval = s.HOUSEKEEPING_INTERVAL
+        self.archive_folder = s.ARCHIVE_FOLDER
+        self._processed = []
+        self._last_sweep = time.monotonic()
+
+    def processed(self, uids):
+        """Queue the UIDs of messages that have been dealt with"""
+        if self.enabled:
+            self._processed.extend(str(uid) for uid in uids)
+
+    def due(self):
+        return bool(self._processed) and (
+            len(self._processed) >= self.batch or
+            time.monotonic() - self._last_sweep >= self.interval)
+
+    def sweep(self, imap, force=False):
+        """Move or delete the processed messages, if a batch is due"""
+        if not (self.due() or force and self._processed):
+            return
+        uids, self._processed = self._processed, []
+        self._last_sweep = time.monotonic()
+        uid_set = ','.join(uids)
+        capabilities = getattr(imap, 'capabilities', ())
+        try:
+            if self.archive_folder and 'MOVE' in capabilities:
+                status, _ = imap.uid('move', uid_set, self.archive_folder)
+            else:
+                status = 'OK'
+                if self.archive_folder:
+                    status, _ = imap.uid('copy', uid_set,
+                                         self.archive_folder)
+                if status == 'OK':
+                    imap.uid('store', uid_set, '+FLAGS.SILENT',
+                             r'(\Deleted)')
+                    if 'UIDPLUS' in capabilities:
+                        status, _ = imap.uid('expunge', uid_set)
+        except Exception as err:
+            if is_transient(err):
+                self._processed = uids + self._processed
+                raise
+            status = err
+        if status != 'OK':
+            logger.warning("Unable to clear %d processed emails: %s",
+                           len(uids), status)
+        else:
+            logger.debug("Cleared %d processed emails", len(uids))
+
+
+class _Tracked:
+    """Iterable wrapper that records whether iteration has started"""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        return iter(self.iterable)
+
+
+def send_stream(smtp, from_email, to_emails, chunks):
+    """Send a message to an open SMTP session as it is generated
+
+    :param chunks: Iterable of CRLF-terminated byte chunks, each starting
+    at the beginning of a line
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, response = smtp.mail(from_email)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_email)
+    for recipient in to_emails:
+        code, response = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(
+                {recipient: (code, response)})
+    code, response = smtp.docmd('data')
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    try:
+        for chunk in chunks:
+            smtp.send(re.sub(rb'(?m)^\.', b'..', chunk))
+    except Exception:
+        # There is no way to abort DATA; drop the session instead and
+        # let the next send reconnect.
+        smtp.close()
+        raise
+    smtp.send(b'.\r\n')
+    code, response = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+
+# Pipelined messages are sent in BDAT chunks of about this size
+BDAT_BYTES = 2 ** 18
+
+
+def send_pipelined(smtp, messages):
+    """Send several messages to an open SMTP session without waiting for
+    a reply between commands, with the PIPELINING and CHUNKING extensions
+    (RFC 2920 and RFC 3030)
+
+    Every command and chunk of every message is written back to back, and
+    the replies are read once all of them have been written, so that the
+    whole batch costs about one round trip. BDAT chunks need no
+    dot-stuffing, and a message whose chunks fail to generate is
+    abandoned with RSET rather than by dropping the session.
+
+    :param messages: (from_email, to_emails, chunks) triples, where
+    chunks is an iterable of CRLF-terminated byte chunks
+    :return: The error of each message, or None for those that were sent
+    """
+    # message: [(command, argument)] whose replies are awaited, and the
+    # error that abandoned the message
+    awaited = []
+    for from_email, to_emails, chunks in messages:
+        commands = [('MAIL', from_email)] + \
+            [('RCPT', recipient) for recipient in to_emails]
+        smtp.send(''.join(
+            '%s %s:%s\r\n' % (command, 'FROM' if command == 'MAIL' else 'TO',
+                              smtplib.quoteaddr(address))
+            for command, address in commands).encode('ascii'))
+        error = None
+        buffered, size = [], 0
+        try:
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= BDAT_BYTES:
+                    smtp.send(b'BDAT %d\r\n' % size + b''.join(buffered))
+                    commands.append(('BDAT', None))
+                    buffered, size = [], 0
+        except Exception as err:
+            smtp.send(b'RSET\r\n')
+            commands.append(('RSET', None))
+            error = err
+        else:
+            smtp.send(b'BDAT %d LAST\r\n' % size + b''.join(buffered))
+            commands.append(('BDAT', None))
+        awaited.append((commands, error))
+
+    errors = []
+    for commands, error in awaited:
+        refused = {}
+        for command, address in commands:
+            code, response = smtp.getreply()
+            if error is not None or command == 'RSET':
+                continue
+            if command == 'MAIL' and code != 250:
+                error = smtplib.SMTPSenderRefused(code, response, address)
+            elif command == 'RCPT' and code not in (250, 251):
+                refused[address] = (code, response)
+            elif command == 'BDAT' and code != 250:
+                error = (smtplib.SMTPRecipientsRefused(refused) if refused
+                         else smtplib.SMTPDataError(code, response))
+        if error is None and refused:
+            error = smtplib.SMTPRecipientsRefused(refused)
+        errors.append(error)
+    return errors
+
+
+def _stored_exists(imap):
+    """EXISTS responses `imap` received outside IDLE, which it keeps until
+    asked for them"""
+    _, data = imap.response('EXISTS')
+    return [] if data == [None] else data
+
+
+class MailboxWaiter:
+    """Waits until new mail may have arrived in an IMAP mailbox.
+
+    Uses IDLE push notifications when the server advertises them.
+    Otherwise it polls adaptively: quickly while requests are
+    outstanding, backing off exponentially while nothing is, and within
+    a budget of polls per minute (see the POLL_* settings).
+    """
+    idle_timeout = 90
+    idle_recheck = 0.25
+
+    def __init__(self, s):
+        self.settings = s
+        self.use_idle = s.IMAP_USE_IDLE
+        self._interval = s.POLL_MIN_INTERVAL
+        self._polls = collections.deque()
+        self._wakeup = threading.Event()
+
+    def attach(self, imap):
+        """Detect whether the (new) session `imap` supports IDLE"""
+        self.use_idle = (self.settings.IMAP_USE_IDLE and
+                         'IDLE' in imap.capabilities)
+        if not self.use_idle:
+            logger.info("IMAP IDLE unavailable, polling for new mail")
+
+    def wait(self, imap, busy):
+        """Block until it is time to look for new mail
+
+        :param busy: Whether requests are waiting on mail right now
+        """
+        if self.use_idle:
+            return self.idle(imap)
+
+        self._wakeup.wait(self.next_interval(busy))
+        self._wakeup.clear()
+        time.sleep(self.budget_delay())
+        self._polls.append(time.monotonic())
+        return 'OK', [b'POLL']
+
+    def idle(self, imap):
+        """IDLE until the server announces new mail"""
+        # New mail announced in the response to an earlier command isn't
+        # announced again during IDLE
+        exists = _stored_exists(imap)
+        if exists:
+            return 'OK', exists
+
+        # imaplib2 only ends IDLE on responses that arrive after it has
+        # seen the server accept the command: mail announced right away
+        # is stored instead, so look for it once IDLE is under way
+        found = []
+
+        def recheck():
+            found.extend(_stored_exists(imap))
+            if found:
+                # Other commands wait for IDLE to end rather than ending
+                # it, so send DONE the way imaplib2 does on new mail
+                imap._end_idle()
+
+        timer = threading.Timer(self.idle_recheck, recheck)
+        timer.daemon = True
+        timer.start()
+        try:
+            result = imap.idle(timeout=self.idle_timeout)
+        finally:
+            timer.cancel()
+            timer.join()
+        return ('OK', found) if found else result
+
+    def notify(self):
+        """A request is now outstanding: poll soon"""
+        self._interval = self.settings.POLL_MIN_INTERVAL
+        self._wakeup.set()
+
+    def next_interval(self, busy):
+        """Seconds until the next poll"""
+        if busy:
+            self._interval = self.settings.POLL_MIN_INTERVAL
+        else:
+            self._interval = min(self._interval * 2,
+                                 self.settings.POLL_MAX_INTERVAL)
+        return self._interval
+
+    def budget_delay(self):
+        """Extra seconds to wait to stay within POLL_BUDGET per minute"""
+        now = time.monotonic()
+        while self._polls and self._polls[0] <= now - 60:
+            self._polls.popleft()
+        if len(self._polls) < self.settings.POLL_BUDGET:
+            return 0
+        return self._polls[0] + 60 - now
+
+
+# Messages sent in one go by `send_pipelined`, at most
+MAX_PIPELINED = 16
+
+
+class _Submission:
+    """A message waiting for `EmailConnection`'s sending thread"""
+
+    def __init__(self, from_email, to_emails, message, stage, future):
+        self.from_email = from_email
+        self.to_emails = to_emails
+        self.message = message
+        self.chunks = None
+        if not isinstance(message, (str, bytes)):
+            self.chunks = _Tracked(message)
+        self.stage = stage
+        self.future = future
+
+    def done(self, started, error=None):
+        if self.stage is not None:
+            if error is None:
+                metrics.observe(self.stage, time.monotonic() - started)
+            else:
+                metrics.count_error(self.stage)
+        if error is None:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(error)
+
+
+def _resolve_with(future, result):
+    """Future of `result`, done when `future` is"""
+    resolved = Future()
+
+    def done(_):
+        if future.exception() is not None:
+            resolved.set_exception(future.exception())
+        else:
+            resolved.set_result(result)
+    future.add_done_callback(done)
+    return resolved
+
+
 class EmailConnection:
     """Houses both an SMTP and IMAP connection for bidirectional packet
     communication through email. This class takes care of sending and
     receiving the responses from the email server, packaging up the
     data to send, etc.
+
+    Pass `imap=False` for a send-only connection, e.g. when replies are
+    collected by a `ReplyWatcher`.
     """
 
-    def __init__(self, s):
+    def __init__(self, s, imap=True):
 
+        self.settings = s
         self.from_email = s.FROM_EMAIL
         self.to_email = s.TO_EMAIL
 
-        logger.debug("Starting SMTP server...")
-        if s.SMTP_USE_SSL:
-            self.smtp = smtplib.SMTP_SSL(s.SMTP_SERVER,
-                                         s.SMTP_PORT)
-        else:
-            self.smtp = smtplib.SMTP(s.SMTP_SERVER,
-                                     s.SMTP_PORT)
-
-        # TODO(?): Handle non-auth SMTP. (Open relays are rare...)
-        self.smtp.login(s.SMTP_USER, s.SMTP_PASSWORD)
-
-        logger.debug("Starting IMAP server...")
-        if s.IMAP_USE_SSL:
-            self.imap = imaplib2.IMAP4_SSL(s.IMAP_SERVER,
-                                           s.IMAP_PORT)
-        else:
-            self.imap = imaplib2.IMAP4(s.IMAP_SERVER,
-                                       s.IMAP_PORT)
-        self.imap.login(s.IMAP_USER,
-                        s.IMAP_PASSWORD)
-        self.imap.select("Inbox")  # TODO: Allow other inboxes
-
-        # TODO: Chekc if IDLE is allowed, and if not, revert to polling
+        self.smtp = connect_with_backoff(smtp_connect, s)
+        self.imap = connect_with_backoff(imap_connect, s) if imap else None
+        self.waiter = MailboxWaiter(s)
+        self.index = MailboxIndex()
+        self.housekeeper = Housekeeper(s)
+        if self.imap is not None:
+            self.waiter.attach(self.imap)
+
+        # UIDs found by an earlier scan but not yet returned by fetch()
+        self._pending = []
+        # Whether the last scan found mail; more is likely to follow
+        self._busy = False
+
+        # Messages wait here for the sending thread (see `submit`)
+        self._outbox = queue.Queue()
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        # Held while the SMTP session is in use
+        self._smtp_lock = threading.Lock()
+
+    def close(self):
+        """Close both sessions, ignoring errors from dead connections."""
+        self._outbox.put(None)
+        closers = [self.smtp.quit]
+        if self.imap is not None:
+            closers.append(self.imap.logout)
+        for close in closers:
+            try:
+                close()
+            except Exception as err:
+                logger.debug("Error closing connection: %s", err)
+
+    def is_alive(self):
+        """Check both sessions with a NOOP"""
+        try:
+            with self._smtp_lock:
+                if self.smtp.noop()[0] != 250:
+                    return False
+            if self.imap is not None:
+                self.imap.noop()
+        except Exception as err:
+            logger.debug("Health check failed: %s", err)
+            return False
+        return True
+
+    def submit(self, from_email, to_emails, message, stage=None):
+        """Queue a message for sending; returns a Future that is done
+        once it has been sent
+
+        Queued messages are sent one after the other by a thread of this
+        connection's own, keeping its SMTP session open. Runs of streamed
+        messages go out pipelined (see `send_pipelined`) when the server
+        supports it and SMTP_PIPELINING is set. A message that fails to
+        generate fails alone, without the session or the messages queued
+        with it.
+
+        :param message: Message as str or bytes, or an iterable of
+        CRLF-terminated byte chunks (see `iter_pack_many`) that is
+        streamed to the server as it is generated. The messages queued
+        behind it wait while it is generated, so it should be made from
+        data that has already been read (see `spool`), not from a network
+        stream.
+        :param stage: Metrics stage to time the sending as
+        """
+        future = Future()
+        with self._sender_lock:
+            if self._sender is None:
+                self._sender = threading.Thread(
+                    target=self._send_queued, name='smtp-sender',
+                    daemon=True)
+                self._sender.start()
+        self._outbox.put(_Submission(from_email, to_emails, message, stage,
+                                     future))
+        return future
+
+    def sendmail(self, from_email, to_emails, message):
+        """`smtplib.SMTP.sendmail`, reconnecting once if the server has
+        dropped the session; see `submit`
+
+        A streamed message is only resent if the session was lost before
+        any of it had been consumed.
+        """
+        self.submit(from_email, to_emails, message).result()
 
-    def send(self, data, subject=None):
+    def _send_queued(self):
+        while True:
+            submissions = [self._outbox.get()]
+            while submissions[-1] is not None and \
+                    len(submissions) < MAX_PIPELINED:
+                try:
+                    submissions.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            closed = submissions[-1] is None
+            if closed:
+                submissions.pop()
+            with self._smtp_lock:
+                self._send_submissions(submissions)
+            if closed:
+                return
+
+    def _send_submissions(self, submissions):
+        started = time.monotonic()
+        pipelined = []
+        for submission in submissions:
+            if submission.chunks is not None and self._can_pipeline():
+                pipelined.append(submission)
+                continue
+            self._send_pipeline(pipelined, started)
+            pipelined = []
+            try:
+                self._send_one(submission)
+            except Exception as err:
+                submission.done(started, err)
+            else:
+                submission.done(started)
+        self._send_pipeline(pipelined, started)
+
+    def _can_pipeline(self):
+        try:
+            self.smtp.ehlo_or_helo_if_needed()
+        except Exception as err:
+            logger.debug("Unable to greet the SMTP server: %s", err)
+            return False
+        return bool(self.settings.SMTP_PIPELINING and
+                    self.smtp.has_extn('pipelining') and
+                    self.smtp.has_extn('chunking'))
+
+    def _send_one(self, submission):
+        chunks = submission.chunks
+        try:
+            if chunks is None:
+                self.smtp.sendmail(submission.from_email,
+                                   submission.to_emails, submission.message)
+            else:
+                send_stream(self.smtp, submission.from_email,
+                            submission.to_emails, chunks)
+        except Exception as err:
+            if not is_transient(err) or (chunks and chunks.started):
+                raise
+            logger.warning("SMTP session lost (%s), reconnecting", err)
+            self.smtp = connect_with_backoff(smtp_connect, self.settings)
+            if chunks is None:
+                self.smtp.sendmail(submission.from_email,
+                                   submission.to_emails, submission.message)
+            else:
+                send_stream(self.smtp, submission.from_email,
+                            submission.to_emails, chunks)
+
+    def _send_pipeline(self, submissions, started):
+        """Send streamed messages with `send_pipelined`, sending those
+        that weren't started again if the session drops"""
+        for attempt in range(2):
+            if not submissions:
+                return
+            try:
+                errors = send_pipelined(self.smtp, [
+                    (submission.from_email, submission.to_emails,
+                     submission.chunks) for submission in submissions])
+            except Exception as err:
+                unsent = [submission for submission in submissions
+                          if not submission.chunks.started]
+                for submission in submissions:
+                    if submission.chunks.started or attempt or \
+                            not is_transient(err):
+                        submission.done(started, err)
+                if attempt or not is_transient(err):
+                    return
+                logger.warning("SMTP session lost (%s), reconnecting", err)
+                try:
+                    self.smtp = connect_with_backoff(smtp_connect,
+                                                     self.settings)
+                except Exception as err:
+                    for submission in unsent:
+                        submission.done(started, err)
+                    return
+                submissions = unsent
+            else:
+                for submission, error in zip(submissions, errors):
+                    submission.done(started, error)
+                return
+
+    def reconnect_imap(self):
+        """Replace a dropped IMAP session, waiting as long as it takes"""
+        try:
+            self.imap.logout()
+        except Exception as err:
+            logger.debug("Error closing IMAP connection: %s", err)
+        self.imap = connect_until_up(imap_connect, self.settings)
+        self.waiter.attach(self.imap)
+
+    def send(self, data, subject=None, encoding=None, headers=None):
         """Forward the data"""
+        return self.send_many([(generate_filename(), data)], subject,
+                              encoding, headers)
+
+    def send_many(self, attachments, subject=None, encoding=None,
+                  headers=None, wait=True):
+        """Forward several (filename, data) payloads in one email,
+        compressed with `encoding` if given
+
+        :param headers: Extra headers of the email, such as the
+        correlation id (CORRELATION_HEADER) its replies will carry
+        :param wait: Whether to wait until the email has been sent; if
+        not, a Future for the subject is returned at once
+        """
 
-        subject = subject if subject else \
-            Settings.MAIL_PREFIX + ' ' + petname.Generate(3, ' ')
+        subject = subject if subject else generate_subject()
 
-        package = pack(self.from_email, [self.to_email],
-                       subject, data)
+        package = metrics.timed_chunks('pack_request', iter_pack_many(
+            self.from_email, [self.to_email], subject, attachments,
+            encoding, headers))
 
-        logging.debug("Sending message: %s", package.as_string())
-        self.smtp.sendmail(
-            self.from_email, [self.to_email], package.as_string())
+        logging.debug("Sending message: %s", subject)
+        sent = self.submit(self.from_email, [self.to_email], package,
+                           'smtp_send')
+        if not wait:
+            return _resolve_with(sent, subject)
+        sent.result()
         return subject
 
     def reply(self, data, initial_email):
         """Reply to an email with new data.
         :param data:
         :param initial_email:  Message object with the email we are replying to
-        :return: the email package that was sent
+        :return: the subject of the reply
+        """
+        return self.reply_many([(generate_filename(), data)], initial_email)
+
+    def reply_many(self, attachments, initial_email, headers=None,
+                   wait=True):
+        """Reply to an email with several (filename, data) payloads.
+
+        Payloads are compressed with the best encoding that the sender
+        of `initial_email` advertised.
+        :param attachments: Payloads, named after the request they answer.
+        Each payload is bytes or an iterable of byte chunks.
+        :param initial_email:  Message object with the email we are replying to
+        :param headers: Further headers for the reply
+        :param wait: Whether to wait until the reply has been sent; if
+        not, a Future for the subject is returned at once
+        :return: the subject of the reply
         """
         subject = 'Re: ' + initial_email['subject']
         to_email = initial_email['from']
         from_email = initial_email['to']
-
-        package = pack(from_email, [to_email], subject, data)
-        logging.debug("Replying with message: %s", package.as_string())
-        self.smtp.sendmail(from_email, [to_email], package.as_string())
-        return package
+        encoding = compression.negotiate(
+            initial_email[compression.ACCEPT_HEADER])
+        headers = dict(headers or {})
+        if initial_email[CORRELATION_HEADER]:
+            headers[CORRELATION_HEADER] = \
+                str(initial_email[CORRELATION_HEADER]).strip()
+
+        package = metrics.timed_chunks('pack_reply', iter_pack_many(
+            from_email, [to_email], subject, attachments, encoding, headers))
+        logging.debug("Replying with message: %s", subject)
+        sent = self.submit(from_email, [to_email], package, 'smtp_reply')
+        if not wait:
+            return _resolve_with(sent, subject)
+        sent.result()
+        return subject
 
     def fetch(self, subject=None, email_from=None):
         """Fetch the email response corresponding to a specific request
 
         Algorithm overview:
-         1. Make an IMAP IDLE call.
-         2. When the idle breaks or timeouts, check if there is a
-         message with whose subject line contains the 'subject'
-         argument.
-         3. If not, go back to IDLE (step 1).
-         4. Otherwise, unpack the data from the message and return.
+         1. If an earlier scan found more matches than were returned,
+         return the oldest of those without scanning again.
+         2. Otherwise make an IMAP IDLE call, or wait for the next poll
+         if the server doesn't support IDLE.
+         3. When the wait ends, look at the headers of the messages
+         that arrived since the last scan (see `MailboxIndex`) for one
+         whose subject line starts with the 'subject' argument (so
+         replies, 'Re: ...', are skipped) and whose sender contains
+         `email_from`. Messages
+         that were unseen when fetching started are looked at too.
+         4. If not, go back to IDLE (step 2).
+         5. Otherwise, queue every match and return the oldest.
         """
 
         if not subject and not email_from:
             raise ValueError("At least one of `subject` or "
                              "`email_from` must be defined.")
 
-        search_args = ["(UNSEEN)"]
-        search_args += ["SUBJECT", subject] if subject else []
-        search_args += ["FROM", email_from] if email_from else []
-
         # TODO Timeout implementation
-        # TODO Implement something other than IDLE?
-        search_results = ['']
         logger.debug('IDLE loop started...')
+        while not self._pending:
+            try:
+                self.index.start(self.imap, unseen=True)
+                self.housekeeper.sweep(self.imap)
+                if not self.index.backlog:
+                    status, message = self.waiter.wait(self.imap,
+                                                       self._busy)
+                    logger.debug("IDLE broken: %s : %s", status, message)
+                messages = self.index.scan(self.imap)
+            except Exception as err:
+                if not is_transient(err):
+                    raise
+                logger.warning("IMAP session lost (%s), reconnecting", err)
+                self.reconnect_imap()
+                continue
+            self._pending = [
+                str(uid) for uid, headers in messages
+                if _starts_with(headers['subject'], subject) and
+                _contains(headers['from'], email_from)]
+            logger.debug("New messages %d, matching %d",
+                         len(messages), len(self._pending))
+            self._busy = bool(messages)
+
+        # Oldest first, so that requests are answered in arrival order
+        uid = self._pending.pop(0)
+        with metrics.timed('imap_fetch_request'):
+            status, raw_data = self.imap.uid("fetch", uid, '(RFC822)')
+        metrics.count_bytes('imap_fetch_request', len(raw_data[0][1]))
+        self.housekeeper.processed([uid])
+        logger.debug("Response STATUS: %s (%d bytes)",
+                     status, len(raw_data[0][1]))
+        response_email = message_from_raw(raw_data[0][1])
+
+        return response_email
+
+
+class ReplyWatcher(threading.Thread):
+    """One IMAP session that collects the replies for every waiting
+    request.
+
+    Callers register the correlation id of the request (see
+    CORRELATION_HEADER) with `expect()` *before* sending it, and get
+    back a `concurrent.futures.Future` that resolves to the raw reply
+    (bytes, see `split_message`). Replies that span several emails are
+    collected with `watch()` instead, which hands every email with the
+    id to a callback until `discard()` is called.
+    Each IDLE wakeup (or poll, see `MailboxWaiter`) peeks at the headers
+    of the messages that arrived since the last one (`MailboxIndex`)
+    and fetches the ones somebody is waiting for, so N concurrent
+    requests cost one wakeup and one header fetch, not N, and the
+    mailbox is never searched.
+    """
+
+    # Unclaimed replies remembered, in case their waiter turns up late
+    max_unclaimed = 1000
+
+    def __init__(self, s):
+        super().__init__(name='reply-watcher', daemon=True)
+        self.settings = s
+        self.imap = connect_with_backoff(imap_connect, s)
+        self.waiter = MailboxWaiter(s)
+        self.waiter.attach(self.imap)
+        self.index = MailboxIndex()
+        self.index.start(self.imap)
+        self.housekeeper = Housekeeper(s)
+        self._waiters = {}
+        # uid: correlation id of the replies nobody has claimed yet
+        self._unclaimed = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Why the watcher stopped for good, if it has
+        self._error = None
+
+    def expect(self, correlation_id):
+        """Future for the reply to the request `correlation_id`"""
+        future = Future()
+
+        def on_reply(raw):
+            self.discard(correlation_id)
+            future.set_result(raw)
+
+        self.watch(correlation_id, on_reply, future.set_exception)
+        return future
+
+    def watch(self, correlation_id, on_reply, on_error):
+        """Call `on_reply(raw)` in the watcher thread for every email
+        with the correlation id, or `on_error(exception)` if the
+        watcher fails (at once, if it has stopped)"""
+        with self._lock:
+            error = self._error
+            if error is None:
+                self._waiters[correlation_id] = (on_reply, on_error)
+        if error is not None:
+            on_error(error)
+            return
+        self.waiter.notify()
+
+    def discard(self, correlation_id):
+        """Stop waiting for `correlation_id` (e.g. the client went away)"""
+        with self._lock:
+            self._waiters.pop(correlation_id, None)
+
+    def stop(self):
+        """Stop watching, failing the requests still waiting on replies"""
+        self._stopped.set()
+        self._fail_all(EmailException('Reply watcher stopped'), final=True)
+
+    def run(self):
+        logger.debug('Reply watcher started...')
+        while not self._stopped.is_set():
+            try:
+                status, message = self.waiter.wait(
+                    self.imap, busy=bool(self._waiters))
+                logger.debug("IDLE broken: %s : %s", status, message)
+                self.poll()
+                self.housekeeper.sweep(self.imap)
+            except Exception as err:
+                if self._stopped.is_set():
+                    return
+                try:
+                    if not is_transient(err):
+                        raise
+                    logger.warning("IMAP session lost (%s), reconnecting",
+                                   err)
+                    # Requests waiting on replies fail rather than wait
+                    # out a long outage; new ones wait for the session
+                    imap = connect_until_up(imap_connect, self.settings,
+                                            self._fail_all, self._stopped)
+                except Exception as failure:
+                    logger.error("Reply watcher failed: %s", failure)
+                    self._fail_all(failure, final=True)
+                    raise
+                if imap is not None:
+                    self.imap = imap
+                    self.waiter.attach(imap)
+
+    def poll(self):
+        """Look at the new messages once and resolve their waiters"""
+        with self._lock:
+            if not self._waiters:
+                return
+
+        # Peek at the headers without marking anything as read
+        for uid, headers in self.index.scan(self.imap):
+            # Requests carry the id too, when both ends share a mailbox
+            if headers[CORRELATION_HEADER] and \
+                    _starts_with(headers['subject'], 'Re:'):
+                self._unclaimed[uid] = \
+                    str(headers[CORRELATION_HEADER]).strip()
+        while len(self._unclaimed) > self.max_unclaimed:
+            uid, _ = self._unclaimed.popitem(last=False)
+            self.housekeeper.processed([uid])
+
+        with self._lock:
+            wanted = {str(uid): correlation_id for uid, correlation_id
+                      in self._unclaimed.items()
+                      if correlation_id in self._waiters}
+        if not wanted:
+            return
+        for uid in wanted:
+            del self._unclaimed[int(uid)]
+
+        with metrics.timed('imap_fetch_reply'):
+            status, raw_data = self.imap.uid(
+                'fetch', ','.join(wanted), '(RFC822)')
+        self.housekeeper.processed(wanted)
+        for uid, raw in fetch_items(raw_data):
+            metrics.count_bytes('imap_fetch_reply', len(raw))
+            with self._lock:
+                callbacks = self._waiters.get(wanted[uid])
+            if callbacks is not None:
+                callbacks[0](raw)
+
+    def _fail_all(self, err, final=False):
+        """Fail the requests waiting on replies, and with `final` all those
+        that are watched from now on"""
+        with self._lock:
+            waiters, self._waiters = self._waiters, {}
+            if final:
+                self._error = err
+        for _, on_error in waiters.values():
+            on_error(err)
+
+
+class EmailConnectionPool:
+    """Thread-safe pool of `EmailConnection` objects.
+
+    Each in-flight request checks out its own connection so that
+    concurrent requests never share an SMTP or IMAP session. Connections
+    are created lazily, up to `size`, and returned to the pool after use.
+    Extra keyword arguments are passed on to `EmailConnection`.
+
+    Call `start_keepalive()` to check idle connections in the background
+    and keep spare ones open, so that a dropped session is replaced
+    before a request needs it.
+    """
+
+    def __init__(self, s, size=None, **connection_kwargs):
+        self.settings = s
+        self.size = size or s.MAX_IN_FLIGHT
+        self.connection_kwargs = connection_kwargs
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        return EmailConnection(self.settings, **self.connection_kwargs)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a `with` block."""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                # The session may be in an unknown state; drop it.
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+    def warm(self, count=1):
+        """Open `count` connections ahead of time (checks credentials)."""
+        for _ in range(min(count, self.size) - self._idle.qsize()):
+            self._idle.put(self._connect())
+
+    def check_idle(self):
+        """NOOP every idle connection, dropping the dead ones, and top
+        the pool back up to SPARE_CONNECTIONS idle connections."""
+        idle = []
         while True:
-            status, message = self.imap.idle(timeout=90)
-            logger.debug("IDLE broken: %s : %s", status, message)
-            status, search_results = \
-                self.imap.uid('search', None, *search_args)
-            logger.debug("Search results %s : %s", status, search_results)
-            if search_results[0]:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
                 break
-        unique_ids = search_results[0].split()
-        if len(unique_ids) > 1:
-            # TODO: Use a queue to deal with multiple emails
-            logger.warn("Too many responses from search query SUBJECT %s",
-                        subject)
+        for conn in idle:
+            if conn.is_alive():
+                self._idle.put(conn)
+            else:
+                logger.info("Replacing a dropped email connection")
+                conn.close()
+        self.warm(self.settings.SPARE_CONNECTIONS)
+
+    def start_keepalive(self, interval=None):
+        """Run `check_idle()` every `interval` seconds in the background"""
+        interval = interval or self.settings.KEEPALIVE_INTERVAL
+
+        def keepalive():
+            while True:
+                try:
+                    self.check_idle()
+                except Exception as err:
+                    logger.error("Email connection keepalive failed: %s",
+                                 err)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=keepalive, daemon=True,
+                                  name='email-keepalive')
+        thread.start()
+        return thread
+
+
+class Account:
+    """One email account of the tunnel: the pool of sessions sending from
+    it, and the watcher collecting the replies sent to it"""
+
+    def __init__(self, pool, watcher, weight=1):
+        self.pool = pool
+        self.watcher = watcher
+        self.weight = weight
+        self.resting_until = 0
+        # Correlation ids of the requests waiting on replies
+        self._outstanding = set()
+
+    @property
+    def outstanding(self):
+        return len(self._outstanding)
+
+    def begin(self, correlation_id):
+        self._outstanding.add(correlation_id)
+
+    def end(self, correlation_id):
+        """Stop waiting for the replies to `correlation_id`"""
+        self.watcher.discard(correlation_id)
+        self._outstanding.discard(correlation_id)
+
+
+class AccountSet:
+    """Spreads requests over several email accounts, so that throughput
+    adds up and one throttled account doesn't stall the tunnel.
+
+    With the 'least-outstanding' policy, requests go to the account with
+    the fewest requests waiting on replies for its weight; with
+    'round-robin', accounts take turns in proportion to their weights.
+    An account that failed to send is rested for `cooldown` seconds,
+    unless all of them are resting.
+    """
 
-        # Get the most recent message
-        status, raw_data = self.imap.uid("fetch", unique_ids[-1], '(RFC822)')
-        logger.debug("Response STATUS: %s\nDATA: %s", status, raw_data)
-        response_email = email.message_from_string(raw_data[0][1])
+    def __init__(self, accounts, policy='least-outstanding', cooldown=60):
+        if policy not in ('least-outstanding', 'round-robin'):
+            raise ValueError('Unknown account policy %s' % policy)
+        self.accounts = list(accounts)
+        self.policy = policy
+        self.cooldown = cooldown
+        self._turn = 0
+        # Smooth weighted round-robin: every pick adds each account's
+        # weight to its credit, and takes the total off the winner's
+        self._credit = {id(account): 0 for account in self.accounts}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return sum(account.pool.size for account in self.accounts)
+
+    def candidates(self):
+        """The accounts to send the next request from, best first"""
+        now = time.monotonic()
+        with self._lock:
+            ready = [account for account in self.accounts
+                     if account.resting_until <= now] or self.accounts
+            # Rotate, so that ties go to each account in turn
+            self._turn = (self._turn + 1) % len(ready)
+            ready = ready[self._turn:] + ready[:self._turn]
+            if self.policy == 'round-robin':
+                total = sum(account.weight for account in ready)
+                for account in ready:
+                    self._credit[id(account)] += account.weight
+                best = max(ready, key=lambda account:
+                           self._credit[id(account)])
+                self._credit[id(best)] -= total
+            else:
+                best = min(ready, key=lambda account:
+                           account.outstanding / account.weight)
+        return [best] + [account for account in ready if account is not best]
+
+    def choose(self):
+        return self.candidates()[0]
+
+    def rest(self, account):
+        """Leave `account` out for a while, e.g. after a failed send"""
+        account.resting_until = time.monotonic() + self.cooldown
+
+
+class RequestBatcher(threading.Thread):
+    """Collect outgoing requests into batch emails.
+
+    `submit()` queues a request and returns a Future for its response
+    payload. The first queued request opens a batch, and requests that
+    arrive within `window` seconds join it until `max_bytes` of request
+    data have been collected. Each batch is sent as one email with one
+    attachment per request; the remote answers with one email whose
+    attachments carry the same filenames.
+
+    Each batch is sent from one of `accounts` (an `AccountSet`), and
+    from the next best one should that fail. Batches are only put
+    together once an account is free to send them; until then requests
+    wait in order of priority (see `priority`).
+    Responses the remote pushes along with them are handed to `on_push`
+    (url, raw page request, chunks) on a thread of their own.
+    With `header_tables` (a `headertable.HeaderTables`), request heads
+    are packed for every account whose remote has been heard to support
+    it, and response heads unpacked.
+    """
 
-        return response_email
+    def __init__(self, accounts, window=0, max_bytes=2 ** 20):
+        super().__init__(name='request-batcher', daemon=True)
+        self.accounts = accounts
+        self.window = window
+        self.max_bytes = max_bytes
+        self._queue = priority.FairQueue()
+        self._senders = ThreadPoolExecutor(accounts.size)
+        self._free_senders = threading.Semaphore(accounts.size)
+        # correlation id: when the batch was sent, until its first reply
+        self._sent_at = {}
+
+        # Compression the remote has advertised; learnt from its replies
+        self.encoding = None
+        self.on_push = None
+        self.header_tables = None
+        # account: `headertable.Peer` of its remote; learnt from replies
+        self._peers = {}
+
+    def submit(self, data, client=None):
+        """Future for the response to the request `data`, as an iterable
+        of byte chunks
+
+        :param client: Who the request is from (e.g. their address);
+        requests of the same priority are sent for each client in turn
+        """
+        future = Future()
+        self._queue.put((priority.rank(data), client, (data, future)))
+        return future
+
+    def run(self):
+        while True:
+            self._free_senders.acquire()
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_bytes:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        item = self._queue.get(timeout=timeout)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            logger.debug("Sending batch of %d requests (%d bytes)",
+                         len(batch), size)
+            self._senders.submit(self._send, batch).add_done_callback(
+                lambda _: self._free_senders.release())
+
+    def _send(self, batch):
+        requests_by_name = {}
+        for data, future in batch:
+            filename = generate_filename()
+            while filename in requests_by_name:
+                filename = generate_filename()
+            requests_by_name[filename] = (data, future)
+        responses = {name: ChunkedResponse() for name in requests_by_name}
+
+        correlation_id = new_correlation_id()
+        for account in self.accounts.candidates():
+            self._watch(account, correlation_id, requests_by_name,
+                        responses)
+            attachments = [(name, data) for name, (data, _)
+                           in requests_by_name.items()]
+            headers = {CORRELATION_HEADER: correlation_id}
+            if self.header_tables is not None:
+                peer = self._peers.get(account)
+                if peer is not None:
+                    attachments = [(name, peer.pack(data))
+                                   for name, data in attachments]
+                headers.update(self.header_tables.email_headers(peer))
+            try:
+                with account.pool.connection() as email_connection:
+                    email_connection.send_many(
+                        attachments, generate_subject(), self.encoding,
+                        headers=headers)
+                self._sent_at[correlation_id] = time.monotonic()
+                return
+            except Exception as err:
+                logger.warning("Unable to send batch (%s)", err)
+                account.end(correlation_id)
+                self.accounts.rest(account)
+                error = err
+        self._fail(error, account, correlation_id, requests_by_name,
+                   responses)
+
+    def _watch(self, account, correlation_id, requests_by_name, responses):
+        account.begin(correlation_id)
+        account.watcher.watch(
+            correlation_id,
+            lambda raw: self._distribute(raw, account, correlation_id,
+                                         requests_by_name, responses),
+            lambda err: self._fail(err, account, correlation_id,
+                                   requests_by_name, responses))
+
+    def _distribute(self, raw, account, correlation_id, requests_by_name,
+                    responses):
+        """Hand each attachment of a (possibly partial) batch reply to
+        its request"""
+        sent_at = self._sent_at.pop(correlation_id, None)
+        if sent_at is not None:
+            metrics.observe('wait_reply', time.monotonic() - sent_at)
+        try:
+            with metrics.timed('unpack_reply'):
+                headers, attachments = split_message(raw)
+        except Exception as err:
+            self._fail(err, account, correlation_id, requests_by_name,
+                       responses)
+            return
+        self.encoding = compression.negotiate(
+            headers[compression.ACCEPT_HEADER])
+        peer = None
+        if self.header_tables is not None:
+            peer = self._peers[account] = self.header_tables.peer(headers)
+
+        # filename: [seq, attachment, more]
+        slices = {}
+        for attachment in attachments:
+            entry = slices.setdefault(attachment.filename, [0, None, False])
+            if attachment.headers.get(MORE_HEADER):
+                entry[2] = True
+            else:
+                entry[0] = int(attachment.headers.get(SEQ_HEADER, 0))
+                entry[1] = attachment
+
+        for filename, (seq, attachment, more) in slices.items():
+            if peer is not None and filename in responses:
+                responses[filename].unpack = peer.unpack_stream
+            if filename in requests_by_name or attachment is None:
+                continue
+            if filename not in responses:
+                if not attachment.headers.get(PUSH_HEADER):
+                    logger.warning("Unexpected attachment %s", filename)
+                    continue
+                responses[filename] = ChunkedResponse()
+                if peer is not None:
+                    responses[filename].unpack = peer.unpack_stream
+                self._push(attachment.headers, requests_by_name,
+                           responses[filename])
+            responses[filename].add(seq, attachment, more)
+
+        for filename, (_, future) in requests_by_name.items():
+            response = responses[filename]
+            if filename in slices and slices[filename][1] is not None:
+                response.add(*slices[filename])
+            elif not future.done():
+                # Every reply email holds all unfinished responses
+                logger.warning("No response for %s in batch reply",
+                               filename)
+                response.add(0, Attachment(filename, {}, b''), False)
+            if not future.done():
+                future.set_result(response)
+
+        if all(response.complete for response in responses.values()):
+            account.end(correlation_id)
+
+    def _push(self, headers, requests_by_name, response):
+        page = requests_by_name.get(headers.get(PUSH_FOR_HEADER))
+        if self.on_push is None or page is None:
+            # Its slices are still collected, so that the reply completes
+            return
+        threading.Thread(
+            target=self.on_push, daemon=True, name='push',
+            args=(headers.get(PUSH_HEADER), page[0], response)).start()
+
+    def _fail(self, err, account, correlation_id, requests_by_name,
+              responses):
+        self._sent_at.pop(correlation_id, None)
+        account.end(correlation_id)
+        for response in responses.values():
+            response.fail(err)
+        for _, future in requests_by_name.values():
+            if not future.done():
+                future.set_exception(err)